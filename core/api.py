@@ -0,0 +1,150 @@
+"""Python API for running a config without the command line.
+
+    >>> from core.api import Model
+    >>> result = Model.from_path('configs/icds-14lakh-aug2019.yml').run(set='7lakh-2000fpu')
+    >>> result.value('pg_shards', 'VMs Total', '2020-09')
+    >>> result.summary().service_summary
+
+Results are computed lazily and memoized. Asking for a single service only
+computes that service and the usage fields it needs. The whole usage,
+service and summary data are only computed when they are accessed.
+"""
+import functools
+from collections import OrderedDict
+
+import pandas as pd
+
+from core.config import config_for_set, config_from_path
+from core.cost import get_cost_data
+from core.generate import compute_service, generate_usage_data, get_service_usage_fields
+from core.sets import get_set_context, iter_combined_sets
+from core.summarize import compare_summaries, get_estimation_buffer, get_summary_dates, summarize_service_data
+
+
+class Model(object):
+    """A config and the caches shared by its results"""
+    def __init__(self, config):
+        self.config = config
+        # usage fields and services that are the same in different sets are only computed once
+        self.usage_cache = {}
+        self.service_cache = {}
+
+    @classmethod
+    def from_path(cls, config_path):
+        return cls(config_from_path(config_path))
+
+    def iter_sets(self):
+        """:return: iterator of set contexts"""
+        if not self.config.sets:
+            return iter([{'name': 'default'}])
+        return iter_combined_sets(self.config.sets)
+
+    @property
+    def set_names(self):
+        return [set_context['name'] for set_context in self.iter_sets()]
+
+    def run(self, set=None):
+        """:param set: Name of the set to run. Defaults to the first set.
+        :return: ModelResult. Nothing is computed until the result is used."""
+        return ModelResult(self, get_set_context(self.config, set))
+
+    def run_all(self):
+        """:return: iterator of ModelResult for each set"""
+        for set_context in self.iter_sets():
+            yield ModelResult(self, set_context)
+
+
+class ModelResult(object):
+    """Lazily computed results of a single set"""
+    def __init__(self, model, set_context):
+        self.model = model
+        self.set_context = set_context
+        self.config = config_for_set(model.config, set_context)
+        self._services = {}
+        self._summaries = {}
+
+    @property
+    def name(self):
+        return self.set_context['name']
+
+    def get_usage(self, fields=None):
+        """Usage data for the given fields (and the fields they depend on).
+        All fields are returned once the full usage data has been computed."""
+        if fields is None or 'usage' in self.__dict__:
+            return self.usage
+        return generate_usage_data(self.config, self.set_context, self.model.usage_cache, fields=fields)
+
+    @functools.cached_property
+    def usage(self):
+        return generate_usage_data(self.config, self.set_context, self.model.usage_cache)
+
+    @functools.cached_property
+    def dates(self):
+        # the date range fields determine the dates
+        return self.get_usage(fields=[]).index
+
+    @functools.cached_property
+    def summary_dates(self):
+        return get_summary_dates(self.config, pd.DataFrame(index=self.dates))
+
+    @functools.cached_property
+    def estimation_buffer(self):
+        return get_estimation_buffer(self.config, self.dates)
+
+    def _get_service(self, service_name):
+        if service_name not in self._services:
+            if service_name not in self.config.services:
+                raise KeyError(f'Unknown service "{service_name}"')
+            service_def = self.config.services[service_name]
+            usage = self.get_usage(sorted(get_service_usage_fields(service_def)))
+            self._services[service_name] = compute_service(
+                self.config, service_name, service_def, usage, self.estimation_buffer, self.model.service_cache
+            )
+        return self._services[service_name]
+
+    def service(self, service_name):
+        """Service data of a single service"""
+        return self._get_service(service_name)[0]
+
+    def service_summary(self, service_name):
+        """Summary data of a single service"""
+        return self._get_service(service_name)[1]
+
+    @functools.cached_property
+    def service_data(self):
+        services = list(self.config.services)
+        return pd.concat([self.service(name) for name in services], keys=services, axis=1)
+
+    @functools.cached_property
+    def summary_data(self):
+        services = list(self.config.services)
+        return pd.concat([self.service_summary(name) for name in services], keys=services, axis=1)
+
+    @functools.cached_property
+    def cost_data(self):
+        """Cost of each service for each month or None if the config has no price catalog"""
+        if self.config.price_catalog:
+            return get_cost_data(self.config, self.summary_data)
+
+    def _get_date(self, date):
+        return self.summary_dates[-1] if date is None else pd.Timestamp(date)
+
+    def value(self, service_name, metric, date=None):
+        """Single summary value e.g. ``value('pg_shards', 'VMs Total', '2020-09')``
+
+        :param date: Defaults to the last summary date
+        """
+        return self.service_summary(service_name)[metric].loc[self._get_date(date)]
+
+    def summary(self, date=None):
+        """ServiceSummary of all the services at a date. Defaults to the last summary date."""
+        date = self._get_date(date)
+        if date not in self._summaries:
+            self._summaries[date] = summarize_service_data(self.config, self.summary_data, date, self.cost_data)
+        return self._summaries[date]
+
+    def comparison(self):
+        """SummaryComparison of the summary dates"""
+        return compare_summaries(self.config, OrderedDict(
+            (date, self.summary(date)) for date in self.summary_dates
+        ))
@@ -0,0 +1,146 @@
+"""Simulate autoscaling of services at minute resolution.
+
+The load on each service is built from its monthly compute requirement and
+an hourly load profile. The autoscaling policy is evaluated on whole arrays
+rather than by stepping through events:
+
+* the desired node count is the load divided by the target utilization
+* new nodes are only available ``scale_up_delay`` minutes after they are needed
+* nodes are only removed once the desired count has been lower for
+  ``scale_down_delay`` minutes, which is a rolling maximum of the desired count
+
+so a year at minute resolution is a handful of vectorized operations per service.
+"""
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+MINUTES_PER_HOUR = 60
+# 1970-01-01 (the epoch) was a Thursday
+EPOCH_HOUR_OF_WEEK = 3 * 24
+
+
+def rolling_max(values, window):
+    """Maximum of each value and the ``window - 1`` values before it.
+
+    Uses the van Herk / Gil-Werman algorithm: the array is split into blocks of
+    ``window`` values and each window is the max of a suffix max of one block and
+    a prefix max of the next. This takes a constant number of operations per value
+    regardless of the window size.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if window <= 1 or not len(values):
+        return values.copy()
+    # pad at the start so that the first windows only include the values
+    padded = np.concatenate([np.full(window - 1, -np.inf), values])
+    block_count = -(-len(padded) // window)
+    blocks = np.full(block_count * window, -np.inf)
+    blocks[:len(padded)] = padded
+    blocks = blocks.reshape(block_count, window)
+
+    prefix = np.maximum.accumulate(blocks, axis=1).ravel()
+    suffix = np.maximum.accumulate(blocks[:, ::-1], axis=1)[:, ::-1].ravel()
+    # window ending at padded index j starts at i = j - window + 1
+    starts = np.arange(len(values))
+    return np.maximum(suffix[starts], prefix[starts + window - 1])
+
+
+def shift(values, periods):
+    """Delay the values by ``periods`` steps, repeating the first value at the start"""
+    if periods <= 0:
+        return values
+    return np.concatenate([np.full(min(periods, len(values)), values[0]), values[:-periods]])
+
+
+def get_minutes(start, days):
+    return np.datetime64(pd.Timestamp(start), 'm') + np.arange(days * 24 * MINUTES_PER_HOUR)
+
+
+def get_hourly_factor(minutes, hourly_profile):
+    """Load factor for each minute relative to the peak hour.
+
+    :param hourly_profile: 24 values (one per hour of the day) or
+                           168 values (one per hour of the week starting on Monday)
+    """
+    profile = np.asarray(hourly_profile, dtype=np.float64)
+    if len(profile) not in (24, 168):
+        raise ValueError('hourly_profile must have 24 or 168 values')
+    hours = minutes.astype('datetime64[h]').astype(np.int64)
+    if len(profile) == 168:
+        hours = hours + EPOCH_HOUR_OF_WEEK
+    return profile[hours % len(profile)] / profile.max()
+
+
+def get_monthly_values(minutes, series):
+    """Value of a monthly series for each minute"""
+    months = series.index.values.astype('datetime64[M]')
+    positions = np.searchsorted(months, minutes.astype('datetime64[M]'), side='right') - 1
+    return series.to_numpy(dtype=np.float64)[np.clip(positions, 0, len(months) - 1)]
+
+
+def simulate_nodes(load, target_utilization, scale_up_delay, scale_down_delay, min_nodes=0, max_nodes=None):
+    """Node count for each step of the load.
+
+    :param load: load for each minute in nodes at 100% utilization
+    :return: array of node counts
+    """
+    desired = np.ceil(load / target_utilization - 1e-9)
+    desired = np.clip(desired, min_nodes, max_nodes if max_nodes else None)
+    # nodes are kept until they haven't been needed for the scale down delay
+    kept = rolling_max(desired, scale_down_delay + 1)
+    # new nodes only become available after the scale up delay
+    return np.minimum(kept, shift(kept, scale_up_delay)) if scale_up_delay else kept
+
+
+def simulate_service(service_def, compute, minutes):
+    """Simulate the autoscaling of a single service.
+
+    :param compute: 'Compute' data of the service from ``generate_service_data``
+    :param minutes: array of datetime64 minutes to simulate
+    :return: dict of results
+    """
+    autoscaling = service_def.autoscaling
+    factor = get_hourly_factor(minutes, autoscaling.hourly_profile or [1] * 24)
+    load = get_monthly_values(minutes, compute['VMs Usage']) * factor
+    if autoscaling.noise:
+        # log-normal noise with a mean of 1
+        rng = np.random.default_rng(autoscaling.seed)
+        sigma = np.sqrt(np.log(1 + float(autoscaling.noise) ** 2))
+        load = load * rng.lognormal(-sigma ** 2 / 2, sigma, len(load))
+
+    nodes = simulate_nodes(
+        load,
+        float(autoscaling.target_utilization),
+        autoscaling.scale_up_delay,
+        autoscaling.scale_down_delay,
+        service_def.min_nodes,
+        autoscaling.max_nodes,
+    )
+    static = get_monthly_values(minutes, compute['VMs'])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        utilization = np.where(nodes > 0, load / nodes, 0)
+    return OrderedDict([
+        ('Static VMs', static.max()),
+        ('Average VMs', nodes.mean()),
+        ('Peak VMs', nodes.max()),
+        ('Average / Static', nodes.mean() / static.max() if static.max() else np.nan),
+        ('Average Utilization', utilization.mean()),
+        ('Minutes Over Capacity', int((load > nodes).sum())),
+    ])
+
+
+def simulate_autoscaling(config, service_data, start, days=365):
+    """Simulate all the services that have an autoscaling policy.
+
+    :param service_data: output of ``generate_service_data``
+    :param start: first day to simulate
+    :return: DataFrame with a row per service
+    """
+    minutes = get_minutes(start, days)
+    results = OrderedDict(
+        (service_name, simulate_service(service_def, service_data[service_name]['Compute'], minutes))
+        for service_name, service_def in config.services.items()
+        if service_def.autoscaling
+    )
+    return pd.DataFrame.from_dict(results, orient='index')
@@ -0,0 +1,340 @@
+"""Fit usage and storage parameters of a config to observed monthly metrics.
+
+Observed metrics are usage fields (e.g. ``forms_total``) or the storage of a
+service (e.g. ``couch.storage`` in bytes). The parameters are fitted by least
+squares with a Levenberg-Marquardt solver. Each step evaluates the model once
+per parameter so the model is evaluated with numpy arrays (``DFModel.evaluate``)
+and only the usage fields downstream of the parameters are re-evaluated.
+"""
+import copy
+import os
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+import pandas as pd
+import yaml
+
+from core.config import EXTENDS_KEY, config_for_set, load_config_data
+from core.generate import generate_usage_data
+from core.models import models_by_slug
+from core.utils import apply_context
+
+STORAGE_METRIC = 'storage'
+# storage parameters are written back as whole bytes
+STORAGE_PARAMETERS = ('unit_size', 'static_baseline')
+
+CalibrationResult = namedtuple('CalibrationResult', 'parameters metrics residuals iterations evaluations')
+FitResult = namedtuple('FitResult', 'x iterations evaluations')
+
+
+def load_observations(path):
+    """Load observed monthly values from a CSV or Parquet file.
+
+    The first column is the month and the other columns are the observed metrics.
+    :return: DataFrame indexed by the first day of the month
+    """
+    if path.endswith('.parquet'):
+        observed = pd.read_parquet(path)
+        if not isinstance(observed.index, pd.DatetimeIndex):
+            observed = observed.set_index(observed.columns[0])
+    else:
+        observed = pd.read_csv(path, index_col=0)
+    observed.index = pd.to_datetime(observed.index).to_period('M').to_timestamp()
+    return observed.astype(np.float64)
+
+
+def parse_parameter(path):
+    """'services.couch.storage.data_models.0.unit_size' -> ('services', 'couch', ..., 0, 'unit_size')"""
+    return tuple(int(part) if part.isdigit() else part for part in path.split('.'))
+
+
+def get_value(data, key):
+    for part in key:
+        data = data[part]
+    return data
+
+
+def set_value(data, key, value):
+    get_value(data, key[:-1])[key[-1]] = value
+
+
+def levenberg_marquardt(residuals, x0, lower=None, max_iterations=100, tolerance=1e-10):
+    """Minimize the sum of squared residuals.
+
+    The Jacobian is estimated with forward differences. Steps are scaled by the
+    diagonal of ``J^T J`` (Marquardt's scaling) so parameters of very different
+    magnitudes (e.g. a factor and a size in bytes) converge together.
+
+    :param residuals: function of the parameter array returning an array of residuals
+    :param lower: Optional array of lower bounds. Steps are clipped to the bounds.
+    :return: FitResult
+    """
+    x = np.array(x0, dtype=np.float64)
+    if lower is not None:
+        x = np.maximum(x, lower)
+    r = residuals(x)
+    cost = r @ r
+    evaluations = 1
+    damping = 1e-3
+    iteration = 0
+    for iteration in range(1, max_iterations + 1):
+        steps = 1e-6 * np.maximum(np.abs(x), 1)
+        jacobian = np.empty((len(r), len(x)))
+        for j, step in enumerate(steps):
+            x_step = x.copy()
+            x_step[j] += step
+            jacobian[:, j] = (residuals(x_step) - r) / step
+        evaluations += len(x)
+
+        gradient = jacobian.T @ r
+        hessian = jacobian.T @ jacobian
+        scale = np.maximum(np.diag(hessian), 1e-12)
+        if np.max(np.abs(gradient) / np.sqrt(scale)) <= tolerance * max(np.sqrt(cost), 1):
+            break
+
+        while damping < 1e12:
+            delta = np.linalg.solve(hessian + damping * np.diag(scale), -gradient)
+            x_new = x + delta
+            if lower is not None:
+                x_new = np.maximum(x_new, lower)
+            r_new = residuals(x_new)
+            evaluations += 1
+            cost_new = r_new @ r_new
+            if cost_new < cost:
+                damping = max(damping / 10, 1e-12)
+                break
+            damping *= 10
+        else:
+            # no step reduces the cost
+            break
+
+        converged = cost - cost_new <= tolerance * cost or np.all(np.abs(x_new - x) <= tolerance * np.maximum(np.abs(x), 1))
+        x, r, cost = x_new, r_new, cost_new
+        if converged:
+            break
+    return FitResult(x, iteration, evaluations)
+
+
+class ModelEvaluator(object):
+    """Evaluate the observed metrics for a set of parameter values.
+
+    Usage fields that don't depend on the parameters are computed once with
+    ``generate_usage_data``. The others are re-evaluated with arrays.
+    """
+    def __init__(self, config, set_context, parameters, metrics):
+        """
+        :param parameters: list of parameter key tuples (see ``parse_parameter``)
+        :param metrics: list of metric names
+        """
+        self.config = config
+        self.set_context = set_context
+        self.parameters = parameters
+        self.metrics = metrics
+        self.model_classes = models_by_slug()
+
+        usage = generate_usage_data(config, set_context)
+        self.index = usage.index
+        self.base_values = {field: usage[field].to_numpy(np.float64) for field in usage.columns}
+
+        self.model_params = {}
+        self.storage = {}
+        self.initial = []
+        for key in parameters:
+            self.initial.append(self._init_parameter(key))
+
+        # re-evaluate the fields downstream of the parameters in the order they were computed
+        order = {field: i for i, field in enumerate(usage.columns)}
+        changed_columns = set()
+        self.fields = []
+        for field in sorted(config.usage, key=lambda field: order[field]):
+            params = self.model_params.get(field, config.usage[field].model_params)
+            model = self._get_model(field, params)
+            if field in self.model_params or changed_columns & set(model.dependant_fields):
+                self.model_params[field] = params
+                self.fields.append(field)
+                # some models produce more than one field e.g. 'cases_baseline'
+                changed_columns.update(model.evaluate(self.base_values))
+
+        for metric in metrics:
+            self._init_metric(metric)
+
+    def _init_parameter(self, key):
+        path = '.'.join(str(part) for part in key)
+        section = key[0]
+        if section == 'usage' and len(key) > 2:
+            if key[1] not in self.config.usage:
+                raise ValueError(f'Unknown usage field in parameter "{path}"')
+            params = self.model_params.setdefault(key[1], copy.deepcopy(self.config.usage[key[1]].model_params))
+            value = self._get_config_value(params, key[2:], path)
+            return apply_context(self.set_context, value, float)
+        if section == 'services' and len(key) > 3 and key[2] == STORAGE_METRIC and key[-1] in STORAGE_PARAMETERS:
+            if key[1] not in self.config.services:
+                raise ValueError(f'Unknown service in parameter "{path}"')
+            storage = self._get_storage(key[1])
+            return float(self._get_config_value(storage, key[2:], path))
+        raise ValueError(
+            f'Unable to calibrate "{path}". Only usage model parameters and '
+            f'storage unit_size / static_baseline can be calibrated.'
+        )
+
+    def _get_config_value(self, data, key, path):
+        try:
+            value = get_value(data, key)
+        except (KeyError, IndexError, TypeError):
+            raise ValueError(f'Parameter "{path}" not found')
+        if isinstance(value, str) and '{' in value:
+            raise ValueError(f'Parameter "{path}" is set by a set variable: {value}')
+        return value
+
+    def _get_storage(self, service_name):
+        if service_name not in self.storage:
+            service_def = self.config.services[service_name]
+            buffer = self.config.storage_buffer
+            if service_def.storage.override_storage_buffer is not None:
+                buffer = service_def.storage.override_storage_buffer
+            self.storage[service_name] = {
+                'storage': {
+                    'static_baseline': service_def.storage.static_baseline_bytes,
+                    'data_models': [
+                        {'referenced_field': data_model.referenced_field, 'unit_size': data_model.unit_bytes}
+                        for data_model in service_def.storage.data_models
+                    ],
+                },
+                'redundancy_factor': service_def.storage.redundancy_factor,
+                'buffer': float(buffer) if service_def.storage.data_models else 0,
+            }
+        return self.storage[service_name]
+
+    def _get_model(self, field, params):
+        return self.model_classes[self.config.usage[field].model](self.set_context, field, **params)
+
+    def _init_metric(self, metric):
+        service_name, _, kind = metric.rpartition('.')
+        if kind == STORAGE_METRIC and service_name in self.config.services:
+            self._get_storage(service_name)
+        elif metric not in self.base_values:
+            raise ValueError(f'Unknown metric "{metric}". Expected a usage field or "<service>.storage".')
+
+    def evaluate(self, x):
+        """:return: array of the value of each metric (rows) for each month (columns)"""
+        for key, value in zip(self.parameters, x):
+            if key[0] == 'usage':
+                set_value(self.model_params[key[1]], key[2:], value)
+            else:
+                set_value(self.storage[key[1]], key[2:], value)
+
+        values = dict(self.base_values)
+        for field in self.fields:
+            values.update(self._get_model(field, self.model_params[field]).evaluate(values))
+
+        return np.vstack([self._metric_values(metric, values) for metric in self.metrics])
+
+    def _metric_values(self, metric, values):
+        service_name, _, kind = metric.rpartition('.')
+        if kind != STORAGE_METRIC or service_name not in self.storage:
+            return values[metric]
+        storage = self.storage[service_name]
+        total = np.full(len(self.index), float(storage['storage']['static_baseline']))
+        for data_model in storage['storage']['data_models']:
+            total = total + values[data_model['referenced_field']] * data_model['unit_size']
+        return total * storage['redundancy_factor'] * (1 + storage['buffer'])
+
+
+def calibrate(config, set_context, parameter_paths, observed, max_iterations=100):
+    """Fit the parameters to the observed values.
+
+    Residuals are relative to the largest observed value of each metric so that
+    metrics with different units contribute equally.
+
+    :param parameter_paths: list of config paths e.g. ['usage.forms.factor']
+    :param observed: DataFrame of observed values (see ``load_observations``)
+    :return: CalibrationResult of
+             parameters: DataFrame indexed by parameter with 'Initial' and 'Fitted' columns
+             metrics: DataFrame indexed by metric with the RMS relative error before and after
+             residuals: DataFrame indexed by (metric, date) of observed and model values
+             iterations, evaluations: number of solver iterations and model evaluations
+    """
+    evaluator = ModelEvaluator(
+        config_for_set(config, set_context), set_context, [parse_parameter(path) for path in parameter_paths], list(observed.columns)
+    )
+    observed = observed.reindex(evaluator.index.intersection(observed.index))
+    if observed.empty:
+        raise ValueError('None of the observed months are in the model date range')
+    positions = evaluator.index.get_indexer(observed.index)
+    observed_values = observed.to_numpy().T
+    mask = ~np.isnan(observed_values)
+    scale = np.nanmax(np.abs(observed_values), axis=1, keepdims=True)
+    scale[~(scale > 0)] = 1
+    weights = np.broadcast_to(1 / scale, observed_values.shape)[mask]
+
+    def _residuals(x):
+        return (evaluator.evaluate(x)[:, positions][mask] - observed_values[mask]) * weights
+
+    x0 = np.array(evaluator.initial, dtype=np.float64)
+    fit = levenberg_marquardt(_residuals, x0, lower=np.zeros(len(x0)), max_iterations=max_iterations)
+
+    initial_values = evaluator.evaluate(x0)[:, positions]
+    fitted_values = evaluator.evaluate(fit.x)[:, positions]
+    rows, cols = np.nonzero(mask)
+    residuals = pd.DataFrame(OrderedDict([
+        ('Observed', observed_values[rows, cols]),
+        ('Initial', initial_values[rows, cols]),
+        ('Fitted', fitted_values[rows, cols]),
+        ('Residual', fitted_values[rows, cols] - observed_values[rows, cols]),
+    ]), index=pd.MultiIndex.from_arrays([
+        observed.columns[rows], observed.index[cols]
+    ], names=['metric', 'date']))
+
+    def _rms_error(values):
+        errors = np.where(mask, (values - observed_values) / scale, np.nan)
+        return np.sqrt(np.nanmean(errors ** 2, axis=1))
+
+    metrics = pd.DataFrame(OrderedDict([
+        ('Initial Error', _rms_error(initial_values)),
+        ('Fitted Error', _rms_error(fitted_values)),
+    ]), index=pd.Index(observed.columns, name='metric'))
+    parameters = pd.DataFrame(OrderedDict([
+        ('Initial', x0),
+        ('Fitted', fit.x),
+    ]), index=pd.Index(parameter_paths, name='parameter'))
+    return CalibrationResult(parameters, metrics, residuals, fit.iterations, fit.evaluations)
+
+
+def format_parameter_value(path, value):
+    if parse_parameter(path)[-1] in STORAGE_PARAMETERS:
+        return int(round(value))
+    return float('{:.6g}'.format(value))
+
+
+def write_fitted_config(config_path, parameters, output_path):
+    """Write a config that extends the config file and overrides the fitted parameter values.
+
+    Lists can't be partially overridden so a parameter in a list (e.g. a storage data model)
+    overrides the whole list.
+
+    :param parameters: dict of parameter path -> fitted value
+    """
+    config_data = load_config_data(config_path)
+    keys = [parse_parameter(path) for path in parameters]
+    for key, (path, value) in zip(keys, parameters.items()):
+        set_value(config_data, key, format_parameter_value(path, value))
+
+    base_path = os.path.relpath(os.path.abspath(config_path), os.path.dirname(os.path.abspath(output_path)))
+    overlay = {EXTENDS_KEY: base_path}
+    for key in keys:
+        key = _get_override_key(config_data, key)
+        section = overlay
+        for part in key[:-1]:
+            section = section.setdefault(part, {})
+        section[key[-1]] = get_value(config_data, key)
+    with open(output_path, 'w') as f:
+        yaml.safe_dump(overlay, f, default_flow_style=False, sort_keys=False)
+
+
+def _get_override_key(config_data, key):
+    """The key up to the first list in the path"""
+    for i, part in enumerate(key):
+        if isinstance(config_data, list):
+            return key[:i]
+        config_data = config_data[part]
+    return key
@@ -0,0 +1,206 @@
+from collections import OrderedDict
+
+import jsonobject
+import numpy as np
+import pandas as pd
+import yaml
+
+from core.cost import TOTAL_COST, get_cost_data
+from core.utils import storage_display_to_bytes, byte_map, tier_storage_column
+
+SERVICE_SCOPE = 'service'
+GROUP_SCOPE = 'group'
+STORAGE_GROUP_SCOPE = 'storage_group'
+TOTAL_SCOPE = 'total'
+TOTAL_NAME = 'all'
+
+# resource name -> summary data column
+COMPUTE_RESOURCES = OrderedDict([
+    ('vms', 'VMs Total'),
+    ('cores', 'Cores Total'),
+    ('ram', 'RAM Total (GB)'),
+])
+STORAGE_RESOURCE = 'storage'
+COST_RESOURCE = 'cost'
+
+
+class ResourceLimits(jsonobject.JsonObject):
+    """
+    vms: Number of VMs
+    cores: Number of cores
+    ram: RAM in GB
+    storage: Storage e.g. 10TB or bytes
+    cost: Monthly cost. Requires a price catalog.
+    """
+    _allow_dynamic_properties = False
+    vms = jsonobject.IntegerProperty()
+    cores = jsonobject.IntegerProperty()
+    ram = jsonobject.DecimalProperty()
+    storage = jsonobject.DefaultProperty()
+    cost = jsonobject.DecimalProperty()
+
+    @property
+    def limits(self):
+        limits = OrderedDict()
+        for resource in COMPUTE_RESOURCES:
+            if self[resource] is not None:
+                limits[resource] = float(self[resource])
+        if self.storage is not None:
+            limits[STORAGE_RESOURCE] = float(storage_display_to_bytes(str(self.storage)))
+        if self.cost is not None:
+            limits[COST_RESOURCE] = float(self.cost)
+        return limits
+
+
+class CapacityConfig(jsonobject.JsonObject):
+    """Fixed resources available to the system.
+
+    services: Limits per service
+    groups: Limits per aggregation key (VMs, cores and RAM)
+    storage_groups: Storage limits per storage group
+    total: Limits for the whole system e.g. a monthly budget
+    """
+    _allow_dynamic_properties = False
+    services = jsonobject.DictProperty(ResourceLimits)
+    groups = jsonobject.DictProperty(ResourceLimits)
+    storage_groups = jsonobject.DictProperty(ResourceLimits)
+    total = jsonobject.ObjectProperty(ResourceLimits, default=None)
+
+    def limit_series(self):
+        """Limits as a series indexed by (scope, name, resource)"""
+        limits = OrderedDict()
+        for scope, limits_by_name in [
+            (SERVICE_SCOPE, self.services),
+            (GROUP_SCOPE, self.groups),
+            (STORAGE_GROUP_SCOPE, self.storage_groups),
+            (TOTAL_SCOPE, {TOTAL_NAME: self.total} if self.total else {}),
+        ]:
+            for name, resource_limits in limits_by_name.items():
+                for resource, limit in resource_limits.limits.items():
+                    limits[(scope, name, resource)] = limit
+        return pd.Series(limits, dtype=float)
+
+
+def capacity_from_path(path):
+    with open(path, 'r') as f:
+        return CapacityConfig(yaml.safe_load(f))
+
+
+def get_monthly_demand(config, summary_data):
+    """Resources required each month by service, aggregation group, storage group
+    and for the whole system. Cost is included if the config has a price catalog.
+
+    :param summary_data: output of ``get_summary_data``
+    :return: DataFrame with columns indexed by (scope, name, resource). Storage is in bytes.
+    """
+    bytes_per_unit = byte_map[config.storage_display_unit]
+    storage_column = 'Data Storage Total (%s)' % config.storage_display_unit
+    cost_data = get_cost_data(config, summary_data) if config.price_catalog else None
+
+    service_demand = OrderedDict()
+    groups = OrderedDict()
+    storage_groups = OrderedDict()
+    os_storage = 0
+    for service_name, service_def in config.services.items():
+        summary = summary_data[service_name]
+        resources = OrderedDict(
+            (resource, summary[column].astype(float))
+            for resource, column in COMPUTE_RESOURCES.items()
+        )
+        storage = summary[storage_column].astype(float) * bytes_per_unit
+        if cost_data is not None:
+            resources[COST_RESOURCE] = cost_data[(service_name, TOTAL_COST)]
+        for resource, series in resources.items():
+            service_demand[(SERVICE_SCOPE, service_name, resource)] = series
+        service_demand[(SERVICE_SCOPE, service_name, STORAGE_RESOURCE)] = storage
+
+        group = service_def.aggregation_key or service_name
+        groups.setdefault(group, []).append(resources)
+        storage_group = service_def.storage.group
+        if storage_group:
+            storage_groups[storage_group] = storage_groups.get(storage_group, 0) + storage
+        for tier_group in service_def.storage.tier_groups:
+            tier_storage = summary[tier_storage_column(tier_group, config.storage_display_unit)].astype(float)
+            storage_groups[tier_group] = storage_groups.get(tier_group, 0) + tier_storage * bytes_per_unit
+        os_storage = os_storage + summary['OS Storage Total (Bytes)'].astype(float)
+
+    storage_groups[config.vm_os_storage_group] = storage_groups.get(config.vm_os_storage_group, 0) + os_storage
+
+    demand = service_demand
+    group_resource_names = list(COMPUTE_RESOURCES) + ([COST_RESOURCE] if cost_data is not None else [])
+    for group, group_resources in groups.items():
+        for resource in group_resource_names:
+            demand[(GROUP_SCOPE, group, resource)] = sum(resources[resource] for resources in group_resources)
+    for storage_group, storage in storage_groups.items():
+        demand[(STORAGE_GROUP_SCOPE, storage_group, STORAGE_RESOURCE)] = storage
+
+    for resource in group_resource_names:
+        demand[(TOTAL_SCOPE, TOTAL_NAME, resource)] = sum(
+            demand[(GROUP_SCOPE, group, resource)] for group in groups
+        )
+    demand[(TOTAL_SCOPE, TOTAL_NAME, STORAGE_RESOURCE)] = sum(storage_groups.values())
+
+    demand = pd.DataFrame(demand)
+    demand.columns.names = ['scope', 'name', 'resource']
+    return demand
+
+
+def get_utilization(demand, limits):
+    """Fraction of each limit used by the demand.
+
+    :param demand: output of ``get_monthly_demand``
+    :param limits: output of ``CapacityConfig.limit_series``
+    :return: DataFrame of demand / limit for each limit
+    """
+    _check_limits(demand, limits)
+    return demand[limits.index] / limits
+
+
+def _check_limits(demand, limits):
+    unknown = limits.index.difference(demand.columns)
+    if len(unknown):
+        raise ValueError('Limits defined for unknown services or groups: %s' % ', '.join(
+            ':'.join(key) for key in unknown
+        ))
+
+
+def forecast_exhaustion(demand_by_set, limits, lead_time=0):
+    """Find the first month in which the demand exceeds each limit for every set.
+
+    :param demand_by_set: dict of set name -> output of ``get_monthly_demand``
+    :param limits: output of ``CapacityConfig.limit_series``
+    :param lead_time: months needed to provision new resources
+    :return: DataFrame indexed by (set, scope, name, resource)
+    """
+    if not demand_by_set:
+        raise ValueError('No sets to forecast')
+    sets = list(demand_by_set)
+    dates = demand_by_set[sets[0]].index
+    for demand in demand_by_set.values():
+        _check_limits(demand, limits)
+
+    # sets x months x limits
+    demand = np.stack([
+        demand_by_set[set_name].reindex(index=dates, columns=limits.index).to_numpy(dtype=float)
+        for set_name in sets
+    ])
+    peak = np.maximum.accumulate(np.nan_to_num(demand), axis=1)
+    exceeded = peak > limits.to_numpy()
+    is_exhausted = exceeded.any(axis=1)
+    # months are sorted and peak is non-decreasing so the first True is the exhaustion date
+    first = exceeded.argmax(axis=1)
+
+    exhausted_dates = np.where(is_exhausted, dates.values[first], np.datetime64('NaT'))
+    order_by = pd.DatetimeIndex(exhausted_dates.ravel()) - pd.DateOffset(months=lead_time)
+
+    index = pd.MultiIndex.from_tuples(
+        [(set_name,) + limit for set_name in sets for limit in limits.index],
+        names=['set', 'scope', 'name', 'resource']
+    )
+    return pd.DataFrame(OrderedDict([
+        ('Provisioned', np.tile(limits.to_numpy(), len(sets))),
+        ('Peak Demand', peak[:, -1, :].ravel()),
+        ('Peak Utilization', (peak[:, -1, :] / limits.to_numpy()).ravel()),
+        ('Exhausted', pd.DatetimeIndex(exhausted_dates.ravel())),
+        ('Order By', order_by),
+    ]), index=index)
@@ -0,0 +1,261 @@
+"""Run the queries in ``queries.yml`` to collect inputs for the model.
+
+SQL queries are run against a database (``sqlite:///path`` or ``postgresql://...``)
+using a pool of connections and Elasticsearch queries are sent to an ES endpoint.
+All queries run concurrently. Results are cached on disk for a limited time and
+each result is reduced to a single value that can be used as a set variable in
+a config e.g. ``{task_case_lifespan}``.
+
+Queries are either a string (SQL, or ES if it is a JSON object) or a dict:
+
+    ledgers_per_case:
+      query: '{"aggs": ...}'
+      index: 'case_search'
+      ttl: 3600
+"""
+import asyncio
+import contextlib
+import datetime
+import decimal
+import hashlib
+import json
+import os
+import sqlite3
+import time
+import urllib.request
+from collections import OrderedDict, namedtuple
+
+import yaml
+
+SQL = 'sql'
+ES = 'es'
+DEFAULT_TTL = 24 * 60 * 60
+
+QueryDef = namedtuple('QueryDef', 'name kind query index ttl')
+
+
+def load_queries(path, default_ttl=DEFAULT_TTL):
+    """:return: OrderedDict of query name -> QueryDef"""
+    with open(path, 'r') as f:
+        raw_queries = yaml.safe_load(f)
+
+    queries = OrderedDict()
+    for name, query in raw_queries.items():
+        if isinstance(query, str):
+            query = {'query': query}
+        text = query['query'].strip()
+        kind = query.get('type') or (ES if text.startswith('{') else SQL)
+        if kind not in (SQL, ES):
+            raise ValueError(f'Unknown query type for "{name}": {kind}')
+        queries[name] = QueryDef(name, kind, text, query.get('index', ''), query.get('ttl', default_ttl))
+    return queries
+
+
+def select_queries(queries, names):
+    """:return: OrderedDict of the named queries in the given order"""
+    unknown = [name for name in names if name not in queries]
+    if unknown:
+        raise ValueError('Unknown queries: {}. Known queries: {}'.format(', '.join(unknown), ', '.join(queries)))
+    return OrderedDict((name, queries[name]) for name in names)
+
+
+def get_connect_function(db_url):
+    """:return: function that opens a new DB-API connection to the database"""
+    if db_url.startswith('sqlite:///'):
+        path = db_url[len('sqlite:///'):]
+        return lambda: sqlite3.connect(path, check_same_thread=False)
+    if db_url.startswith(('postgres://', 'postgresql://')):
+        try:
+            import psycopg2
+        except ImportError:
+            raise ValueError('psycopg2 is required for PostgreSQL queries')
+        return lambda: psycopg2.connect(db_url)
+    raise ValueError(f'Unsupported database URL: {db_url}')
+
+
+class ConnectionPool(object):
+    """Fixed size pool of DB-API connections shared by coroutines.
+    Connections are opened when they are first needed."""
+    def __init__(self, connect, size):
+        self.connect = connect
+        self.size = size
+        self.opened = []
+        self.available = asyncio.Queue()
+        self.semaphore = asyncio.Semaphore(size)
+
+    @contextlib.asynccontextmanager
+    async def connection(self):
+        async with self.semaphore:
+            if self.available.empty():
+                conn = await asyncio.get_running_loop().run_in_executor(None, self.connect)
+                self.opened.append(conn)
+            else:
+                conn = self.available.get_nowait()
+            try:
+                yield conn
+            finally:
+                self.available.put_nowait(conn)
+
+    def close(self):
+        for conn in self.opened:
+            conn.close()
+        self.opened = []
+
+
+def _to_json_value(value):
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if isinstance(value, datetime.timedelta):
+        # durations are reported in days
+        return value.total_seconds() / (24 * 60 * 60)
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return value
+
+
+def run_sql(conn, query):
+    """:return: dict with the column names and rows of the result"""
+    cursor = conn.cursor()
+    try:
+        cursor.execute(query)
+        columns = [column[0] for column in cursor.description]
+        rows = [[_to_json_value(value) for value in row] for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+    return {'columns': columns, 'rows': rows}
+
+
+def run_es(es_url, index, query, timeout=60):
+    path = f'/{index}/_search' if index else '/_search'
+    request = urllib.request.Request(
+        es_url.rstrip('/') + path,
+        data=query.encode('utf8'),
+        headers={'Content-Type': 'application/json'},
+        method='POST',
+    )
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return json.loads(response.read().decode('utf8'))
+
+
+def reduce_sql(result):
+    """Single value results are returned as the value, otherwise ``None``"""
+    rows = result['rows']
+    if len(rows) == 1 and len(rows[0]) == 1:
+        return rows[0][0]
+
+
+def reduce_es(result):
+    """Mean number of documents per bucket of the first aggregation.
+
+    For nested bucket aggregations (e.g. a date histogram for each user) the mean
+    is taken of the inner buckets first so the result is e.g. the mean cases per user per month.
+    """
+    aggregations = result.get('aggregations')
+    if not aggregations:
+        total = result.get('hits', {}).get('total')
+        if isinstance(total, dict):
+            # Elasticsearch 7+ e.g. {'value': 10, 'relation': 'eq'}
+            return total.get('value')
+        return total
+    return _mean_bucket_count(next(iter(aggregations.values())))
+
+
+def _mean_bucket_count(aggregation):
+    if 'buckets' not in aggregation:
+        # single bucket aggregation e.g. 'nested'
+        sub_aggregations = [value for value in aggregation.values() if isinstance(value, dict)]
+        if sub_aggregations:
+            return _mean_bucket_count(sub_aggregations[0])
+        return aggregation.get('doc_count')
+
+    values = []
+    for bucket in aggregation['buckets']:
+        sub_aggregations = [value for value in bucket.values() if isinstance(value, dict)]
+        if sub_aggregations:
+            value = _mean_bucket_count(sub_aggregations[0])
+        else:
+            value = bucket['doc_count']
+        if value is not None:
+            values.append(value)
+    return sum(values) / len(values) if values else None
+
+
+class ResultCache(object):
+    """Query results stored in a JSON file. Results expire after the query TTL
+    and are only used if the query and endpoint are unchanged."""
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if path and os.path.exists(path):
+            with open(path, 'r') as f:
+                self.entries = json.load(f)
+
+    @staticmethod
+    def get_key(query_def, endpoint):
+        key = json.dumps([query_def.kind, query_def.query, query_def.index, endpoint])
+        return hashlib.sha1(key.encode('utf8')).hexdigest()
+
+    def get(self, query_def, endpoint):
+        entry = self.entries.get(query_def.name)
+        if entry and entry['key'] == self.get_key(query_def, endpoint) and time.time() - entry['time'] < query_def.ttl:
+            return entry['result']
+
+    def set(self, query_def, endpoint, result):
+        self.entries[query_def.name] = {
+            'key': self.get_key(query_def, endpoint),
+            'time': time.time(),
+            'result': result,
+        }
+
+    def save(self):
+        if self.path:
+            with open(self.path, 'w') as f:
+                json.dump(self.entries, f)
+
+
+async def run_queries(queries, db_url=None, es_url=None, pool_size=4, cache=None, refresh=False):
+    """Run the queries concurrently.
+
+    :param queries: output of ``load_queries``
+    :param cache: Optional ``ResultCache``
+    :param refresh: Ignore cached results
+    :return: OrderedDict of query name -> (result, value) where ``value`` is the reduced result
+    """
+    missing = [q.name for q in queries.values() if (q.kind == SQL and not db_url) or (q.kind == ES and not es_url)]
+    if missing:
+        raise ValueError('No endpoint for queries: {}'.format(', '.join(missing)))
+
+    loop = asyncio.get_running_loop()
+    pool = ConnectionPool(get_connect_function(db_url), pool_size) if db_url else None
+    es_semaphore = asyncio.Semaphore(pool_size)
+
+    async def _run(query_def):
+        endpoint = db_url if query_def.kind == SQL else es_url
+        result = None if refresh or cache is None else cache.get(query_def, endpoint)
+        if result is None:
+            if query_def.kind == SQL:
+                async with pool.connection() as conn:
+                    result = await loop.run_in_executor(None, run_sql, conn, query_def.query)
+            else:
+                async with es_semaphore:
+                    result = await loop.run_in_executor(None, run_es, es_url, query_def.index, query_def.query)
+            if cache is not None:
+                cache.set(query_def, endpoint, result)
+        value = reduce_sql(result) if query_def.kind == SQL else reduce_es(result)
+        return result, value
+
+    try:
+        results = await asyncio.gather(*[_run(query_def) for query_def in queries.values()])
+    finally:
+        if pool:
+            pool.close()
+        if cache is not None:
+            cache.save()
+    return OrderedDict(zip(queries, results))
+
+
+def get_overrides(results, set_name='collected'):
+    """Config overrides with the single value results as set variables"""
+    values = OrderedDict([('name', set_name)])
+    values.update((name, value) for name, (_, value) in results.items() if value is not None)
+    return {'sets': {set_name: [dict(values)]}}
@@ -1,9 +1,18 @@
+import copy
+import functools
+import os
+import subprocess
+
 import jsonobject
 import yaml
 from datetime import datetime
 from jsonobject.base import get_dynamic_properties
 
-from core.utils import storage_display_to_bytes
+from core.sets import iter_combined_sets
+from core.utils import apply_context_typed, get_context_variables, has_context, storage_display_to_bytes
+
+# key of the path of the config that a config overrides
+EXTENDS_KEY = 'extends'
 
 
 class UsageModelDef(jsonobject.JsonObject):
@@ -15,10 +24,30 @@ class UsageModelDef(jsonobject.JsonObject):
         return get_dynamic_properties(self)
 
 
+class StorageTierDef(jsonobject.JsonObject):
+    """
+    group: Storage group of the tier
+    after: Age in months after which data moves to this tier
+    redundancy_factor: Copies of the data kept in this tier
+    """
+    _allow_dynamic_properties = False
+    group = jsonobject.StringProperty(required=True)
+    after = jsonobject.IntegerProperty(required=True)
+    redundancy_factor = jsonobject.IntegerProperty(default=1)
+
+
 class StorageSizeDef(jsonobject.JsonObject):
     _allow_dynamic_properties = False
     referenced_field = jsonobject.StringProperty(required=True)
     unit_size = jsonobject.DefaultProperty(required=True)
+    # lifecycle tiers for data that is older than a number of months. Younger data stays in the service's storage.
+    tiers = jsonobject.ListProperty(StorageTierDef)
+
+    def validate(self, required=True):
+        super(StorageSizeDef, self).validate(required=required)
+        ages = [tier.after for tier in self.tiers]
+        assert all(age > 0 for age in ages), 'storage tier "after" must be at least 1 month'
+        assert ages == sorted(set(ages)), 'storage tiers must be in order of increasing "after"'
 
     @property
     def unit_bytes(self):
@@ -32,17 +61,33 @@ class SubProcessDef(jsonobject.JsonObject):
     usage_field: Field to reference for capacity. Defaults to 'users'
     capacity: Usage capacity that each process can support. e.g. 500 users per process
 
-    Only one of ``static_number`` and ``capacity`` should be supplied.
+    Queueing mode (size the processes to meet a target wait time):
+    service_time: Mean time in seconds to process a task
+    target_wait: Target time in seconds that tasks wait before being processed
+    wait_percentile: Fraction of tasks that should wait less than ``target_wait``. Defaults to 0.95
+    tasks_per_usage: Number of tasks per month for each unit of usage. Defaults to 1
+    peak_factor: Ratio of the peak task rate to the average rate. Defaults to 1
+    concurrency: Number of tasks each process can work on at a time. Defaults to 1
+
+    Only one of ``static_number``, ``capacity`` and ``service_time`` should be supplied.
     """
     name = jsonobject.StringProperty()
     static_number = jsonobject.IntegerProperty()
     capacity = jsonobject.DecimalProperty()
 
+    service_time = jsonobject.DecimalProperty()
+    target_wait = jsonobject.DecimalProperty()
+    wait_percentile = jsonobject.DecimalProperty(default=0.95)
+    tasks_per_usage = jsonobject.DecimalProperty(default=1)
+    peak_factor = jsonobject.DecimalProperty(default=1)
+    concurrency = jsonobject.IntegerProperty(default=1)
+
     def validate(self, required=True):
-        if self.static_number:
-            assert not self.capacity, 'only one of static_number and capacity should be provided'
-        else:
-            assert self.capacity, 'one of static_number or capacity required'
+        modes = [mode for mode in (self.static_number, self.capacity, self.service_time) if mode]
+        assert len(modes) == 1, 'one of static_number, capacity or service_time required'
+        if self.service_time:
+            assert self.target_wait is not None, 'target_wait required with service_time'
+            assert 0 < self.wait_percentile < 1, 'wait_percentile must be between 0 and 1'
 
 
 class StorageDef(jsonobject.JsonObject):
@@ -58,6 +103,16 @@ class StorageDef(jsonobject.JsonObject):
     def static_baseline_bytes(self):
         return storage_display_to_bytes(str(self.static_baseline))
 
+    @property
+    def tier_groups(self):
+        """Storage groups of the lifecycle tiers of the data models"""
+        groups = []
+        for data_model in self.data_models:
+            for tier in data_model.tiers:
+                if tier.group not in groups:
+                    groups.append(tier.group)
+        return groups
+
 
 class ProcessDef(jsonobject.JsonObject):
     _allow_dynamic_properties = False
@@ -79,6 +134,57 @@ class ProcessDef(jsonobject.JsonObject):
             assert self.ram_per_sub_process, 'ram_per_sub_process required if more than one process listed'
 
 
+class AutoscalingDef(jsonobject.JsonObject):
+    """
+    hourly_profile: Relative load for each hour of the day (24 values) or week (168 values starting on Monday)
+    target_utilization: Utilization the autoscaler keeps the nodes at
+    scale_up_delay: Minutes before a new node is available
+    scale_down_delay: Minutes the load must stay lower before a node is removed
+    max_nodes: Maximum number of nodes. The minimum is the service ``min_nodes``.
+    noise: Coefficient of variation of random minute to minute changes in load
+    seed: Random seed for the noise
+    """
+    _allow_dynamic_properties = False
+    hourly_profile = jsonobject.ListProperty(float)
+    target_utilization = jsonobject.DecimalProperty(default=0.7)
+    scale_up_delay = jsonobject.IntegerProperty(default=5)
+    scale_down_delay = jsonobject.IntegerProperty(default=30)
+    max_nodes = jsonobject.IntegerProperty()
+    noise = jsonobject.DecimalProperty(default=0)
+    seed = jsonobject.IntegerProperty(default=0)
+
+
+class PriceDef(jsonobject.JsonObject):
+    """
+    Prices are per month and are either a single value or a mapping of the month
+    the price starts applying to the price e.g. {'2019-01': 300, '2020-06': 250}
+
+    on_demand: On-demand price
+    reserved: Price when reserved. Defaults to the on-demand price.
+    reserved_fraction: Fraction of the resources that are reserved. Defaults to the catalog value.
+    """
+    _allow_dynamic_properties = False
+    on_demand = jsonobject.DefaultProperty(required=True)
+    reserved = jsonobject.DefaultProperty()
+    reserved_fraction = jsonobject.DecimalProperty()
+
+
+class PriceCatalog(jsonobject.JsonObject):
+    """
+    currency: Label for the costs
+    storage_unit: Unit that storage prices are given for e.g. 0.1 per GB per month
+    reserved_fraction: Fraction of the resources that are reserved
+    vm_types: Prices per VM by VM type ('{cores_per_node}x{ram_per_node}')
+    storage_groups: Prices per storage unit by storage group
+    """
+    _allow_dynamic_properties = False
+    currency = jsonobject.StringProperty(default='USD')
+    storage_unit = jsonobject.StringProperty(default='GB', choices=['KB', 'MB', 'GB', 'TB'])
+    reserved_fraction = jsonobject.DecimalProperty(default=0)
+    vm_types = jsonobject.DictProperty(PriceDef)
+    storage_groups = jsonobject.DictProperty(PriceDef)
+
+
 class ServiceDef(jsonobject.JsonObject):
     _allow_dynamic_properties = False
     aggregation_key = jsonobject.StringProperty()
@@ -92,6 +198,7 @@ class ServiceDef(jsonobject.JsonObject):
     include_ha_resources = jsonobject.BooleanProperty(default=False)
     storage = jsonobject.ObjectProperty(StorageDef)
     process = jsonobject.ObjectProperty(ProcessDef)
+    autoscaling = jsonobject.ObjectProperty(AutoscalingDef, default=None)
 
     def validate(self, required=True):
         super(ServiceDef, self).validate(required=required)
@@ -123,15 +230,25 @@ class ClusterConfig(jsonobject.JsonObject):
     estimation_growth_factor = jsonobject.DecimalProperty(default=0)
     storage_buffer = jsonobject.DecimalProperty(required=True)
     storage_display_unit = jsonobject.StringProperty(default='GB')
+    # use smaller dtypes for the service and summary data (see ``compact_summary_data``)
+    compact_dtypes = jsonobject.BooleanProperty(default=False)
     summary_dates = jsonobject.ListProperty()
     vm_os_storage_gb = jsonobject.IntegerProperty(required=True)
     vm_os_storage_group = jsonobject.StringProperty(required=True)
+    price_catalog = jsonobject.ObjectProperty(PriceCatalog, default=None)
 
     sets_summary_date = jsonobject.StringProperty()
     sets = jsonobject.DictProperty(jsonobject.ListProperty(SetContext))
     usage = jsonobject.DictProperty(UsageModelDef)
     services = jsonobject.DictProperty(ServiceDef)
 
+    def __init__(self, _obj=None, **kwargs):
+        # services that reference set variables are kept as templates and
+        # resolved with the first set until ``config_for_set`` is used
+        _obj, service_templates = _split_service_templates(_obj)
+        super(ClusterConfig, self).__init__(_obj, **kwargs)
+        self._service_templates = service_templates
+
     def validate(self, required=True):
         super(ClusterConfig, self).validate(required=required)
         self.summary_date_vals
@@ -149,6 +266,158 @@ class ClusterConfig(jsonobject.JsonObject):
         return datetime.strptime(self.sets_summary_date, "%Y-%m") if self.sets_summary_date else None
 
 
+def _split_service_templates(config_data):
+    """:return: tuple of (config data with the service templates resolved with the first set,
+                dict of service name -> template)"""
+    services = (config_data or {}).get('services') or {}
+    templates = {name: service_def for name, service_def in services.items() if has_context(service_def)}
+    if not templates:
+        return config_data, {}
+    if not config_data.get('sets'):
+        raise ValueError('Services reference set variables but there are no sets: {}'.format(', '.join(templates)))
+    first_set = next(iter_combined_sets(config_data['sets']))
+    resolved = dict(services)
+    resolved.update(_resolve_templates(templates, first_set))
+    return dict(config_data, services=resolved), templates
+
+
+def _resolve_templates(templates, set_context):
+    try:
+        return {name: apply_context_typed(set_context, template) for name, template in templates.items()}
+    except KeyError as e:
+        raise ValueError(f"Unknown set variable {e} in services for set '{set_context['name']}'")
+
+
+def get_config_variables(config):
+    """:return: set of the set variables that the usage and services of the config reference"""
+    return get_context_variables(config._obj.get('usage') or {}) | get_context_variables(config._service_templates)
+
+
+def check_config_variables(config, names):
+    """Raise ValueError if any of the names aren't set variables that the config uses.
+    Changing them would have no effect."""
+    variables = get_config_variables(config)
+    unknown = [name for name in names if name not in variables]
+    if unknown:
+        raise ValueError('Unknown set variables: {}. The config uses: {}'.format(
+            ', '.join(unknown), ', '.join(sorted(variables)) or 'none'
+        ))
+
+
+def config_for_set(config, set_context):
+    """Config with the set variables in the services section applied.
+    Returns the same config if no services reference set variables."""
+    templates = {
+        name: template for name, template in config._service_templates.items() if name in config.services
+    }
+    if not templates:
+        return config
+    config_data = copy.deepcopy(config._obj)
+    config_data['services'].update(_resolve_templates(templates, set_context))
+    return ClusterConfig(config_data)
+
+
 def config_from_path(config_path):
+    return ClusterConfig(load_config_data(config_path))
+
+
+def load_config_data(config_path):
+    """Copy of the config data with the configs it extends merged in"""
+    config_data = _load_config_data(os.path.abspath(config_path))
+    # configs are modified in place e.g. to filter services so always return a new copy
+    return copy.deepcopy(config_data)
+
+
+def _load_config_data(config_path, extended_by=()):
+    """Config data with the configs it extends merged in"""
+    config_data = _load_yaml(config_path, os.path.getmtime(config_path))
+    return _merge_extends(config_data, config_path, _load_config_data, extended_by)
+
+
+@functools.lru_cache(maxsize=None)
+def _load_yaml(config_path, mtime):
+    # the parsed data is shared by every config that extends this one so it must not be modified
     with open(config_path, 'r') as f:
-        return ClusterConfig(yaml.safe_load(f))
+        return yaml.safe_load(f)
+
+
+def _merge_extends(config_data, config_path, load_data, extended_by):
+    """Merge the config data into the config it ``extends`` (if any).
+
+    :param load_data: function(path, extended_by) that returns the merged data of the base config
+    :param extended_by: paths of the configs that extend this one to detect cycles
+    """
+    base_path = (config_data or {}).get(EXTENDS_KEY)
+    if not base_path:
+        return config_data
+    base_path = get_base_path(config_path, base_path)
+    if base_path == config_path or base_path in extended_by:
+        raise ValueError(f'Circular "{EXTENDS_KEY}" in {config_path}: {base_path}')
+    base_data = load_data(base_path, extended_by + (config_path,))
+    overlay = {key: value for key, value in config_data.items() if key != EXTENDS_KEY}
+    return merge_config_data(base_data, overlay)
+
+
+def get_base_path(config_path, base_path):
+    """Path of the base config relative to the directory of the config that extends it"""
+    return os.path.normpath(os.path.join(os.path.dirname(config_path), base_path))
+
+
+def merge_config_data(base, overlay):
+    """Override the keys in the base config data with the values in the overlay.
+    Nested dicts (e.g. a single usage field or service) are merged key by key,
+    other values replace the base value and ``null`` removes the key.
+    New keys are added after the base keys.
+
+    Neither the base nor the overlay are modified. Values that the overlay doesn't
+    change are shared with the base.
+    """
+    merged = dict(base)
+    for key, value in overlay.items():
+        if value is None:
+            merged.pop(key, None)
+        elif isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge_config_data(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def get_config_root(config_path):
+    """Path of the config at the root of the ``extends`` chain or the config itself"""
+    config_path = os.path.abspath(config_path)
+    seen = set()
+    while config_path not in seen:
+        seen.add(config_path)
+        base_path = (_load_yaml(config_path, os.path.getmtime(config_path)) or {}).get(EXTENDS_KEY)
+        if not base_path:
+            return config_path
+        config_path = get_base_path(config_path, base_path)
+    raise ValueError(f'Circular "{EXTENDS_KEY}" in {config_path}')
+
+
+def config_from_git(config_path, revision):
+    """Load the config as it was at a git revision e.g. 'HEAD~1'.
+    Configs that it extends are also loaded from the revision."""
+    config_path = os.path.abspath(config_path)
+
+    def _load_from_git(path, extended_by=()):
+        config_string = subprocess.check_output(
+            ['git', 'show', f'{revision}:./{os.path.basename(path)}'],
+            cwd=os.path.dirname(path)
+        )
+        return _merge_extends(yaml.safe_load(config_string), path, _load_from_git, extended_by)
+
+    return ClusterConfig(_load_from_git(config_path))
+
+
+def config_to_json(config):
+    """JSON representation of the config for sending to other processes.
+    Unlike ``to_json`` this does not re-validate the config."""
+    config_data = copy.deepcopy(config._obj)
+    templates = getattr(config, '_service_templates', None)
+    if templates:
+        config_data['services'].update({
+            name: copy.deepcopy(template) for name, template in templates.items() if name in config_data['services']
+        })
+    return config_data
@@ -0,0 +1,149 @@
+"""Monthly cost of the resources in the summary data.
+
+Prices come from a price catalog (``price_catalog`` in the config or a separate
+YAML file) with prices per VM type and per unit of storage for each storage group:
+
+    currency: USD
+    storage_unit: GB
+    reserved_fraction: 0.5
+    vm_types:
+      8x32:
+        on_demand: 300
+        reserved: {'2019-01': 200, '2020-06': 180}
+    storage_groups:
+      SSD:
+        on_demand: 0.1
+
+The cost of every service and month is computed in one pass as (months x services)
+array operations.
+"""
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import yaml
+
+from core.config import PriceCatalog
+from core.utils import byte_map, tier_storage_column
+
+COMPUTE_COST = 'Compute Cost'
+STORAGE_COST = 'Storage Cost'
+TOTAL_COST = 'Total Cost'
+COST_COLUMNS = (COMPUTE_COST, STORAGE_COST, TOTAL_COST)
+MONTHLY_COST = 'Monthly Cost'
+CUMULATIVE_COST = 'Cumulative Cost'
+
+
+def catalog_from_path(path):
+    with open(path, 'r') as f:
+        return PriceCatalog(yaml.safe_load(f))
+
+
+def get_price_series(price, dates):
+    """Monthly price for each date.
+
+    :param price: single price or dict of the month the price starts applying -> price.
+                  The first price also applies before its start month.
+    """
+    if not isinstance(price, dict):
+        return pd.Series(float(price), index=dates)
+    changes = pd.Series({pd.Timestamp(str(date)): float(value) for date, value in price.items()}).sort_index()
+    return changes.reindex(changes.index.union(dates)).ffill().bfill().reindex(dates)
+
+
+def get_price_data(catalog, prices, dates):
+    """Effective monthly price of each item in ``prices`` (a dict of name -> PriceDef)
+    combining the reserved and on-demand prices.
+
+    :return: DataFrame with the dates as the index and a column for each item
+    """
+    data = OrderedDict()
+    for name, price_def in prices.items():
+        reserved_fraction = price_def.reserved_fraction
+        if reserved_fraction is None:
+            reserved_fraction = catalog.reserved_fraction
+        reserved_fraction = float(reserved_fraction)
+        on_demand = get_price_series(price_def.on_demand, dates)
+        if price_def.reserved is None or not reserved_fraction:
+            data[name] = on_demand
+        else:
+            reserved = get_price_series(price_def.reserved, dates)
+            data[name] = reserved_fraction * reserved + (1 - reserved_fraction) * on_demand
+    return pd.DataFrame(data, index=dates, columns=list(prices))
+
+
+def _get_prices(price_data, names, required, kind):
+    """(months x len(names)) array of prices for each name. Names that are not
+    in the catalog are priced at 0 unless they are required."""
+    missing = sorted({name for name, needed in zip(names, required) if needed and name not in price_data})
+    if missing:
+        raise ValueError('No price in the catalog for {}: {}'.format(kind, ', '.join(missing)))
+    return price_data.reindex(columns=names, fill_value=0).to_numpy(dtype=float)
+
+
+def get_cost_data(config, summary_data, catalog=None):
+    """Monthly cost of each service.
+
+    Compute cost is the number of VMs (including HA VMs) times the price of the VM type
+    plus the OS storage of the VMs times the price of the ``vm_os_storage_group``.
+    Storage cost is the data storage times the price of the service's storage group
+    plus the storage of each lifecycle tier times the price of the tier's storage group.
+
+    :param summary_data: output of ``get_summary_data``
+    :param catalog: PriceCatalog. Defaults to ``config.price_catalog``.
+    :return: DataFrame with a (service, cost) column for each of ``COST_COLUMNS``
+    """
+    catalog = catalog or config.price_catalog
+    if catalog is None:
+        raise ValueError('No price catalog')
+
+    services = list(config.services)
+    dates = summary_data.index
+    storage_column = 'Data Storage Total (%s)' % config.storage_display_unit
+    bytes_per_price_unit = byte_map[catalog.storage_unit]
+
+    def _values(column):
+        return np.column_stack([
+            summary_data[(service_name, column)].to_numpy(dtype=float) for service_name in services
+        ])
+
+    # months x services
+    vms = _values('VMs Total')
+    data_storage = _values(storage_column) * (byte_map[config.storage_display_unit] / bytes_per_price_unit)
+    os_storage = _values('OS Storage Total (Bytes)') / bytes_per_price_unit
+
+    vm_types = [summary_data[(service_name, 'VM Type')].iloc[0] for service_name in services]
+    storage_groups = [config.services[service_name].storage.group for service_name in services]
+    vm_prices = _get_prices(
+        get_price_data(catalog, catalog.vm_types, dates), vm_types, vms.any(axis=0), 'VM types'
+    )
+    storage_price_data = get_price_data(catalog, catalog.storage_groups, dates)
+    storage_prices = _get_prices(storage_price_data, storage_groups, data_storage.any(axis=0), 'storage groups')
+    os_storage_prices = _get_prices(
+        storage_price_data, [config.vm_os_storage_group], [os_storage.any()], 'storage groups'
+    )
+
+    compute_cost = vms * vm_prices + os_storage * os_storage_prices
+    storage_cost = data_storage * storage_prices
+    for i, service_name in enumerate(services):
+        for group in config.services[service_name].storage.tier_groups:
+            tier_storage = summary_data[(service_name, tier_storage_column(group, config.storage_display_unit))]
+            tier_storage = tier_storage.to_numpy(dtype=float) * (byte_map[config.storage_display_unit] / bytes_per_price_unit)
+            tier_prices = _get_prices(storage_price_data, [group], [tier_storage.any()], 'storage groups')
+            storage_cost[:, i] += tier_storage * tier_prices[:, 0]
+    # months x services x costs
+    costs = np.stack([compute_cost, storage_cost, compute_cost + storage_cost], axis=2)
+    columns = pd.MultiIndex.from_product([services, COST_COLUMNS])
+    return pd.DataFrame(costs.reshape(len(dates), -1), index=dates, columns=columns)
+
+
+def summarize_costs(cost_data, summary_date):
+    """Monthly and cumulative cost of each service at a date with a total row.
+
+    :param cost_data: output of ``get_cost_data``
+    """
+    summary = cost_data.loc[summary_date].unstack()[list(COST_COLUMNS)]
+    summary = summary.rename(columns={TOTAL_COST: MONTHLY_COST})
+    summary[CUMULATIVE_COST] = cost_data.loc[:summary_date].xs(TOTAL_COST, axis=1, level=1).sum()
+    summary.loc['Total'] = summary.sum()
+    return summary
@@ -0,0 +1,168 @@
+"""Monthly summary data for every set stored as a labeled 4D array
+(set x month x service x metric).
+
+The values are stored in a ``.npy`` file which is memory mapped when loaded
+so slices can be read without loading the whole cube. The labels for each
+axis are stored alongside in a ``.json`` file.
+
+    cube = SummaryCube.load('sweep')
+    cube.sel(metric='VMs Total', service='pg_shards', period='2020-Q2').to_frame()
+"""
+import json
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from core.summarize import LABEL_COLUMNS
+
+AXES = ('set', 'month', 'service', 'metric')
+
+
+def _cube_paths(path):
+    return f'{path}.npy', f'{path}.json'
+
+
+def get_summary_metrics(summary_data):
+    return [
+        column for column in OrderedDict.fromkeys(summary_data.columns.get_level_values(1))
+        if column not in LABEL_COLUMNS
+    ]
+
+
+class CubeWriter(object):
+    """Write the summary data of each set into a cube file as it is computed.
+
+    The axes labels for months, services and metrics are taken from the first set.
+    The data of the other sets is aligned to these labels: values for months, services
+    or metrics that a set doesn't have are NaN and any others are dropped.
+    """
+    def __init__(self, path, set_count):
+        self.path = path
+        self.set_count = set_count
+        self.data = None
+        self.labels = None
+
+    def write(self, set_name, summary_data):
+        if self.data is None:
+            self._create(summary_data)
+        set_index = len(self.labels['set'])
+        if set_index >= self.set_count:
+            raise IndexError(f'Cube only has space for {self.set_count} sets')
+
+        services, metrics = self.labels['service'], self.labels['metric']
+        columns = pd.MultiIndex.from_product([services, metrics])
+        months = pd.DatetimeIndex(self.labels['month'])
+        values = summary_data.reindex(index=months, columns=columns).astype(np.float64).to_numpy()
+        self.data[set_index] = values.reshape(len(months), len(services), len(metrics))
+        self.labels['set'].append(set_name)
+
+    def _create(self, summary_data):
+        services = list(OrderedDict.fromkeys(summary_data.columns.get_level_values(0)))
+        self.labels = OrderedDict([
+            ('set', []),
+            ('month', [date.strftime('%Y-%m-%d') for date in summary_data.index]),
+            ('service', services),
+            ('metric', get_summary_metrics(summary_data)),
+        ])
+        shape = (self.set_count, len(summary_data.index), len(services), len(self.labels['metric']))
+        data_path, _ = _cube_paths(self.path)
+        self.data = np.lib.format.open_memmap(data_path, mode='w+', dtype=np.float64, shape=shape)
+
+    def close(self):
+        if self.data is None:
+            return
+        self.data.flush()
+        self.data = None
+        data_path, labels_path = _cube_paths(self.path)
+        with open(labels_path, 'w') as f:
+            json.dump({'labels': self.labels}, f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class SummaryCube(object):
+    def __init__(self, data, labels):
+        """
+        :param data: 4D array (set x month x service x metric)
+        :param labels: dict of axis name -> list of labels
+        """
+        self.data = data
+        self.labels = OrderedDict((axis, list(labels[axis])) for axis in AXES)
+
+    @classmethod
+    def load(cls, path):
+        data_path, labels_path = _cube_paths(path)
+        with open(labels_path, 'r') as f:
+            metadata = json.load(f)
+        data = np.load(data_path, mmap_mode='r')
+        # the cube may have been allocated for more sets than were written
+        return cls(data[:len(metadata['labels']['set'])], metadata['labels'])
+
+    @property
+    def months(self):
+        return pd.DatetimeIndex(self.labels['month'])
+
+    def sel(self, set=None, service=None, metric=None, start=None, end=None, period=None):
+        """Select a subset of the cube. Each of ``set``, ``service`` and ``metric`` may be
+        a single label or a list of labels.
+
+        :param start: First month to include e.g. '2020-01'
+        :param end: Last month to include e.g. '2020-06'
+        :param period: Period to include e.g. '2020', '2020-Q2' or '2020-06'
+        :return: SummaryCube
+        """
+        months = self.months
+        month_mask = np.ones(len(months), dtype=bool)
+        if period is not None:
+            period = pd.Period(period)
+            month_mask &= (months >= period.start_time) & (months <= period.end_time)
+        if start is not None:
+            month_mask &= months >= pd.Timestamp(start)
+        if end is not None:
+            month_mask &= months <= pd.Timestamp(end)
+
+        indexers = [
+            self._indexer('set', set),
+            np.flatnonzero(month_mask),
+            self._indexer('service', service),
+            self._indexer('metric', metric),
+        ]
+        data = self.data[np.ix_(*indexers)]
+        labels = {
+            axis: [self.labels[axis][i] for i in indexer]
+            for axis, indexer in zip(AXES, indexers)
+        }
+        return SummaryCube(data, labels)
+
+    def _indexer(self, axis, selection):
+        labels = self.labels[axis]
+        if selection is None:
+            return np.arange(len(labels))
+        if isinstance(selection, str):
+            selection = [selection]
+        missing = [label for label in selection if label not in labels]
+        if missing:
+            raise KeyError(f"Unknown {axis}: {', '.join(missing)}")
+        return np.array([labels.index(label) for label in selection], dtype=int)
+
+    def to_frame(self):
+        """DataFrame indexed by month with a column for each combination of
+        set, service and metric. Axes with only one label are dropped from the columns."""
+        sets, months, services, metrics = self.data.shape
+        frame = pd.DataFrame(
+            np.asarray(self.data).transpose(1, 0, 2, 3).reshape(months, sets * services * metrics),
+            index=self.months,
+            columns=pd.MultiIndex.from_product(
+                [self.labels['set'], self.labels['service'], self.labels['metric']],
+                names=['set', 'service', 'metric']
+            )
+        )
+        for level in ['set', 'service', 'metric']:
+            if frame.columns.nlevels > 1 and len(self.labels[level]) == 1:
+                frame.columns = frame.columns.droplevel(level)
+        return frame
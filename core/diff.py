@@ -0,0 +1,216 @@
+"""Compare the results of two configs (or one config at two git revisions).
+
+Usage fields and services that are the same in both configs are only
+computed once. Changed cells are traced back to the config keys that
+caused them by following the usage dependency graph to the services.
+"""
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+import pandas as pd
+
+from core.config import config_for_set, config_to_json
+from core.cube import LABEL_COLUMNS
+from core.generate import compute_service, generate_usage_data, get_service_usage_fields
+from core.models import models_by_slug
+from core.summarize import get_estimation_buffer
+
+ConfigDiff = namedtuple('ConfigDiff', 'changed_keys causes cells')
+
+# top level config keys that only change which dates are output
+OUTPUT_KEYS = ('sets_summary_date', 'summary_dates')
+
+
+def flatten_config(data, prefix=()):
+    """Flatten nested config data into a dict of key path tuple -> value.
+    Empty lists and dicts are left out."""
+    flat = OrderedDict()
+    if isinstance(data, dict):
+        for key, value in data.items():
+            flat.update(flatten_config(value, prefix + (str(key),)))
+    elif isinstance(data, list):
+        for i, value in enumerate(data):
+            flat.update(flatten_config(value, prefix + (str(i),)))
+    else:
+        flat[prefix] = data
+    return flat
+
+
+def get_changed_keys(config_a, config_b):
+    """:return: list of key path tuples that were added, removed or changed.
+                List indexes are dropped from the paths e.g. ('usage', 'users', 'ranges')
+                and sections only in one config are reported once e.g. ('services', 'new_service')"""
+    flat_a = flatten_config(config_to_json(config_a))
+    flat_b = flatten_config(config_to_json(config_b))
+    prefixes_a = {key[:i] for key in flat_a for i in range(len(key) + 1)}
+    prefixes_b = {key[:i] for key in flat_b for i in range(len(key) + 1)}
+
+    def _missing_prefix(key, other_prefixes):
+        for i in range(1, len(key) + 1):
+            if key[:i] not in other_prefixes:
+                return key[:i]
+        return key
+
+    changed = OrderedDict()
+    for key in list(flat_a) + [key for key in flat_b if key not in flat_a]:
+        if key not in flat_b:
+            key = _missing_prefix(key, prefixes_b)
+        elif key not in flat_a:
+            key = _missing_prefix(key, prefixes_a)
+        elif flat_a[key] == flat_b[key]:
+            continue
+        changed[tuple(part for part in key if not part.isdigit())] = None
+    return list(changed)
+
+
+def get_usage_dependants(config, set_context):
+    """:return: dict of usage field -> set of usage fields computed from it (directly or indirectly)"""
+    model_classes = models_by_slug()
+    dependencies = {
+        name: set(model_classes[model_def.model](set_context, name, **model_def.model_params).dependant_fields)
+        for name, model_def in config.usage.items()
+    }
+    dependants = {name: set() for name in dependencies}
+    changed = True
+    while changed:
+        changed = False
+        for name, fields in dependencies.items():
+            for field in fields:
+                downstream = {name} | dependants[name]
+                if not downstream <= dependants.setdefault(field, set()):
+                    dependants[field] |= downstream
+                    changed = True
+    return dependants
+
+
+def trace_changes(changed_keys, configs_and_contexts):
+    """Map each service to the changed config keys that affect it.
+
+    :param changed_keys: output of ``get_changed_keys``
+    :param configs_and_contexts: list of (config, set_context) for both sides of the diff
+    :return: OrderedDict of service name -> list of key path tuples
+    """
+    dependants = {}
+    service_fields = {}
+    for config, set_context in configs_and_contexts:
+        for field, downstream in get_usage_dependants(config, set_context).items():
+            dependants.setdefault(field, set()).update(downstream)
+        for service_name, service_def in config.services.items():
+            service_fields.setdefault(service_name, set()).update(get_service_usage_fields(service_def))
+
+    def _services_using(fields):
+        for field in list(fields):
+            fields |= dependants.get(field, set())
+        return [name for name, used in service_fields.items() if used & fields]
+
+    causes = OrderedDict((service_name, []) for service_name in service_fields)
+    for key in changed_keys:
+        section = key[0]
+        if section in OUTPUT_KEYS:
+            affected = []
+        elif section == 'services' and len(key) > 1:
+            affected = [key[1]]
+        elif section == 'usage' and len(key) > 1:
+            affected = _services_using({key[1]})
+        elif section == 'sets':
+            # set variables affect the usage fields that reference them
+            variables = {key[2]} if len(key) > 2 else {
+                variable for config, _ in configs_and_contexts
+                for group, set_items in config_to_json(config)['sets'].items() if group in key[1:2] or len(key) == 1
+                for set_item in set_items
+                for variable in set_item if variable != 'name'
+            }
+            affected = _services_using({
+                name for config, _ in configs_and_contexts
+                for name, model_def in config.usage.items()
+                if any('{%s}' % variable in repr(model_def.model_params) for variable in variables)
+            })
+        else:
+            affected = list(causes)
+        for service_name in affected:
+            causes.setdefault(service_name, []).append(key)
+    return causes
+
+
+def _compute_summaries(config, usage, cache):
+    """Compute the service and summary data for each service.
+
+    :param cache: service cache shared by both configs (see ``compute_service``). Services
+                  whose definition and usage inputs are unchanged are reused from the other config.
+    :return: tuple of (service data, summary data) as dicts keyed by service name
+    """
+    estimation_buffer = get_estimation_buffer(config, usage.index)
+    service_data = OrderedDict()
+    summary_data = OrderedDict()
+    for service_name, service_def in config.services.items():
+        service_data[service_name], summary_data[service_name] = compute_service(
+            config, service_name, service_def, usage, estimation_buffer, cache
+        )
+    return service_data, summary_data
+
+
+def _numeric_frame(frames):
+    frame = pd.concat(list(frames.values()), axis=1, keys=list(frames))
+    if frame.columns.nlevels > 2:
+        # flatten service data columns e.g. ('Compute', 'VMs') -> 'Compute: VMs'
+        frame.columns = pd.MultiIndex.from_tuples([
+            (column[0], ': '.join(str(level) for level in column[1:])) for column in frame.columns
+        ])
+    frame = frame.loc[:, ~frame.columns.get_level_values(1).isin(LABEL_COLUMNS)]
+    return frame.astype(np.float64)
+
+
+def compare_frames(frame_a, frame_b, rtol=0.01, atol=0):
+    """Cells that differ by more than the tolerance.
+
+    :return: DataFrame indexed by (service, metric, date) with columns 'Before', 'After' and 'Change'
+    """
+    columns = frame_a.columns.append(frame_b.columns.difference(frame_a.columns, sort=False))
+    index = frame_a.index.union(frame_b.index)
+    before = frame_a.reindex(index=index, columns=columns).to_numpy()
+    after = frame_b.reindex(index=index, columns=columns).to_numpy()
+
+    same = np.isclose(after, before, rtol=rtol, atol=atol) | (np.isnan(before) & np.isnan(after))
+    rows, cols = np.nonzero(~same)
+    # order by service and metric then date
+    order = np.lexsort((rows, cols))
+    rows, cols = rows[order], cols[order]
+    cells = pd.DataFrame(OrderedDict([
+        ('Before', before[rows, cols]),
+        ('After', after[rows, cols]),
+        ('Change', after[rows, cols] - before[rows, cols]),
+    ]), index=pd.MultiIndex.from_arrays([
+        columns.get_level_values(0)[cols],
+        columns.get_level_values(1)[cols],
+        index[rows],
+    ], names=['service', 'metric', 'date']))
+    return cells
+
+
+def diff_configs(config_a, set_context_a, config_b, set_context_b, rtol=0.01, atol=0):
+    """Compare the results of two configs.
+
+    :return: ConfigDiff of
+             changed_keys: list of changed config key path tuples
+             causes: dict of service -> changed keys affecting it
+             cells: DataFrame indexed by (frame, service, metric, date) of changed cells
+    """
+    config_a = config_for_set(config_a, set_context_a)
+    config_b = config_for_set(config_b, set_context_b)
+    changed_keys = get_changed_keys(config_a, config_b)
+
+    usage_cache = {}
+    usage_a = generate_usage_data(config_a, set_context_a, cache=usage_cache)
+    usage_b = generate_usage_data(config_b, set_context_b, cache=usage_cache)
+
+    service_cache = {}
+    service_data_a, summary_a = _compute_summaries(config_a, usage_a, service_cache)
+    service_data_b, summary_b = _compute_summaries(config_b, usage_b, service_cache)
+
+    cells = pd.concat([
+        compare_frames(_numeric_frame(summary_a), _numeric_frame(summary_b), rtol, atol),
+        compare_frames(_numeric_frame(service_data_a), _numeric_frame(service_data_b), rtol, atol),
+    ], keys=['Summary', 'Service Data'], names=['frame'])
+
+    causes = trace_changes(changed_keys, [(config_a, set_context_a), (config_b, set_context_b)])
+    return ConfigDiff(changed_keys, causes, cells)
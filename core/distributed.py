@@ -0,0 +1,212 @@
+"""Run set sweeps across multiple hosts.
+
+The coordinator listens on a TCP address and hands out shards of set
+contexts to any number of workers. Each worker computes the summary
+snapshot for every set in its shard and sends it back. Shards from workers
+that fail or disconnect are put back on the queue and retried.
+
+Messages are exchanged with ``multiprocessing.connection`` which frames
+and pickles them and authenticates both ends with a shared key. Since the
+messages are unpickled the key must be kept secret: anyone with the key can
+run code on the coordinator and the workers.
+"""
+import logging
+import queue
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from multiprocessing.connection import Client, Listener, answer_challenge, deliver_challenge
+
+from core.config import ClusterConfig, config_for_set, config_to_json
+from core.generate import generate_usage_data, generate_service_data
+from core.summarize import get_summary_data, summarize_service_data, get_summary_dates
+
+logger = logging.getLogger(__name__)
+
+class ShardFailed(Exception):
+    pass
+
+
+def parse_address(address):
+    host, port = address.rsplit(':', 1)
+    return host or 'localhost', int(port)
+
+
+def get_set_snapshot(config, set_context):
+    """Compute the summary of a single set at the sets summary date"""
+    config = config_for_set(config, set_context)
+    usage = generate_usage_data(config, set_context)
+    service_data = generate_service_data(config, usage)
+    summary_date = config.sets_summary_date_val or get_summary_dates(config, usage)[-1]
+    summary_data = get_summary_data(config, service_data)
+    return summarize_service_data(config, summary_data, summary_date)
+
+
+def run_worker(address, authkey, connect_timeout=30):
+    """Connect to a coordinator and process shards until told to stop.
+
+    :return: number of shards processed
+    """
+    deadline = time.time() + connect_timeout
+    while True:
+        try:
+            conn = Client(address, authkey=authkey)
+            break
+        except ConnectionRefusedError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.2)
+
+    processed = 0
+    with conn:
+        config = None
+        while True:
+            try:
+                message = conn.recv()
+            except EOFError:
+                break
+            kind = message[0]
+            if kind == 'config':
+                config = ClusterConfig(message[1])
+            elif kind == 'shard':
+                shard_id, set_contexts = message[1:]
+                try:
+                    results = [
+                        (set_context['name'], get_set_snapshot(config, set_context))
+                        for set_context in set_contexts
+                    ]
+                except Exception:
+                    conn.send(('error', shard_id, traceback.format_exc()))
+                else:
+                    conn.send(('result', shard_id, results))
+                processed += 1
+            elif kind == 'stop':
+                break
+    return processed
+
+
+class Coordinator(object):
+    """Distribute set contexts across workers and collect their snapshots.
+
+    :param config: ClusterConfig to send to the workers
+    :param set_contexts: iterable of set contexts
+    :param shard_size: number of sets sent to a worker at a time
+    :param max_retries: number of times a shard is retried before giving up
+    """
+    def __init__(self, config, set_contexts, address, authkey, shard_size=1, max_retries=3):
+        self.config_json = config_to_json(config)
+        self.set_contexts = list(set_contexts)
+        self.shard_size = shard_size
+        self.max_retries = max_retries
+        self.authkey = authkey
+        # connections are authenticated in their own thread so that a client that
+        # fails or stalls the handshake doesn't stop other workers from connecting
+        self.listener = Listener(address)
+        self.closed = False
+
+        self.shards = [
+            self.set_contexts[i:i + shard_size]
+            for i in range(0, len(self.set_contexts), shard_size)
+        ]
+        self.pending = queue.Queue()
+        for shard_id in range(len(self.shards)):
+            self.pending.put(shard_id)
+        self.attempts = [0] * len(self.shards)
+        self.results = {}
+        self.failure = None
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+
+    @property
+    def address(self):
+        return self.listener.address
+
+    def run(self, timeout=None):
+        """Serve workers until all the shards are complete.
+
+        :return: OrderedDict of set name to ServiceSummary in set order
+        """
+        if not self.shards:
+            self.listener.close()
+            return OrderedDict()
+
+        accept_thread = threading.Thread(target=self._accept, daemon=True)
+        accept_thread.start()
+        finished = self.done.wait(timeout)
+        self.closed = True
+        self.listener.close()
+        if self.failure:
+            raise ShardFailed(self.failure)
+        if not finished:
+            raise TimeoutError(f'{len(self.shards) - len(self.results)} shards incomplete')
+
+        snapshots = OrderedDict()
+        for shard_id in range(len(self.shards)):
+            for name, snapshot in self.results[shard_id]:
+                snapshots[name] = snapshot
+        return snapshots
+
+    def _accept(self):
+        while not self.done.is_set():
+            try:
+                conn = self.listener.accept()
+            except Exception:
+                if self.closed:
+                    return
+                logger.warning('Failed to accept connection', exc_info=True)
+                continue
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        with conn:
+            try:
+                deliver_challenge(conn, self.authkey)
+                answer_challenge(conn, self.authkey)
+            except Exception as e:
+                # e.g. a port scan or a worker with the wrong key
+                logger.warning('Rejected connection: %s', e or type(e).__name__)
+                return
+            try:
+                conn.send(('config', self.config_json))
+            except OSError:
+                return
+            while not self.done.is_set():
+                try:
+                    shard_id = self.pending.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+
+                try:
+                    conn.send(('shard', shard_id, self.shards[shard_id]))
+                    kind, _, payload = conn.recv()
+                except (EOFError, OSError):
+                    self._retry(shard_id, 'worker disconnected')
+                    return
+
+                if kind == 'result':
+                    self._complete(shard_id, payload)
+                else:
+                    self._retry(shard_id, payload)
+
+            try:
+                conn.send(('stop',))
+            except OSError:
+                pass
+
+    def _complete(self, shard_id, results):
+        with self.lock:
+            self.results[shard_id] = results
+            if len(self.results) == len(self.shards):
+                self.done.set()
+
+    def _retry(self, shard_id, reason):
+        with self.lock:
+            self.attempts[shard_id] += 1
+            names = ', '.join(s['name'] for s in self.shards[shard_id])
+            if self.attempts[shard_id] > self.max_retries:
+                self.failure = f'Shard {shard_id} ({names}) failed after {self.max_retries} retries:\n{reason}'
+                self.done.set()
+                return
+            logger.warning('Retrying shard %s (%s): %s', shard_id, names, reason)
+        self.pending.put(shard_id)
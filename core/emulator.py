@@ -0,0 +1,251 @@
+"""Surrogate model (emulator) of the headline metrics for interactive what-if answers.
+
+The parameter space of continuous set variables (e.g. users, forms per user) is
+sampled with a Latin hypercube and each sample is run through the full model.
+A polynomial in the scaled parameters is then fitted to each headline metric by
+least squares. Some of the samples are held out of the fit and the error of the
+emulator on those samples is saved with it so that predictions come with an
+error bound.
+
+    emulator = Emulator.load('emulator.json')
+    emulator.predict(users=50000, forms_per_user=12)
+"""
+import itertools
+import json
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from core.config import ClusterConfig, check_config_variables, config_for_set, config_to_json
+from core.cost import CUMULATIVE_COST, MONTHLY_COST
+from core.generate import generate_usage_data, get_service_and_summary_data
+from core.summarize import summarize_service_data
+
+ParameterRange = namedtuple('ParameterRange', 'name low high')
+
+
+def parse_parameter_range(value):
+    """Parse ``name=low:high`` e.g. ``users=1000:50000``"""
+    try:
+        name, bounds = value.split('=')
+        low, high = (float(bound) for bound in bounds.split(':'))
+    except ValueError:
+        raise ValueError(f'Invalid parameter range "{value}". Expected name=low:high')
+    if not low < high:
+        raise ValueError(f'Invalid parameter range "{value}". The low value must be less than the high value.')
+    return ParameterRange(name, low, high)
+
+
+def latin_hypercube(samples, dimensions, seed=0):
+    """Latin hypercube sample of the unit cube: each dimension has exactly one
+    sample in each of ``samples`` equal intervals.
+
+    :return: array of shape (samples, dimensions)
+    """
+    rng = np.random.default_rng(seed)
+    offsets = rng.random((samples, dimensions))
+    strata = np.column_stack([rng.permutation(samples) for _ in range(dimensions)])
+    return (strata + offsets) / samples
+
+
+def get_headline_metrics(config, summary):
+    """Totals shown in the summary comparison: compute resources, storage by group and cost
+
+    :param summary: output of ``summarize_service_data``
+    """
+    total = summary.service_summary.loc['Total']
+    metrics = OrderedDict([
+        ('Cores', total['Cores Total']),
+        ('RAM (GB)', total['RAM Total (GB)']),
+        ('VMs', total['VMs Total']),
+    ])
+    for group, storage in summary.storage_by_group.iloc[:, 0].items():
+        metrics[f'Storage {group} ({config.storage_display_unit})'] = storage
+    if summary.cost is not None:
+        metrics[MONTHLY_COST] = summary.cost.loc['Total', MONTHLY_COST]
+        metrics[CUMULATIVE_COST] = summary.cost.loc['Total', CUMULATIVE_COST]
+    return OrderedDict((name, float(value)) for name, value in metrics.items())
+
+
+_worker_state = {}
+
+
+def _init_worker(config_json, set_context, date):
+    _worker_state.update({
+        'config': ClusterConfig(config_json),
+        'set_context': set_context,
+        'date': date,
+        'cache': {},
+    })
+
+
+def _evaluate(values):
+    state = _worker_state
+    set_context = dict(state['set_context'], **values)
+    config = config_for_set(state['config'], set_context)
+    usage = generate_usage_data(config, set_context, state['cache'])
+    _, summary_data = get_service_and_summary_data(config, usage)
+    date = state['date'] or config.sets_summary_date_val or usage.index[-1]
+    return get_headline_metrics(config, summarize_service_data(config, summary_data, pd.Timestamp(date)))
+
+
+def run_samples(config, set_context, parameters, samples, date=None, jobs=1):
+    """Run the model for each sample.
+
+    :param parameters: list of ``ParameterRange``
+    :param samples: array of parameter values with a column for each parameter
+    :return: DataFrame of the headline metrics with a row for each sample
+    """
+    values = [
+        OrderedDict(
+            (parameter.name, int(value) if _is_integer(parameter) else value)
+            for parameter, value in zip(parameters, sample.tolist())
+        )
+        for sample in samples
+    ]
+    if jobs > 1:
+        with ProcessPoolExecutor(
+            max_workers=jobs, initializer=_init_worker, initargs=(config_to_json(config), set_context, date)
+        ) as executor:
+            metrics = list(executor.map(_evaluate, values))
+    else:
+        _init_worker(config_to_json(config), set_context, date)
+        metrics = [_evaluate(sample_values) for sample_values in values]
+    # metrics that are missing for some samples e.g. an empty storage group are 0
+    return pd.DataFrame(metrics).fillna(0)
+
+
+def _is_integer(parameter):
+    return float(parameter.low).is_integer() and float(parameter.high).is_integer()
+
+
+def polynomial_exponents(dimensions, degree):
+    """Exponents of each term of a polynomial with total degree up to ``degree``"""
+    return np.array([
+        exponents for exponents in itertools.product(range(degree + 1), repeat=dimensions)
+        if sum(exponents) <= degree
+    ])
+
+
+class Emulator(object):
+    """Polynomial surrogate of the headline metrics.
+
+    :param parameters: list of ``ParameterRange``
+    :param metrics: names of the metrics
+    :param exponents: (terms x parameters) exponents of the polynomial terms
+    :param coefficients: (terms x metrics) coefficients of the polynomial terms
+    :param errors: DataFrame of the held-out errors of each metric
+    """
+    def __init__(self, parameters, metrics, exponents, coefficients, errors=None):
+        self.parameters = parameters
+        self.metrics = list(metrics)
+        self.exponents = np.asarray(exponents)
+        self.coefficients = np.asarray(coefficients, dtype=float)
+        self.errors = errors
+        self._low = np.array([parameter.low for parameter in parameters])
+        self._scale = np.array([parameter.high - parameter.low for parameter in parameters])
+
+    def _features(self, samples):
+        scaled = (np.atleast_2d(samples) - self._low) / self._scale
+        return np.prod(scaled[:, np.newaxis, :] ** self.exponents, axis=2)
+
+    @classmethod
+    def fit(cls, parameters, samples, metrics, degree=2):
+        """Least squares fit of the metrics of each sample
+
+        :param samples: (samples x parameters) array of parameter values
+        :param metrics: DataFrame with a row of metrics for each sample
+        """
+        exponents = polynomial_exponents(len(parameters), degree)
+        emulator = cls(parameters, metrics.columns, exponents, np.zeros((len(exponents), len(metrics.columns))))
+        emulator.coefficients, _, _, _ = np.linalg.lstsq(
+            emulator._features(samples), metrics.to_numpy(dtype=float), rcond=None
+        )
+        return emulator
+
+    def predict_samples(self, samples):
+        """:return: (samples x metrics) array of predictions"""
+        return self._features(samples) @ self.coefficients
+
+    def predict(self, **values):
+        """Predicted metrics for a single set of parameter values. Values outside
+        the fitted ranges are extrapolated and are not covered by the error bound."""
+        sample = [values[parameter.name] for parameter in self.parameters]
+        return OrderedDict(zip(self.metrics, self.predict_samples(sample)[0].tolist()))
+
+    def get_errors(self, samples, metrics):
+        """Errors of the predictions for samples with known metrics
+
+        :return: DataFrame of the max absolute error, RMS error and max error relative to
+                 the range of each metric
+        """
+        actual = metrics[self.metrics].to_numpy(dtype=float)
+        errors = np.abs(self.predict_samples(samples) - actual)
+        value_range = actual.max(axis=0) - actual.min(axis=0)
+        return pd.DataFrame(OrderedDict([
+            ('Max Error', errors.max(axis=0)),
+            ('RMS Error', np.sqrt((errors ** 2).mean(axis=0))),
+            ('Max Relative Error', errors.max(axis=0) / np.where(value_range > 0, value_range, 1)),
+        ]), index=self.metrics)
+
+    def to_json(self):
+        return OrderedDict([
+            ('parameters', [parameter._asdict() for parameter in self.parameters]),
+            ('metrics', self.metrics),
+            ('exponents', self.exponents.tolist()),
+            ('coefficients', self.coefficients.tolist()),
+            ('errors', self.errors.to_dict(orient='index') if self.errors is not None else None),
+        ])
+
+    @classmethod
+    def from_json(cls, data):
+        errors = pd.DataFrame.from_dict(data['errors'], orient='index') if data.get('errors') else None
+        return cls(
+            [ParameterRange(**parameter) for parameter in data['parameters']],
+            data['metrics'], data['exponents'], data['coefficients'], errors
+        )
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_json(), f, indent=2)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as f:
+            return cls.from_json(json.load(f))
+
+
+def fit_emulator(config, set_context, parameters, samples=64, holdout=0.25, degree=2, date=None, jobs=1, seed=0):
+    """Sample the parameter space, run the model and fit an emulator.
+
+    :param parameters: list of ``ParameterRange``. Integer bounds give integer values.
+    :param samples: total number of model runs including the held-out runs
+    :param holdout: fraction of the runs used to measure the error instead of fitting
+    :return: Emulator with the held-out errors
+    """
+    check_config_variables(config, [parameter.name for parameter in parameters])
+    holdout_count = int(round(samples * holdout))
+    fit_count = samples - holdout_count
+    term_count = len(polynomial_exponents(len(parameters), degree))
+    if fit_count < term_count:
+        raise ValueError(f'At least {term_count + holdout_count} samples are needed for a degree {degree} fit')
+
+    # the fit and held-out samples are independent hypercubes so both cover the whole space
+    unit_samples = np.vstack([
+        latin_hypercube(fit_count, len(parameters), seed),
+        latin_hypercube(holdout_count, len(parameters), seed + 1),
+    ])
+    low = np.array([parameter.low for parameter in parameters])
+    high = np.array([parameter.high for parameter in parameters])
+    values = low + unit_samples * (high - low)
+    for i, parameter in enumerate(parameters):
+        if _is_integer(parameter):
+            values[:, i] = np.round(values[:, i])
+
+    metrics = run_samples(config, set_context, parameters, values, date, jobs)
+    emulator = Emulator.fit(parameters, values[:fit_count], metrics.iloc[:fit_count], degree)
+    if holdout_count:
+        emulator.errors = emulator.get_errors(values[fit_count:], metrics.iloc[fit_count:])
+    return emulator
@@ -1,43 +1,168 @@
+import hashlib
+from collections import OrderedDict
+
 import numpy as np
 import pandas as pd
 
+from core.config import config_to_json
 from core.models import models_by_slug
-from core.utils import byte_map
+from core.queueing import SECONDS_PER_MONTH, required_servers
+from core.summarize import compact_service_data, get_estimation_buffer, get_service_summary_data
+from core.utils import byte_map, apply_context_recursive, tier_storage_field
 
 
-def generate_usage_data(config, set_context):
+def generate_usage_data(config, set_context, cache=None, fields=None):
+    """
+    :param cache: Optional dict used to share computed usage fields between calls.
+                  Fields whose model parameters and inputs are the same in each call
+                  (e.g. fields that don't depend on the set) are only computed once.
+    :param fields: Optional list of fields to compute. Only these fields and the fields they
+                   depend on are computed. Date range fields are always included since they
+                   determine the date index.
+    """
     model_classes = models_by_slug()
 
     models = [
-        model_classes[model_def.model](set_context, name, **model_def.model_params)
+        (model_classes[model_def.model](set_context, name, **model_def.model_params), model_def)
         for name, model_def in config.usage.items()
     ]
+    if fields is not None:
+        models = _get_required_models(models, fields)
     usage_df = pd.DataFrame()
+    field_keys = {}
     while models:
         models_len = len(models)
-        for model in models:
+        for model, model_def in models:
             if model.can_run(usage_df):
-                models.remove(model)
-                usage_df = pd.concat([usage_df, model.data_frame(usage_df)], axis=1)
+                models.remove((model, model_def))
+                if cache is None:
+                    model_df = model.data_frame(usage_df)
+                else:
+                    key = _usage_cache_key(model, model_def, set_context, usage_df, field_keys)
+                    model_df = cache.get(key)
+                    if model_df is None:
+                        model_df = cache[key] = model.data_frame(usage_df)
+                    field_keys.update({column: key for column in model_df.columns})
+                usage_df = pd.concat([usage_df, model_df], axis=1)
         if len(models) == models_len:
             # no models could run which means we're stuck
-            models_remaining = [model.name for model in models]
+            models_remaining = [model.name for model, model_def in models]
             raise Exception('Unmet dependencies for models: %s' % ', '.join(models_remaining))
 
     return usage_df
 
 
+def _get_required_models(models, fields):
+    producers = {field: model for model, model_def in models for field in model.output_fields}
+    required = set()
+    pending = list(fields) + [model.name for model, model_def in models if not model.dependant_fields]
+    while pending:
+        model = producers.get(pending.pop())
+        if model is not None and model.name not in required:
+            required.add(model.name)
+            pending.extend(model.dependant_fields)
+    return [(model, model_def) for model, model_def in models if model.name in required]
+
+
+def _usage_cache_key(model, model_def, set_context, usage_df, field_keys):
+    return (
+        model.name,
+        model.slug,
+        repr(apply_context_recursive(set_context, model_def.model_params)),
+        tuple(usage_df.index),
+        tuple(field_keys[field] for field in model.dependant_fields),
+    )
+
+
 def generate_service_data(config, usage_data):
-    dfs = []
-    users = usage_data['users']
-    for service_name, service_def in config.services.items():
-        data_storage = _service_storage_data(config, service_def, usage_data)
-        compute = ComputeModel(service_name, service_def).data_frame(usage_data, data_storage)
-        data = pd.concat([users, compute, data_storage], keys=['Users', 'Compute', 'Data Storage'], axis=1)
-        dfs.append(data)
+    dfs = [
+        get_service_data(config, service_name, service_def, usage_data)
+        for service_name, service_def in config.services.items()
+    ]
     return pd.concat(dfs, keys=list(config.services), axis=1)
 
 
+def get_service_and_summary_data(config, usage_data, cache=None):
+    """``generate_service_data`` followed by ``get_summary_data``
+
+    :param cache: Optional dict used to share results between sets of the same config.
+                  A service is only recomputed if its definition or the usage fields it
+                  uses are different from the last call.
+    :return: tuple of (service_data, summary_data)
+    """
+    estimation_buffer = get_estimation_buffer(config, usage_data.index)
+    results = [
+        compute_service(config, service_name, service_def, usage_data, estimation_buffer, cache)
+        for service_name, service_def in config.services.items()
+    ]
+    services = list(config.services)
+    return (
+        pd.concat([result[0] for result in results], keys=services, axis=1),
+        pd.concat([result[1] for result in results], keys=services, axis=1),
+    )
+
+
+def compute_service(config, service_name, service_def, usage_data, estimation_buffer, cache=None):
+    """Service data and summary data for a single service
+
+    :param cache: see ``get_service_and_summary_data``
+    :return: tuple of (service data, summary data)
+    """
+    if cache is not None:
+        key, cached = get_cached_service(cache, config, service_name, service_def, usage_data)
+        if cached:
+            return cached
+
+    service_data = get_service_data(config, service_name, service_def, usage_data)
+    summary_data = get_service_summary_data(config, service_name, service_def, service_data, estimation_buffer)
+    if config.compact_dtypes:
+        service_data = compact_service_data(service_data)
+    if cache is not None:
+        cache_service(cache, service_name, key, (service_data, summary_data))
+    return service_data, summary_data
+
+
+def get_cached_service(cache, config, service_name, service_def, usage_data):
+    """:return: tuple of (cache key, cached (service data, summary data) or None)"""
+    key = _service_cache_key(config, service_def, usage_data)
+    cached = cache.get(service_name)
+    if cached and cached[0] == key:
+        return key, cached[1:]
+    return key, None
+
+
+def cache_service(cache, service_name, key, result):
+    # only the last result is kept for each service to limit memory use with large sweeps
+    cache[service_name] = (key,) + tuple(result)
+
+
+# top level config keys that don't change the service data of a service with the same definition
+# and usage inputs: they are covered by the rest of the key or only select the output dates
+SERVICE_INDEPENDENT_KEYS = ('sets', 'usage', 'services', 'sets_summary_date', 'summary_dates')
+
+
+def _service_cache_key(config, service_def, usage_data):
+    global_params = {key: value for key, value in config._obj.items() if key not in SERVICE_INDEPENDENT_KEYS}
+    fields = sorted(get_service_usage_fields(service_def))
+    usage_hash = hashlib.sha1(usage_data[fields].to_numpy(dtype=np.float64).tobytes()).hexdigest()
+    return repr(global_params), repr(config_to_json(service_def)), tuple(usage_data.index), usage_hash
+
+
+def get_service_usage_fields(service_def):
+    """Usage fields that the service data is computed from"""
+    fields = {'users', service_def.usage_field}
+    fields.update(data_model.referenced_field for data_model in service_def.storage.data_models)
+    fields.update(data_model.referenced_field for data_model in service_def.process.ram_model)
+    return fields
+
+
+def get_service_data(config, service_name, service_def, usage_data):
+    """Compute and storage data for a single service"""
+    data_storage = _service_storage_data(config, service_def, usage_data)
+    compute = ComputeModel(service_name, service_def).data_frame(usage_data, data_storage)
+    return pd.concat([usage_data['users'], compute, data_storage], keys=['Users', 'Compute', 'Data Storage'], axis=1)
+
+
 def _service_storage_data(config, service_def, usage_data):
     def _to_df(storage, raw=None):
         df = pd.DataFrame({
@@ -59,16 +184,61 @@ def _service_storage_data(config, service_def, usage_data):
         if service_def.storage.override_storage_buffer != None:
             buffer = service_def.storage.override_storage_buffer
         total = data_storage.sum(axis=1) * float(1 + buffer)
-        return _to_df(total, data_storage)
+        df = _to_df(total, data_storage)
+        for group, tier_storage in _tier_data_size(service_def.storage.data_models, usage_data).items():
+            df[tier_storage_field(group)] = tier_storage * float(1 + buffer)
+        return df
     else:
         static = service_def.storage.static_baseline_bytes * service_def.storage.redundancy_factor
         data_storage = pd.Series([static] * len(usage_data), index=usage_data.index)
         return _to_df(data_storage)
 
 
+def get_age_buckets(values, ages):
+    """Split cumulative values into buckets by age using shifted values.
+
+    The values older than ``age`` months are the values ``age`` months ago, limited to
+    the current value in case items have been removed (oldest first).
+
+    :param values: array of cumulative values with the months along the last axis
+                   e.g. (months) for a single set or (sets x months)
+    :param ages: increasing ages in months at which each bucket starts after the first
+    :return: array of shape (..., len(ages) + 1, months). Bucket 0 is the values younger than ``ages[0]``.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    months = np.arange(values.shape[-1])
+    shifted = months[np.newaxis, :] - np.asarray(ages)[:, np.newaxis]
+    older = np.where(shifted >= 0, values[..., np.clip(shifted, 0, None)], 0)
+    older = np.minimum(older, values[..., np.newaxis, :])
+    # the values older than each bucket boundary: all values (age 0), ..., none
+    bounds = np.concatenate([values[..., np.newaxis, :], older, np.zeros_like(values)[..., np.newaxis, :]], axis=-2)
+    return bounds[..., :-1, :] - bounds[..., 1:, :]
+
+
+def _tier_data_size(data_models, usage_data):
+    """:return: dict of storage group -> bytes in each tier"""
+    tiers = OrderedDict()
+    for size_def in data_models:
+        if not size_def.tiers:
+            continue
+        buckets = get_age_buckets(usage_data[size_def.referenced_field], [tier.after for tier in size_def.tiers])
+        for tier, bucket in zip(size_def.tiers, buckets[1:]):
+            tier_bytes = bucket * size_def.unit_bytes * tier.redundancy_factor
+            tiers[tier.group] = tiers.get(tier.group, 0) + tier_bytes
+    return OrderedDict(
+        (group, pd.Series(tier_bytes, index=usage_data.index)) for group, tier_bytes in tiers.items()
+    )
+
+
 def _service_data_size(data_models, static_baseline_bytes, usage_data, redundancy_factor=1):
     def _service_requirement(size_def):
-        bytes = usage_data[size_def.referenced_field] * size_def.unit_bytes
+        values = usage_data[size_def.referenced_field]
+        if size_def.tiers:
+            # only the data that hasn't moved to a lifecycle tier
+            values = pd.Series(
+                get_age_buckets(values, [size_def.tiers[0].after])[0], index=values.index, name=values.name
+            )
+        bytes = values * size_def.unit_bytes
         return bytes * redundancy_factor
 
     baseline = pd.Series(
@@ -86,9 +256,25 @@ class ComputeModel(object):
     def _get_process_series(self, process_def, usage_data):
         if process_def.static_number:
             return pd.Series([process_def.static_number] * len(usage_data), index=usage_data.index)
+        elif process_def.service_time:
+            return self._get_queue_process_series(process_def, usage_data)
         else:
             return (usage_data / float(process_def.capacity)).map(np.ceil)
 
+    def _get_queue_process_series(self, process_def, usage_data):
+        """Number of processes needed to keep the task wait time within the target at peak load"""
+        arrival_rate = (
+            usage_data.to_numpy(dtype=np.float64) * float(process_def.tasks_per_usage)
+            * float(process_def.peak_factor) / SECONDS_PER_MONTH
+        )
+        workers = required_servers(
+            arrival_rate,
+            float(process_def.service_time),
+            float(process_def.target_wait),
+            float(process_def.wait_percentile),
+        )
+        return pd.Series(np.ceil(workers / process_def.concurrency), index=usage_data.index)
+
     def data_frame(self, current_data_frame, data_storage):
         usage = current_data_frame[self.service_def.usage_field]
         if self.service_def.process.sub_processes:
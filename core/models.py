@@ -2,8 +2,11 @@ import logging
 from abc import ABC, abstractmethod
 from collections import namedtuple
 
+import numpy as np
 import pandas as pd
 
+from core.expressions import compile_expression
+from core.survival import live_items, survival_from_curve, survival_from_distribution
 from core.utils import apply_context
 
 logger = logging.getLogger(__name__)
@@ -16,10 +19,12 @@ def models_by_slug():
         DateValueModel,
         CumulativeModel,
         LimitedLifetimeModel,
+        SurvivalModel,
         DerivedSum,
         DerivedProduct,
         DerivedFactor,
         BaselineWithGrowth,
+        ExpressionModel,
     ]
 
     return {
@@ -41,6 +46,28 @@ class DFModel(ABC):
     def dependant_fields(self):
         return []
 
+    @property
+    def output_fields(self):
+        """Fields in the model's data frame"""
+        return [self.name]
+
+    def evaluate(self, values):
+        """Model values as numpy arrays. Unlike ``data_frame`` the values are not
+        rounded to whole items so they change smoothly with the model parameters.
+        Used where the model is evaluated many times e.g. calibration.
+
+        Models without an array implementation fall back to ``data_frame``.
+
+        :param values: dict of field name -> array which includes the fields this model depends on
+        :return: dict of field name -> array for each field the model produces
+        """
+        length = len(next(iter(values.values())))
+        current_data_frame = pd.DataFrame(
+            {field: values[field] for field in self.dependant_fields}, index=pd.RangeIndex(length)
+        )
+        model_df = self.data_frame(current_data_frame)
+        return {field: model_df[field].to_numpy(np.float64) for field in model_df.columns}
+
     def can_run(self, current_data_frame):
         if not self.dependant_fields:
             return True
@@ -97,6 +124,9 @@ class CumulativeModel(DFModel):
         monthly_data = current_data_frame[self.dependant_field]
         return _get_cumulative_data(self.name, monthly_data, self.start_with)
 
+    def evaluate(self, values):
+        return {self.name: _get_cumulative_values(values[self.dependant_field], self.start_with)}
+
 
 def _get_cumulative_data(name, monthly_data, start_with=0):
     monthly_data = monthly_data.copy()
@@ -106,6 +136,12 @@ def _get_cumulative_data(name, monthly_data, start_with=0):
     return pd.DataFrame([cumulative]).T
 
 
+def _get_cumulative_values(monthly_values, start_with=0):
+    cumulative = np.cumsum(monthly_values, dtype=np.float64)
+    cumulative += start_with
+    return cumulative
+
+
 class LimitedLifetimeModel(CumulativeModel):
     """Extends the cumulative model by giving items a finite lifespan"""
     slug = 'cumulative_limited_lifespan'
@@ -121,6 +157,47 @@ class LimitedLifetimeModel(CumulativeModel):
         live_items.name = self.name
         return live_items.astype(int)
 
+    def evaluate(self, values):
+        cumulative = _get_cumulative_values(values[self.dependant_field], self.start_with)
+        live = cumulative.copy()
+        live[self.lifespan:] -= cumulative[:max(len(live) - self.lifespan, 0)]
+        return {self.name: live}
+
+
+class SurvivalModel(CumulativeModel):
+    """Extends the cumulative model by giving items a lifespan that varies between items
+    e.g. cases which are closed after a few months on average."""
+    slug = 'cumulative_survival'
+
+    def __init__(self, context, name, dependant_field, survival=None, distribution=None, start_with=0):
+        """
+        :param survival: List of the fraction of items that are live at each age in months
+                         starting with the month they are created
+        :param distribution: Lifespan distribution e.g. {'type': 'exponential', 'mean': 6}
+        :param start_with: Int used to account for existing data
+        """
+        super(SurvivalModel, self).__init__(context, name, dependant_field, start_with=start_with)
+        if (survival is None) == (distribution is None):
+            raise ValueError(f"One of 'survival' or 'distribution' required for '{name}'")
+        self.survival = survival
+        self.distribution = distribution
+
+    def get_survival_curve(self, length):
+        if self.distribution:
+            return survival_from_distribution(self.context, self.distribution, length)
+        return survival_from_curve(self.context, self.survival, length)
+
+    def data_frame(self, current_data_frame):
+        new_items = current_data_frame[self.dependant_field].to_numpy(dtype=float).copy()
+        new_items[0] += self.start_with
+        live = live_items(new_items, self.get_survival_curve(len(new_items)))
+        return pd.DataFrame({self.name: np.rint(live).astype(int)}, index=current_data_frame.index)
+
+    def evaluate(self, values):
+        new_items = np.array(values[self.dependant_field], dtype=np.float64)
+        new_items[0] += self.start_with
+        return {self.name: live_items(new_items, self.get_survival_curve(len(new_items)))}
+
 
 class DerivedModel(DFModel):
     """Base class for models that are derived from other fields"""
@@ -129,6 +206,10 @@ class DerivedModel(DFModel):
     def func(self):
         raise NotImplemented
 
+    def array_func(self, arrays):
+        """Equivalent of ``func`` applied to a list of arrays"""
+        return self._apply_func(pd.DataFrame(dict(zip(self.dependant_fields, arrays)))).to_numpy()
+
     def __init__(self, context, name, dependant_fields, start_with=None):
         self.context = context
         self.name = name
@@ -139,22 +220,34 @@ class DerivedModel(DFModel):
     def dependant_fields(self):
         return self._dependant_fields
 
-    def data_frame(self, current_data_frame):
+    def _apply_func(self, current_data_frame):
         fields = self.dependant_fields
         if len(fields) == 1:
             fields = fields[0]
-        series = current_data_frame[fields].apply(self.func, axis=1)
+        return current_data_frame[fields].apply(self.func, axis=1)
+
+    def data_frame(self, current_data_frame):
+        series = self._apply_func(current_data_frame)
         series.name = self.name
         if self.start_with:
             series[0] += self.start_with
         return pd.DataFrame([series]).T
 
+    def evaluate(self, values):
+        result = np.array(self.array_func([values[field] for field in self.dependant_fields]), dtype=np.float64)
+        if self.start_with:
+            result[0] += self.start_with
+        return {self.name: result}
+
 
 class DerivedSum(DerivedModel):
     """Sum multiple fields"""
     slug = 'derived_sum'
     func = sum
 
+    def array_func(self, arrays):
+        return np.sum(arrays, axis=0)
+
 
 class DerivedProduct(DerivedModel):
     """Multiply multiple fields"""
@@ -167,6 +260,9 @@ class DerivedProduct(DerivedModel):
 
         return _prod
 
+    def array_func(self, arrays):
+        return np.prod(arrays, axis=0)
+
 
 class DerivedFactor(DerivedModel):
     """Multiply a single other field by a static factor"""
@@ -183,6 +279,9 @@ class DerivedFactor(DerivedModel):
 
         return _mul
 
+    def array_func(self, arrays):
+        return arrays[0] * self.factor
+
 
 class BaselineWithGrowth(DFModel):
     """Used to model something with a starting value that grows over time
@@ -209,6 +308,10 @@ class BaselineWithGrowth(DFModel):
     def dependant_fields(self):
         return [self.dependant_field]
 
+    @property
+    def output_fields(self):
+        return ['{}_baseline'.format(self.name), '{}_monthly'.format(self.name), self.name]
+
     def data_frame(self, current_data_frame):
         baseline_name = '{}_baseline'.format(self.name)
         baseline_model = DerivedFactor(self.context, baseline_name, self.dependant_field, self.baseline)
@@ -224,3 +327,58 @@ class BaselineWithGrowth(DFModel):
         total.name = self.name
 
         return pd.DataFrame([baseline, monthly, total]).T
+
+    def evaluate(self, values):
+        dependant = values[self.dependant_field]
+        baseline = dependant * apply_context(self.context, self.baseline, float)
+        monthly = dependant * apply_context(self.context, self.monthly_growth, float)
+        return {
+            '{}_baseline'.format(self.name): baseline,
+            '{}_monthly'.format(self.name): monthly,
+            self.name: baseline + _get_cumulative_values(monthly, self.start_with),
+        }
+
+
+class ExpressionModel(DFModel):
+    """Evaluate an arithmetic formula over other fields
+    e.g. forms per day: ``users * forms_per_user * 0.04``
+
+    Set variables can be referenced with the ``{var}`` syntax.
+    """
+    slug = 'expression'
+
+    def __init__(self, context, name, expression, start_with=0):
+        """
+        :param expression: Formula referencing other fields by name
+        :param start_with:  Int used to account for existing data
+        """
+        self.context = context
+        self.name = name
+        self.expression = apply_context(context, str(expression))
+        self.start_with = start_with
+        self._evaluate, self._dependant_fields = compile_expression(self.expression)
+
+    @property
+    def dependant_fields(self):
+        return self._dependant_fields
+
+    def data_frame(self, current_data_frame):
+        values = {
+            field: current_data_frame[field].to_numpy()
+            for field in self.dependant_fields
+        }
+        result = self._evaluate(values)
+        if not self.dependant_fields:
+            result = [result] * len(current_data_frame.index)
+        series = pd.Series(result, index=current_data_frame.index, name=self.name)
+        if self.start_with:
+            series.iloc[0] += self.start_with
+        return pd.DataFrame([series]).T
+
+    def evaluate(self, values):
+        result = self._evaluate({field: values[field] for field in self.dependant_fields})
+        length = len(next(iter(values.values())))
+        result = np.array(np.broadcast_to(result, (length,)), dtype=np.float64)
+        if self.start_with:
+            result[0] += self.start_with
+        return {self.name: result}
@@ -1,4 +1,6 @@
-from core.utils import format_date
+from collections import OrderedDict
+
+from core.utils import format_date, byte_map
 import pandas as pd
 import numpy as np
 
@@ -13,7 +15,7 @@ SERVICE_INDEX = 'Service'
 
 
 def write_summary_comparisons(config, writer, user_counts, comparisons, prefix=''):
-    storage_by_cat, storage_by_group, compute = comparisons
+    storage_by_cat, storage_by_group, compute = comparisons[:3]
     sheet = '%s%s' % (prefix, COMPARISONS_SHEET)
 
     if user_counts:
@@ -35,6 +37,10 @@ def write_summary_comparisons(config, writer, user_counts, comparisons, prefix='
 
     writer.write_data_frame(compute, sheet, SERVICE_INDEX, '%sCompute Combined' % prefix, has_total_row=True)
 
+    if comparisons.cost is not None:
+        cost_header = '%sCost (%s)' % (prefix, config.price_catalog.currency)
+        writer.write_data_frame(comparisons.cost, sheet, SERVICE_INDEX, cost_header, has_total_row=True)
+
 
 def write_summary_data(config, writer, summary_date, summary_data, user_count):
     sheet_name = SUMMARY_SHEET % (format_date(summary_date), short_user_count(user_count))
@@ -79,6 +85,15 @@ def write_summary_data(config, writer, summary_date, summary_data, user_count):
         has_total_row=True
     )
 
+    if summary_data.cost is not None:
+        writer.write_data_frame(
+            summary_data.cost,
+            sheet_name,
+            'Service',
+            'Cost (%s)' % config.price_catalog.currency,
+            has_total_row=True
+        )
+
 
 def write_raw_service_data(writer, service_data, summary_data, title):
     def _get_cols(headers):
@@ -97,6 +112,72 @@ def write_raw_service_data(writer, service_data, summary_data, title):
         combined = sdata.join(summary_data[section])
         writer.write_data_frame(combined, "{} ({})".format(title, section), 'Dates')
 
+def write_set_summary(stream_writer, set_name, summary_date, summary_data):
+    service_summary = summary_data.service_summary.drop('Total', axis=0)
+    service_summary = service_summary.rename_axis(SERVICE_INDEX).reset_index()
+    service_summary.insert(0, 'Date', format_date(summary_date))
+    service_summary.insert(0, 'Set', set_name)
+    stream_writer.write_data_frame(service_summary)
+
+
+def write_capacity_forecast(config, writer, forecast, lead_time):
+    forecast = forecast.copy()
+    storage_rows = forecast.index.get_level_values('resource') == 'storage'
+    bytes_per_unit = byte_map[config.storage_display_unit]
+    forecast.loc[storage_rows, ['Provisioned', 'Peak Demand']] /= bytes_per_unit
+    forecast = forecast.rename(index={'storage': 'storage (%s)' % config.storage_display_unit}, level='resource')
+    for column in ('Exhausted', 'Order By'):
+        forecast[column] = forecast[column].map(lambda date: format_date(date) if pd.notna(date) else '')
+
+    for set_name in forecast.index.unique(level='set'):
+        set_forecast = forecast.xs(set_name, level='set')
+        set_forecast.index = [': '.join(key) for key in set_forecast.index]
+        set_forecast = set_forecast.sort_values(['Order By', 'Peak Utilization'], ascending=[True, False])
+        exhausted = set_forecast['Exhausted'] != ''
+        set_forecast = pd.concat([set_forecast[exhausted], set_forecast[~exhausted]])
+        writer.write_data_frame(
+            set_forecast, 'Capacity Forecast', 'Limit',
+            'Capacity forecast: %s (lead time %s months)' % (set_name, lead_time)
+        )
+
+
+def write_procurement_plan(config, writer, plan, lead_time):
+    bytes_per_unit = byte_map[config.storage_display_unit]
+    storage_label = 'storage (%s)' % config.storage_display_unit
+
+    orders = plan.orders.copy()
+    storage_rows = orders.index.get_level_values('resource') == 'storage'
+    orders.loc[storage_rows, ['Quantity', 'Provisioned', 'Required']] /= bytes_per_unit
+    orders = orders.rename(index={'storage': storage_label}, level='resource')
+    for column in ('Order By', 'Delivery'):
+        orders[column] = orders[column].map(format_date)
+
+    storage_columns = plan.provisioned.columns.get_level_values('resource') == 'storage'
+    provisioned = plan.provisioned.copy()
+    required = plan.required.copy()
+    for data in (provisioned, required):
+        data.loc[:, storage_columns] /= bytes_per_unit
+    headroom = provisioned - required
+
+    for set_name in plan.provisioned.columns.unique(level='set'):
+        if set_name in orders.index.unique(level='set'):
+            set_orders = orders.xs(set_name, level='set')
+            set_orders.index = [': '.join(key) for key in set_orders.index]
+            writer.write_data_frame(
+                set_orders, 'Procurement', 'Resource',
+                'Procurement orders: %s (lead time %s months)' % (set_name, lead_time)
+            )
+
+        curves = pd.DataFrame(OrderedDict(
+            ('%s: %s: %s: %s' % (scope, name, storage_label if resource == 'storage' else resource, kind),
+             data[set_name][(scope, name, resource)])
+            for scope, name, resource in plan.provisioned[set_name].columns
+            for kind, data in [('Provisioned', provisioned), ('Required', required), ('Headroom', headroom)]
+        ))
+        curves.index = curves.index.map(format_date)
+        writer.write_data_frame(curves, 'Procurement', 'Date', 'Provisioned vs required: %s' % set_name)
+
+
 def write_raw_data(writer, usage, title):
         writer.write_data_frame(usage, title, 'Dates')
 
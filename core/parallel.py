@@ -0,0 +1,105 @@
+"""Compute the per-service data in parallel worker processes.
+
+The usage data is copied once into a block of shared memory. Each worker
+attaches to that block and wraps it in a DataFrame without copying so the
+usage data is not duplicated per worker or pickled per task. Only the
+(much smaller) per-service results are sent back to the parent.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+from core.config import ClusterConfig, config_to_json
+from core.generate import cache_service, compute_service, get_cached_service
+from core.summarize import get_estimation_buffer
+
+
+class SharedFrame(object):
+    """Numeric DataFrame stored in shared memory as a single float64 block"""
+    def __init__(self, data_frame):
+        values = data_frame.to_numpy(dtype=np.float64)
+        self.shm = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+        block = np.ndarray(values.shape, dtype=np.float64, buffer=self.shm.buf)
+        block[:] = values
+        self.spec = (self.shm.name, values.shape, list(data_frame.columns), data_frame.index)
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def attach_shared_frame(spec):
+    """Zero-copy DataFrame view of a ``SharedFrame`` from another process.
+
+    :return: tuple of (SharedMemory, DataFrame). The SharedMemory must be kept
+             open for as long as the DataFrame is in use.
+    """
+    name, shape, columns, index = spec
+    shm = shared_memory.SharedMemory(name=name)
+    block = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+    return shm, pd.DataFrame(block, index=index, columns=columns, copy=False)
+
+
+_worker_state = {}
+
+
+def _init_worker(config_json, usage_spec):
+    shm, usage_data = attach_shared_frame(usage_spec)
+    config = ClusterConfig(config_json)
+    _worker_state.update({
+        'shm': shm,
+        'config': config,
+        'usage_data': usage_data,
+        'estimation_buffer': get_estimation_buffer(config, usage_data.index),
+    })
+
+
+def _service_worker(service_name):
+    config = _worker_state['config']
+    usage_data = _worker_state['usage_data']
+    return compute_service(
+        config, service_name, config.services[service_name], usage_data, _worker_state['estimation_buffer']
+    )
+
+
+def generate_service_summary_data(config, usage_data, processes, cache=None):
+    """Parallel version of ``generate_service_data`` followed by ``get_summary_data``
+
+    :param processes: number of worker processes
+    :param cache: see ``get_service_and_summary_data``. Only the services that aren't
+                  in the cache are sent to the workers.
+    :return: tuple of (service_data, summary_data)
+    """
+    services = list(config.services)
+    results = {}
+    keys = {}
+    if cache is not None:
+        for service_name in services:
+            keys[service_name], results[service_name] = get_cached_service(
+                cache, config, service_name, config.services[service_name], usage_data
+            )
+    pending = [service_name for service_name in services if results.get(service_name) is None]
+
+    if pending:
+        with SharedFrame(usage_data) as shared_usage:
+            with ProcessPoolExecutor(
+                max_workers=min(processes, len(pending)),
+                initializer=_init_worker,
+                initargs=(config_to_json(config), shared_usage.spec)
+            ) as executor:
+                results.update(zip(pending, executor.map(_service_worker, pending)))
+        if cache is not None:
+            for service_name in pending:
+                cache_service(cache, service_name, keys[service_name], results[service_name])
+
+    service_data = pd.concat([results[name][0] for name in services], keys=services, axis=1)
+    summary_data = pd.concat([results[name][1] for name in services], keys=services, axis=1)
+    return service_data, summary_data
@@ -0,0 +1,129 @@
+"""Month-by-month procurement plan.
+
+Resources are bought in fixed steps (e.g. disks in 10TB units, VMs in blocks of 4)
+and take ``lead_time`` months to arrive. The steps are defined in the same format
+as the capacity limits with ``*`` matching every name in a scope:
+
+    services:
+      '*': {vms: 1}
+      pg_shards: {vms: 4}
+    storage_groups:
+      SSD: {storage: 10TB}
+
+For each month the provisioned resources must cover the peak demand so far so the
+provisioned amount is the running maximum of the demand rounded up to whole steps.
+Every set, month and planned resource is computed in one pass as
+(sets x months x resources) array operations.
+"""
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+import pandas as pd
+
+ANY_NAME = '*'
+
+ProcurementPlan = namedtuple('ProcurementPlan', 'orders provisioned required')
+
+
+def get_step_series(steps, demand_columns):
+    """Step sizes of the demand columns that are planned.
+
+    :param steps: ``CapacityConfig`` of step sizes
+    :param demand_columns: columns of the output of ``get_monthly_demand``
+    :return: series of step sizes indexed by (scope, name, resource)
+    """
+    step_series = steps.limit_series()
+    _check_steps(step_series)
+    wildcard = {
+        (scope, resource): step for (scope, name, resource), step in step_series.items() if name == ANY_NAME
+    }
+    explicit = OrderedDict((key, step) for key, step in step_series.items() if key[1] != ANY_NAME)
+    unknown = set(explicit) - set(demand_columns)
+    if unknown:
+        raise ValueError('Steps defined for unknown services or groups: %s' % ', '.join(
+            ':'.join(key) for key in sorted(unknown)
+        ))
+
+    planned = OrderedDict()
+    for scope, name, resource in demand_columns:
+        if (scope, name, resource) in explicit:
+            planned[(scope, name, resource)] = explicit[(scope, name, resource)]
+        elif (scope, resource) in wildcard:
+            planned[(scope, name, resource)] = wildcard[(scope, resource)]
+    if not planned:
+        raise ValueError('No steps defined for any of the demand')
+    return pd.Series(
+        list(planned.values()), dtype=float,
+        index=pd.MultiIndex.from_tuples(list(planned), names=['scope', 'name', 'resource'])
+    )
+
+
+def _check_steps(step_series):
+    invalid = step_series[step_series <= 0]
+    if len(invalid):
+        raise ValueError('Steps must be greater than 0: %s' % ', '.join(':'.join(key) for key in invalid.index))
+
+
+def plan_procurement(demand_by_set, steps, provisioned=None, lead_time=0):
+    """Orders needed so that the provisioned resources cover the demand every month.
+
+    :param demand_by_set: dict of set name -> output of ``get_monthly_demand``
+    :param steps: ``CapacityConfig`` of the step size of each resource
+    :param provisioned: ``CapacityConfig`` of the resources provisioned before the first month.
+                        Orders add whole steps on top of these.
+    :param lead_time: months between ordering and delivery
+    :return: ProcurementPlan of:
+             orders: DataFrame indexed by (set, scope, name, resource) with a row per order
+             provisioned: DataFrame of the monthly provisioned resources with columns indexed
+                          by (set, scope, name, resource)
+             required: DataFrame of the monthly demand with the same columns
+    """
+    if not demand_by_set:
+        raise ValueError('No sets to plan')
+    sets = list(demand_by_set)
+    dates = demand_by_set[sets[0]].index
+    step_series = get_step_series(steps, demand_by_set[sets[0]].columns)
+    initial = np.zeros(len(step_series))
+    if provisioned is not None:
+        initial = provisioned.limit_series().reindex(step_series.index, fill_value=0).to_numpy()
+
+    # sets x months x resources
+    demand = np.nan_to_num(np.stack([
+        demand_by_set[set_name].reindex(index=dates, columns=step_series.index).to_numpy(dtype=float)
+        for set_name in sets
+    ]))
+    peak = np.maximum.accumulate(demand, axis=1)
+    step = step_series.to_numpy()
+    shortfall = np.maximum(peak - initial, 0)
+    # tolerance so that float rounding in the demand doesn't buy an extra step
+    step_counts = np.ceil(shortfall / step - 1e-9)
+    supply = initial + step_counts * step
+
+    # steps delivered each month: the first month includes anything needed immediately
+    delivered = np.diff(step_counts, axis=1, prepend=0)
+    set_index, month_index, resource_index = np.nonzero(delivered)
+    delivery_dates = pd.DatetimeIndex(dates.values[month_index])
+    orders = pd.DataFrame(OrderedDict([
+        ('Order By', delivery_dates - pd.DateOffset(months=lead_time)),
+        ('Delivery', delivery_dates),
+        ('Steps', delivered[set_index, month_index, resource_index].astype(int)),
+        ('Quantity', delivered[set_index, month_index, resource_index] * step[resource_index]),
+        ('Provisioned', supply[set_index, month_index, resource_index]),
+        ('Required', peak[set_index, month_index, resource_index]),
+    ]), index=pd.MultiIndex.from_arrays(
+        [np.array(sets, dtype=object)[set_index]] + [
+            step_series.index.get_level_values(level)[resource_index] for level in range(3)
+        ],
+        names=['set', 'scope', 'name', 'resource']
+    ))
+
+    columns = pd.MultiIndex.from_tuples(
+        [(set_name,) + key for set_name in sets for key in step_series.index],
+        names=['set', 'scope', 'name', 'resource']
+    )
+
+    def _frame(values):
+        return pd.DataFrame(values.transpose(1, 0, 2).reshape(len(dates), -1), index=dates, columns=columns)
+
+    # np.nonzero orders the orders by set and then by month
+    return ProcurementPlan(orders, _frame(supply), _frame(demand))
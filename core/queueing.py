@@ -0,0 +1,84 @@
+"""M/M/c queueing formulas for sizing worker pools from a target wait time.
+
+The Erlang B probability is computed with the recursion
+
+    B(0) = 1
+    B(k) = a * B(k - 1) / (k + a * B(k - 1))
+
+which stays within [0, 1] for any number of servers so it doesn't overflow
+like the factorial form does for the thousands of workers some queues need.
+Erlang C is derived from it. All functions accept arrays of loads
+(e.g. one per month) and evaluate them together.
+"""
+import numpy as np
+
+# average length of a month
+SECONDS_PER_MONTH = 365.25 / 12 * 24 * 60 * 60
+
+
+def erlang_c(servers, load):
+    """Probability that a task has to wait (Erlang C).
+
+    :param servers: number of servers
+    :param load: offered load in Erlangs (arrival rate * service time). Scalar or array.
+    """
+    load = np.asarray(load, dtype=np.float64)
+    erlang_b = np.ones(load.shape)
+    for k in range(1, servers + 1):
+        erlang_b = load * erlang_b / (k + load * erlang_b)
+    return _erlang_c_from_b(servers, load, erlang_b)
+
+
+def _erlang_c_from_b(servers, load, erlang_b):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        erlang_c = erlang_b / (1 - load / servers * (1 - erlang_b))
+    # the queue is unstable if the load is more than the number of servers
+    return np.where(load < servers, erlang_c, 1.)
+
+
+def wait_probability(servers, arrival_rate, service_time, wait):
+    """Probability that a task waits longer than ``wait`` seconds in an M/M/c queue"""
+    arrival_rate = np.asarray(arrival_rate, dtype=np.float64)
+    load = arrival_rate * service_time
+    stable = load < servers
+    probability = erlang_c(servers, load) * _wait_decay(servers, arrival_rate, service_time, wait, stable)
+    return np.where(stable, probability, 1.)
+
+
+def _wait_decay(servers, arrival_rate, service_time, wait, stable):
+    """``exp(-(c / service_time - arrival_rate) * wait)`` for the stable loads and 1 for the others.
+    The exponent is only evaluated for stable loads since it overflows for unstable ones."""
+    spare_rate = np.where(stable, servers / service_time - arrival_rate, 0)
+    return np.exp(-spare_rate * wait)
+
+
+def required_servers(arrival_rate, service_time, target_wait, percentile=0.95):
+    """Smallest number of servers for which the wait time of the given percentile
+    of tasks is at most ``target_wait``.
+
+    :param arrival_rate: tasks per second. Scalar or array.
+    :param service_time: mean seconds to process a task
+    :param target_wait: target wait time in seconds
+    :param percentile: fraction of tasks that should wait at most ``target_wait``
+    :return: array of server counts with the same shape as ``arrival_rate``
+    """
+    arrival_rate = np.asarray(arrival_rate, dtype=np.float64)
+    load = arrival_rate * service_time
+    allowed = 1 - percentile
+
+    servers = np.zeros(load.shape)
+    pending = load > 0
+    erlang_b = np.ones(load.shape)
+    k = 0
+    # all loads are evaluated together so this only loops up to the largest server count needed
+    while pending.any():
+        k += 1
+        erlang_b = load * erlang_b / (k + load * erlang_b)
+        stable = pending & (load < k)
+        if not stable.any():
+            continue
+        probability = _erlang_c_from_b(k, load, erlang_b) * _wait_decay(k, arrival_rate, service_time, target_wait, stable)
+        done = stable & (probability <= allowed)
+        servers[done] = k
+        pending &= ~done
+    return servers
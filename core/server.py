@@ -0,0 +1,315 @@
+"""HTTP server that answers JSON queries about configs that are loaded once.
+
+The results of each set (and what-if variant of a set) are kept in an LRU cache
+so repeated queries don't recompute the usage and service data and the responses
+are cached so repeated queries are answered without any computation.
+Concurrent requests for the same query wait for a single computation.
+
+    GET /configs
+    GET /usage?config=icds-14lakh-aug2019&set=7lakh-2000fpu&field=users
+    GET /value?config=icds-14lakh-aug2019&set=7lakh-2000fpu&service=pg_shards&metric=VMs Total&date=2020-09
+    GET /summary?config=icds-14lakh-aug2019&set=7lakh-2000fpu&date=2020-09
+    GET /comparison?config=icds-14lakh-aug2019
+
+What-if values for set variables are passed as ``override.<variable>`` e.g.
+``/value?service=pg_shards&metric=VMs Total&override.users=50000`` or as
+``overrides`` in the JSON body of a POST request with the other parameters.
+Only variables that the config uses can be overridden.
+"""
+import asyncio
+import json
+import logging
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl, urlsplit
+
+import numpy as np
+import pandas as pd
+
+from core.api import Model, ModelResult
+from core.config import check_config_variables
+from core.sets import get_set_context
+from core.summarize import compare_summaries
+from core.utils import format_date
+
+OVERRIDE_PREFIX = 'override.'
+STATUS_REASONS = {
+    200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 500: 'Internal Server Error'
+}
+
+logger = logging.getLogger(__name__)
+
+
+class QueryError(Exception):
+    def __init__(self, message, status=400):
+        super(QueryError, self).__init__(message)
+        self.status = status
+
+
+def _to_json_value(value):
+    if isinstance(value, (pd.Timestamp, np.datetime64)):
+        return format_date(pd.Timestamp(value))
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and not np.isfinite(value):
+        return None
+    return value
+
+
+def _label(label):
+    if isinstance(label, tuple):
+        return [_label(part) for part in label]
+    return _to_json_value(label)
+
+
+def frame_to_json(data_frame):
+    return {
+        'index': [_label(label) for label in data_frame.index],
+        'columns': [_label(label) for label in data_frame.columns],
+        'data': [[_to_json_value(value) for value in row] for row in data_frame.itertuples(index=False)],
+    }
+
+
+def series_to_json(series):
+    return OrderedDict((format_date(date), _to_json_value(value)) for date, value in series.items())
+
+
+def _parse_override(value):
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def _check_values(params, prefix=''):
+    """Raise QueryError unless every parameter is a single JSON value"""
+    for name, value in params.items():
+        if not isinstance(value, (str, int, float, bool, type(None))):
+            raise QueryError(f'"{prefix}{name}" must be a single value')
+
+
+def _freeze(overrides):
+    return tuple(sorted((overrides or {}).items()))
+
+
+class ModelServer(object):
+    """Answers queries about a set of configs.
+
+    :param models: dict of config name -> ``Model``
+    :param cache_size: number of set results to keep
+    :param response_cache_size: number of responses to keep
+    :param usage_cache_size: number of usage fields to keep per config before the cache is cleared
+    """
+    endpoints = ('configs', 'usage', 'value', 'summary', 'comparison')
+
+    def __init__(self, models, cache_size=32, response_cache_size=1024, usage_cache_size=10000):
+        self.models = models
+        self.cache_size = cache_size
+        self.response_cache_size = response_cache_size
+        self.usage_cache_size = usage_cache_size
+        self.results = OrderedDict()
+        self.responses = OrderedDict()
+        self.pending = {}
+        # queries are computed one at a time off the event loop. Cached responses don't wait.
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.computations = 0
+
+    @classmethod
+    def from_paths(cls, config_paths, **kwargs):
+        models = OrderedDict(
+            (os.path.splitext(os.path.basename(path))[0], Model.from_path(path)) for path in config_paths
+        )
+        return cls(models, **kwargs)
+
+    def get_model(self, config_name):
+        if config_name is None:
+            if len(self.models) > 1:
+                raise QueryError('"config" is required when more than one config is loaded')
+            config_name = next(iter(self.models))
+        try:
+            return config_name, self.models[config_name]
+        except KeyError:
+            raise QueryError(f'Unknown config "{config_name}"', 404)
+
+    def get_result(self, config_name, set_name=None, overrides=None):
+        """:return: cached ``ModelResult`` for the set with the overrides applied"""
+        config_name, model = self.get_model(config_name)
+        key = (config_name, set_name, _freeze(overrides))
+        if key in self.results:
+            self.results.move_to_end(key)
+            return self.results[key]
+
+        set_context = get_set_context(model.config, set_name)
+        if overrides:
+            try:
+                check_config_variables(model.config, list(overrides))
+            except ValueError as e:
+                raise QueryError(str(e))
+            set_context = dict(set_context, **overrides)
+        if len(model.usage_cache) > self.usage_cache_size:
+            # what-if values add new entries for every value
+            model.usage_cache.clear()
+        result = ModelResult(model, set_context)
+        self.results[key] = result
+        if len(self.results) > self.cache_size:
+            self.results.popitem(last=False)
+        return result
+
+    async def query(self, endpoint, params):
+        """JSON response for a query. Identical concurrent queries share one computation."""
+        if endpoint not in self.endpoints:
+            raise QueryError(f'Unknown query "{endpoint}"', 404)
+        key = json.dumps([endpoint, params], sort_keys=True)
+        if key in self.responses:
+            self.responses.move_to_end(key)
+            return self.responses[key]
+
+        if key not in self.pending:
+            self.pending[key] = asyncio.ensure_future(self._compute(key, endpoint, params))
+        return await asyncio.shield(self.pending[key])
+
+    async def _compute(self, key, endpoint, params):
+        try:
+            handler = getattr(self, f'query_{endpoint}')
+            response = await asyncio.get_running_loop().run_in_executor(self.executor, handler, params)
+            self.computations += 1
+        finally:
+            del self.pending[key]
+        self.responses[key] = response
+        if len(self.responses) > self.response_cache_size:
+            self.responses.popitem(last=False)
+        return response
+
+    def _get_result(self, params):
+        return self.get_result(params.get('config'), params.get('set'), params.get('overrides'))
+
+    def query_configs(self, params):
+        return OrderedDict(
+            (name, {
+                'sets': model.set_names,
+                'usage': list(model.config.usage),
+                'services': list(model.config.services),
+            })
+            for name, model in self.models.items()
+        )
+
+    def query_usage(self, params):
+        field = _require(params, 'field')
+        usage = self._get_result(params).get_usage([field])
+        if field not in usage:
+            raise QueryError(f'Unknown usage field "{field}"', 404)
+        return {'field': field, 'data': series_to_json(usage[field])}
+
+    def query_value(self, params):
+        service, metric = _require(params, 'service'), _require(params, 'metric')
+        result = self._get_result(params)
+        return {'value': _to_json_value(result.value(service, metric, params.get('date')))}
+
+    def query_summary(self, params):
+        summary = self._get_result(params).summary(params.get('date'))
+        response = OrderedDict([
+            ('service_summary', frame_to_json(summary.service_summary)),
+            ('storage_by_group', frame_to_json(summary.storage_by_group)),
+        ])
+        if summary.cost is not None:
+            response['cost'] = frame_to_json(summary.cost)
+        return response
+
+    def query_comparison(self, params):
+        """Comparison of the summaries of every set at the ``sets_summary_date``"""
+        config_name, model = self.get_model(params.get('config'))
+        summaries = OrderedDict()
+        for set_name in model.set_names:
+            result = self.get_result(config_name, set_name, params.get('overrides'))
+            summaries[set_name] = result.summary(model.config.sets_summary_date_val)
+        comparison = compare_summaries(model.config, summaries)
+        return OrderedDict(
+            (name, frame_to_json(data_frame))
+            for name, data_frame in comparison._asdict().items() if data_frame is not None
+        )
+
+    async def handle_request(self, method, target, body):
+        """:return: tuple of (status, JSON response)"""
+        url = urlsplit(target)
+        endpoint = url.path.strip('/')
+        params = {}
+        overrides = {}
+        for name, value in parse_qsl(url.query):
+            if name.startswith(OVERRIDE_PREFIX):
+                overrides[name[len(OVERRIDE_PREFIX):]] = _parse_override(value)
+            else:
+                params[name] = value
+        try:
+            if method == 'POST' and body:
+                try:
+                    body = json.loads(body)
+                except ValueError:
+                    raise QueryError('Invalid JSON body')
+                if not isinstance(body, dict):
+                    raise QueryError('The JSON body must be an object')
+                body_overrides = body.pop('overrides', None) or {}
+                if not isinstance(body_overrides, dict):
+                    raise QueryError('"overrides" must be an object')
+                params.update(body)
+                overrides.update(body_overrides)
+            elif method not in ('GET', 'POST'):
+                raise QueryError(f'Method {method} not allowed', 405)
+            _check_values(params)
+            _check_values(overrides, OVERRIDE_PREFIX)
+            if overrides:
+                params['overrides'] = overrides
+            return 200, await self.query(endpoint, params)
+        except QueryError as e:
+            return e.status, {'error': str(e)}
+        except (KeyError, ValueError) as e:
+            return 400, {'error': f'{type(e).__name__}: {e}'}
+        except Exception:
+            logger.exception('Error answering %s %s', method, target)
+            return 500, {'error': STATUS_REASONS[500]}
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, target, version = request_line.decode('latin1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode('latin1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                status, response = await self.handle_request(method, target, body)
+                data = json.dumps(response).encode('utf8')
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                writer.write((
+                    f'HTTP/1.1 {status} {STATUS_REASONS[status]}\r\n'
+                    f'Content-Type: application/json\r\n'
+                    f'Content-Length: {len(data)}\r\n'
+                    f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'
+                ).encode('latin1') + data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host='127.0.0.1', port=8000):
+        """:return: ``asyncio.Server`` that is accepting connections"""
+        return await asyncio.start_server(self.handle_connection, host, port)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+def _require(params, name):
+    if not params.get(name):
+        raise QueryError(f'"{name}" is required')
+    return params[name]
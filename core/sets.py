@@ -0,0 +1,95 @@
+import itertools
+import math
+from collections.abc import Mapping
+
+import numpy as np
+
+from core.utils import apply_context, context_pattern
+
+SWEEP_FUNCTIONS = {
+    # inclusive of ``stop`` when it falls on a step
+    'range': lambda start, stop, step: np.arange(start, stop + step / 2.0, step),
+    'linspace': lambda start, stop, num: np.linspace(start, stop, int(num)),
+    'logspace': lambda start, stop, num: np.geomspace(start, stop, int(num)),
+}
+
+
+def _sweep_values(spec):
+    (kind, params), = spec.items()
+    values = SWEEP_FUNCTIONS[kind](*params)
+    if all(float(value).is_integer() for value in values):
+        return [int(round(value)) for value in values]
+    return [float(value) for value in values]
+
+
+def _is_sweep(value):
+    return isinstance(value, Mapping) and len(value) == 1 and list(value)[0] in SWEEP_FUNCTIONS
+
+
+def expand_set_item(item):
+    """Expand a single set item which may contain range values e.g.
+
+        - name: '{users}'
+          users: {range: [700000, 1400000, 100000]}
+
+    :return: list of plain set items
+    """
+    item = dict(item)
+    sweeps = {key: _sweep_values(value) for key, value in item.items() if _is_sweep(value)}
+    if not sweeps:
+        return [item]
+
+    name = item.get('name')
+    items = []
+    for values in itertools.product(*sweeps.values()):
+        expanded = item.copy()
+        expanded.update(zip(sweeps, values))
+        if name:
+            if context_pattern.findall(name):
+                expanded['name'] = apply_context(expanded, name)
+            else:
+                expanded['name'] = '-'.join([name] + [str(value) for value in values])
+        items.append(expanded)
+    return items
+
+
+def expand_sets(sets):
+    return {
+        set_name: [expanded for item in items for expanded in expand_set_item(item)]
+        for set_name, items in sets.items()
+    }
+
+
+def count_combined_sets(sets):
+    return math.prod(len(items) for items in expand_sets(sets).values())
+
+
+def iter_combined_sets(sets):
+    """Lazily generate the combination of all the sets.
+    Only the individual set lists are held in memory, not the product."""
+    for combinations in itertools.product(*expand_sets(sets).values()):
+        context = {}
+        name = None
+        for item in combinations:
+            item = item.copy()
+            item_name = item.pop('name', None)
+            context.update(item)
+            if item_name:
+                if not name:
+                    name = item_name
+                else:
+                    name += f'-{item_name}'
+        context['name'] = name
+        yield context
+
+
+def get_set_context(config, set_name=None):
+    """:return: context of the set with the given name or the first set if ``set_name`` is None"""
+    if not config.sets:
+        if set_name not in (None, 'default'):
+            raise ValueError(f'Set "{set_name}" not found')
+        return {'name': 'default'}
+    for set_context in iter_combined_sets(config.sets):
+        if set_name is None or set_context['name'] == set_name:
+            return set_context
+    raise ValueError(f'Set "{set_name}" not found')
@@ -0,0 +1,116 @@
+"""Find the largest value of a set variable (e.g. users) that can be supported
+by a fixed set of resources.
+
+Resource usage is assumed to increase with the variable. Each round of the
+search evaluates a batch of candidate values spread across the remaining
+interval which narrows the interval by a factor of ``batch_size + 1`` per
+round. Usage fields that don't depend on the variable are cached and only
+computed once.
+"""
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from core.capacity import get_monthly_demand, get_utilization
+from core.config import ClusterConfig, check_config_variables, config_for_set, config_to_json
+from core.generate import generate_usage_data, get_service_and_summary_data
+
+SolveResult = namedtuple('SolveResult', 'value utilization exceeded_value exceeded_utilization evaluations')
+
+
+def get_peak_utilization(config, set_context, limits, date=None, cache=None):
+    """Peak utilization of each limit over all months (up to ``date`` if supplied)"""
+    config = config_for_set(config, set_context)
+    usage = generate_usage_data(config, set_context, cache)
+    _, summary_data = get_service_and_summary_data(config, usage)
+    if date is not None:
+        summary_data = summary_data.loc[:date]
+    demand = get_monthly_demand(config, summary_data)
+    return get_utilization(demand, limits).max()
+
+
+_worker_state = {}
+
+
+def _init_worker(config_json, set_context, variable, limits, date):
+    _worker_state.update({
+        'config': ClusterConfig(config_json),
+        'set_context': set_context,
+        'variable': variable,
+        'limits': limits,
+        'date': date,
+        'cache': {},
+    })
+
+
+def _evaluate(value):
+    state = _worker_state
+    set_context = dict(state['set_context'], **{state['variable']: value})
+    return get_peak_utilization(state['config'], set_context, state['limits'], state['date'], state['cache'])
+
+
+def _get_candidates(low, high, batch_size, integer):
+    candidates = np.linspace(low, high, batch_size + 2)[1:-1]
+    if integer:
+        candidates = np.unique(np.round(candidates).astype(int))
+    return [candidate for candidate in candidates.tolist() if low < candidate < high]
+
+
+def solve_max_value(config, set_context, variable, limits, low, high,
+                    tolerance=1, batch_size=4, date=None, jobs=1):
+    """Find the largest value of ``variable`` in [low, high] for which no limit is exceeded.
+
+    :param set_context: base set context. ``variable`` is overridden in this context.
+    :param limits: output of ``CapacityConfig.limit_series``
+    :param tolerance: stop once the interval is smaller than this
+    :param batch_size: number of candidates evaluated per round
+    :param jobs: number of processes used to evaluate the candidates
+    :return: SolveResult. ``value`` is None if ``low`` exceeds the limits and
+             ``exceeded_value`` is None if ``high`` does not.
+    """
+    check_config_variables(config, [variable])
+    integer = all(float(value).is_integer() for value in (low, high, tolerance))
+    executor = None
+    if jobs > 1:
+        executor = ProcessPoolExecutor(
+            max_workers=jobs, initializer=_init_worker,
+            initargs=(config_to_json(config), set_context, variable, limits, date)
+        )
+        evaluate_batch = lambda values: list(executor.map(_evaluate, values))
+    else:
+        _init_worker(config_to_json(config), set_context, variable, limits, date)
+        evaluate_batch = lambda values: [_evaluate(value) for value in values]
+
+    results = {}
+
+    def _evaluate_values(values):
+        for value, utilization in zip(values, evaluate_batch(values)):
+            results[value] = utilization
+
+    def _fits(value):
+        return (results[value] <= 1).all()
+
+    try:
+        _evaluate_values([low, high])
+        if not _fits(low):
+            return SolveResult(None, None, low, results[low], len(results))
+        if _fits(high):
+            return SolveResult(high, results[high], None, None, len(results))
+
+        while high - low > tolerance:
+            candidates = _get_candidates(low, high, batch_size, integer)
+            if not candidates:
+                break
+            _evaluate_values(candidates)
+            for candidate in candidates:
+                if _fits(candidate):
+                    low = candidate
+                else:
+                    high = candidate
+                    break
+    finally:
+        if executor:
+            executor.shutdown()
+
+    return SolveResult(low, results[low], high, results[high], len(results))
@@ -0,0 +1,163 @@
+"""Local SQLite database of model results.
+
+Every run is recorded along with the hash of the config and the git commit
+it was run at. The usage, service and summary data for each set is stored in
+long format (one row per value) so results can be compared across runs
+without re-running the model.
+"""
+import hashlib
+import itertools
+import json
+import sqlite3
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from core.config import config_to_json
+from core.cube import LABEL_COLUMNS
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    created TEXT NOT NULL,
+    config_name TEXT NOT NULL,
+    config_hash TEXT NOT NULL,
+    git_commit TEXT,
+    end_date TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_config_hash ON runs (config_hash);
+CREATE INDEX IF NOT EXISTS runs_git_commit ON runs (git_commit);
+
+CREATE TABLE IF NOT EXISTS usage (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    set_name TEXT NOT NULL,
+    date TEXT NOT NULL,
+    field TEXT NOT NULL,
+    value REAL
+);
+CREATE INDEX IF NOT EXISTS usage_lookup ON usage (field, set_name, date, run_id);
+
+CREATE TABLE IF NOT EXISTS service_data (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    set_name TEXT NOT NULL,
+    date TEXT NOT NULL,
+    service TEXT NOT NULL,
+    category TEXT NOT NULL,
+    field TEXT NOT NULL,
+    value REAL
+);
+CREATE INDEX IF NOT EXISTS service_data_lookup ON service_data (service, field, set_name, date, run_id);
+
+CREATE TABLE IF NOT EXISTS summary (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    set_name TEXT NOT NULL,
+    date TEXT NOT NULL,
+    service TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    value REAL
+);
+CREATE INDEX IF NOT EXISTS summary_lookup ON summary (service, metric, set_name, date, run_id);
+"""
+
+
+def get_config_hash(config):
+    config_json = json.dumps(config_to_json(config), sort_keys=True, default=str)
+    return hashlib.sha1(config_json.encode('utf8')).hexdigest()
+
+
+def _iter_rows(run_id, set_name, data_frame):
+    """Long format rows of (run_id, set_name, date, *column labels, value)"""
+    row_count, column_count = data_frame.shape
+    dates = np.repeat(data_frame.index.strftime('%Y-%m-%d').to_numpy(), column_count).tolist()
+    labels = [
+        np.tile(data_frame.columns.get_level_values(level).to_numpy(), row_count).tolist()
+        for level in range(data_frame.columns.nlevels)
+    ]
+    # SQLite stores NaN as NULL
+    values = data_frame.astype(np.float64).to_numpy().ravel().tolist()
+    return zip(
+        itertools.repeat(run_id), itertools.repeat(set_name), dates, *labels, values
+    )
+
+
+class ResultsStore(object):
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(SCHEMA)
+
+    def add_run(self, config_name, config, git_commit):
+        """:return: ID of the new run"""
+        cursor = self.conn.execute(
+            'INSERT INTO runs (created, config_name, config_hash, git_commit) VALUES (?, ?, ?, ?)',
+            (datetime.utcnow().isoformat(timespec='seconds'), config_name, get_config_hash(config), git_commit)
+        )
+        return cursor.lastrowid
+
+    def add_set(self, run_id, set_name, usage, service_data, summary_data):
+        """Store the data for a single set of a run
+
+        :param usage: output of ``generate_usage_data``
+        :param service_data: output of ``generate_service_data``
+        :param summary_data: output of ``get_summary_data``
+        """
+        summary_metrics = summary_data.loc[:, ~summary_data.columns.get_level_values(1).isin(LABEL_COLUMNS)]
+        with self.conn:
+            self.conn.executemany(
+                'INSERT INTO usage VALUES (?, ?, ?, ?, ?)',
+                _iter_rows(run_id, set_name, usage)
+            )
+            self.conn.executemany(
+                'INSERT INTO service_data VALUES (?, ?, ?, ?, ?, ?, ?)',
+                _iter_rows(run_id, set_name, service_data)
+            )
+            self.conn.executemany(
+                'INSERT INTO summary VALUES (?, ?, ?, ?, ?, ?)',
+                _iter_rows(run_id, set_name, summary_metrics)
+            )
+            self.conn.execute(
+                "UPDATE runs SET end_date = MAX(COALESCE(end_date, ''), ?) WHERE id = ?",
+                (summary_data.index.max().strftime('%Y-%m-%d'), run_id)
+            )
+
+    def get_history(self, service, metric, set_name=None, date=None, config_name=None):
+        """Value of a summary metric for a service in each run.
+
+        :param date: Date to compare (YYYY-MM). Defaults to the last date of each run.
+        :return: DataFrame with a row per run and set
+        """
+        where = ['summary.service = ?', 'summary.metric = ?']
+        params = [service, metric]
+        if set_name:
+            where.append('summary.set_name = ?')
+            params.append(set_name)
+        if date:
+            where.append('summary.date = ?')
+            params.append(pd.Timestamp(date).strftime('%Y-%m-%d'))
+        else:
+            where.append('summary.date = runs.end_date')
+        if config_name:
+            where.append('runs.config_name = ?')
+            params.append(config_name)
+
+        query = """
+            SELECT runs.id AS run, runs.created, runs.config_name AS config, runs.git_commit AS "commit",
+                   summary.set_name AS "set", summary.date, summary.value
+            FROM summary JOIN runs ON runs.id = summary.run_id
+            WHERE {}
+            ORDER BY runs.id, summary.set_name
+        """.format(' AND '.join(where))
+        return pd.read_sql_query(query, self.conn, params=params)
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
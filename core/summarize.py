@@ -5,16 +5,31 @@ import pandas as pd
 import numpy as np
 from pandas import DataFrame
 
-from core.utils import format_date, to_storage_display_unit, tenth_round
-
-ServiceSummary = namedtuple('ServiceSummary', 'service_summary storage_by_group vm_slabs, vm_aggs')
-SummaryComparison = namedtuple('SummaryComparison', 'storage_by_category storage_by_group compute')
+from core.cost import CUMULATIVE_COST, MONTHLY_COST, get_cost_data, summarize_costs
+from core.utils import format_date, to_storage_display_unit, tenth_round, tier_storage_column, tier_storage_field
+
+# ``cost`` is only included if the config has a price catalog
+ServiceSummary = namedtuple('ServiceSummary', 'service_summary storage_by_group vm_slabs, vm_aggs cost',
+                            defaults=(None,))
+SummaryComparison = namedtuple('SummaryComparison', 'storage_by_category storage_by_group compute cost',
+                               defaults=(None,))
+
+# summary columns that are labels rather than values
+LABEL_COLUMNS = ('VM Type', 'Storage Group', 'Aggregation Key')
+# summary columns that are always whole numbers
+COUNT_COLUMNS = (
+    'Cores Per VM', 'Cores HA', 'Cores Total', 'RAM Per VM', 'RAM HA (GB)', 'RAM Total (GB)',
+    'VMs HA', 'VMs Total', 'VM Buffer', 'OS Storage HA (GB)', 'OS Storage Total (GB)',
+)
+# service data columns that are always whole numbers
+SERVICE_COUNT_COLUMNS = ('users', 'VMs', 'VMs Usage', 'Additional VMs (storage)', 'Additional VMs (RAM)')
 
 
 def incremental_summaries(summary_comparisons, summary_dates):
     storage_by_cat_series = []
     storage_by_group_series = []
     compute_series = []
+    cost_series = []
     keys = [format_date(date) for date in summary_dates]
 
     def _get_incremental(loop_count, keys, data):
@@ -29,23 +44,29 @@ def incremental_summaries(summary_comparisons, summary_dates):
         storage_by_cat_series.append(_get_incremental(i, keys, summary_comparisons.storage_by_category))
         storage_by_group_series.append(_get_incremental(i, keys, summary_comparisons.storage_by_group))
         compute_series.append(_get_incremental(i, keys, summary_comparisons.compute))
+        if summary_comparisons.cost is not None:
+            cost_series.append(_get_incremental(i, keys, summary_comparisons.cost))
 
     storage_by_cat_series.append(summary_comparisons.storage_by_category['Group'])
     return SummaryComparison(
         pd.concat(storage_by_cat_series, axis=1, keys=keys + ['Group']),
         pd.concat(storage_by_group_series, axis=1, keys=keys),
         pd.concat(compute_series, axis=1, keys=keys),
+        pd.concat(cost_series, axis=1, keys=keys) if cost_series else None,
     )
 
 
-def summarize_service_data(config, summary_data, summary_date):
+def summarize_service_data(config, summary_data, summary_date, cost_data=None):
+    """:param cost_data: Optional output of ``get_cost_data`` for the summary data. Pass it in
+                      when summarizing several dates so the costs are only computed once."""
     storage_units = config.storage_display_unit
     to_display = to_storage_display_unit(storage_units)
 
-    summary_by_service = summary_data.T[summary_date].unstack()
+    # selecting the row avoids transposing (and copying) all the summary data
+    summary_by_service = summary_data.loc[summary_date].unstack()
     summary_by_service.sort_index(inplace=True)
 
-    vm_types = summary_by_service.groupby('VM Type')['VMs Total'].sum()
+    vm_types = _group_sum(summary_by_service, 'VM Type', 'VMs Total')
     vm_types.index.name = None
     try:
         del vm_types['NonexNone']
@@ -58,10 +79,12 @@ def summarize_service_data(config, summary_data, summary_date):
     vms_by_type.sort_index(inplace=True)
     summary_by_service.drop('VM Type', axis=1, inplace=True)
 
-    by_type = summary_by_service.groupby('Storage Group')['Data Storage Total (%s)' % storage_units].sum()
+    by_type = _group_sum(summary_by_service, 'Storage Group', 'Data Storage Total (%s)' % storage_units)
     if config.vm_os_storage_group not in by_type:
         by_type[config.vm_os_storage_group] = 0
     by_type[config.vm_os_storage_group] += math.ceil(to_display(summary_by_service['OS Storage Total (Bytes)'].sum()))
+    for group, column in _get_tier_columns(config, summary_by_service.columns).items():
+        by_type[group] = by_type.get(group, 0) + summary_by_service[column].sum()
 
     by_type.index.name = None
     storage_by_group = pd.DataFrame({
@@ -69,7 +92,7 @@ def summarize_service_data(config, summary_data, summary_date):
     })
     storage_by_group.sort_index(inplace=True)
 
-    vm_aggs = summary_by_service.groupby('Aggregation Key')[['Cores Total', 'RAM Total (GB)', 'VMs Total']].sum()
+    vm_aggs = _group_sum(summary_by_service, 'Aggregation Key', ['Cores Total', 'RAM Total (GB)', 'VMs Total'])
     vm_aggs.index.name = None
 
     summary_by_service.drop('OS Storage Total (Bytes)', axis=1, inplace=True)
@@ -77,135 +100,214 @@ def summarize_service_data(config, summary_data, summary_date):
     total.name = 'Total'
     summary_by_service = summary_by_service._append(total, ignore_index=False)
 
-    return ServiceSummary(summary_by_service, storage_by_group, vms_by_type, vm_aggs)
+    cost = None
+    if config.price_catalog:
+        if cost_data is None:
+            cost_data = get_cost_data(config, summary_data)
+        cost = summarize_costs(cost_data, summary_date)
+
+    return ServiceSummary(summary_by_service, storage_by_group, vms_by_type, vm_aggs, cost)
+
+
+def _get_tier_columns(config, columns):
+    """:return: dict of storage group -> summary column for the lifecycle tiers of all services"""
+    tier_columns = OrderedDict()
+    for service_def in config.services.values():
+        for group in service_def.storage.tier_groups:
+            tier_columns[group] = tier_storage_column(group, config.storage_display_unit)
+    return OrderedDict((group, column) for group, column in tier_columns.items() if column in columns)
+
+
+def _group_sum(data, by, columns):
+    grouped = data.groupby(by, observed=True)[columns].sum()
+    if isinstance(grouped.index, pd.CategoricalIndex):
+        grouped.index = grouped.index.astype(object)
+    return grouped
+
+
+def compact_summary_data(summary_data):
+    """Convert the summary data of a service to smaller dtypes:
+
+    * counts (VMs, cores, RAM) to int32 which is exact
+    * labels to categoricals
+    * other values to float32 except 'OS Storage Total (Bytes)' which is rounded up after summing
+
+    float32 values are within a relative error of 2 ** -24 (6e-8) of the float64 values
+    and sums of n values within n * 2 ** -24.
+    """
+    columns = OrderedDict()
+    for column, values in summary_data.items():
+        if column in LABEL_COLUMNS:
+            columns[column] = values.astype('category')
+        elif column in COUNT_COLUMNS and not values.isna().any():
+            columns[column] = values.astype(np.int32)
+        elif column == 'OS Storage Total (Bytes)':
+            columns[column] = values
+        else:
+            columns[column] = values.astype(np.float32)
+    return pd.DataFrame(columns, index=summary_data.index)
 
 
-def get_summary_data(config, service_data):
-    """Compute summary data for each month and each service"""
+def compact_service_data(service_data):
+    """Convert the service data of a service to int32 counts and float32 values"""
+    return pd.concat(OrderedDict(
+        (column, values.astype(
+            np.int32 if column[-1] in SERVICE_COUNT_COLUMNS and not values.isna().any() else np.float32
+        ))
+        for column, values in service_data.items()
+    ), axis=1)
+
 
+def get_summary_dates(config, usage):
+    """Sorted list of dates to summarize at. Defaults to the final date of the usage data."""
+    if config.summary_dates:
+        return sorted(config.summary_date_vals)
+    return [usage.iloc[-1].name]
+
+
+def get_estimation_buffer(config, index):
     # formula for compound growth: start_val * (1 + growth factor)^N
-    ebi = pd.Series(range(0, len(service_data.index)), index=service_data.index)
+    ebi = pd.Series(range(0, len(index)), index=index)
     estimation_buffer = config.estimation_buffer * (1 + config.estimation_growth_factor) ** ebi
-    estimation_buffer = estimation_buffer.map(float)
+    return estimation_buffer.map(float)
+
+
+def get_summary_data(config, service_data):
+    """Compute summary data for each month and each service"""
+    estimation_buffer = get_estimation_buffer(config, service_data.index)
+    summary_df = {
+        service_name: get_service_summary_data(
+            config, service_name, service_def, service_data[service_name], estimation_buffer
+        )
+        for service_name, service_def in config.services.items()
+    }
+    return pd.concat(list(summary_df.values()), axis=1, keys=list(summary_df))
 
+
+def get_service_summary_data(config, service_name, service_def, service_snapshot, estimation_buffer):
+    """Compute summary data for each month for a single service"""
     storage_units = config.storage_display_unit
     to_display = to_storage_display_unit(storage_units)
     to_gb = to_storage_display_unit('GB')
-    summary_df = {}
-    for service_name, service_def in config.services.items():
-        service_snapshot = service_data[service_name]
-        compute = service_snapshot['Compute']
-        data_storage = service_snapshot['Data Storage']['storage']
-        node_buffer = 0 if service_def.static_number else (compute['VMs'] * estimation_buffer).map(np.ceil)
-        vms_suggested = (compute['VMs'] + node_buffer).map(np.ceil)
-        vms_total = pd.DataFrame([
-            vms_suggested,
-            pd.Series([service_def.min_nodes] * len(vms_suggested), index=vms_suggested.index)
-        ]).max()
-
-        storage_estimation_buffer = estimation_buffer
-        if service_def.storage.override_estimation_buffer is not None:
-            storage_estimation_buffer = pd.Series(
-                [float(service_def.storage.override_estimation_buffer)] * len(service_data.index),
-                index=service_data.index
-            )
-        # this is True if 'service_def.min_nodes' is more than what is being suggested
-        vm_total_gt = vms_total > vms_suggested
-        data_storage_buffer = data_storage * storage_estimation_buffer
-
-        min_storage_per_node = service_def.min_storage_per_node_bytes
-        if service_def.storage_scales_with_nodes:
-            # in this case total storage = storage * VM number
-            data_storage_per_vm = data_storage + data_storage_buffer
+
+    compute = service_snapshot['Compute']
+    data_storage = service_snapshot['Data Storage']['storage']
+    node_buffer = 0 if service_def.static_number else (compute['VMs'] * estimation_buffer).map(np.ceil)
+    vms_suggested = (compute['VMs'] + node_buffer).map(np.ceil)
+    vms_total = pd.DataFrame([
+        vms_suggested,
+        pd.Series([service_def.min_nodes] * len(vms_suggested), index=vms_suggested.index)
+    ]).max()
+
+    storage_estimation_buffer = estimation_buffer
+    if service_def.storage.override_estimation_buffer is not None:
+        storage_estimation_buffer = pd.Series(
+            [float(service_def.storage.override_estimation_buffer)] * len(service_snapshot.index),
+            index=service_snapshot.index
+        )
+    # this is True if 'service_def.min_nodes' is more than what is being suggested
+    vm_total_gt = vms_total > vms_suggested
+    data_storage_buffer = data_storage * storage_estimation_buffer
+
+    min_storage_per_node = service_def.min_storage_per_node_bytes
+    if service_def.storage_scales_with_nodes:
+        # in this case total storage = storage * VM number
+        data_storage_per_vm = data_storage + data_storage_buffer
+        data_storage_total = data_storage_per_vm * vms_total
+    elif True in set(vm_total_gt):
+        # in this case 'service_def.min_nodes' is more than what is being suggested
+        # so we want to add storage buffer and then distribute among all the nodes
+        # but only where vm_total_gt = False
+
+        # 1. calculate storage per VM and total for case where ``vms_total <= vms_suggested``
+        # per vm storage = storage / vms_suggested
+        # total storage = per vm storage * vms_total
+        vm_total_lte = np.invert(vm_total_gt)
+        data_storage_per_vm_lt = (data_storage + data_storage_buffer) / compute['VMs'] * vm_total_lte
+        if min_storage_per_node:
+            data_storage_per_vm_lt = data_storage_per_vm_lt.map(lambda x: max(x, min_storage_per_node))
+        data_storage_total_lt = data_storage_per_vm_lt * vms_total * vm_total_lte
+
+        # 2. calculate storage per VM and total for case where ``vms_total > vms_suggested``
+        data_storage_total_gt = (data_storage + data_storage_buffer) * vm_total_gt
+        data_storage_per_vm_gt = data_storage_total_gt / vms_total * vm_total_gt
+        if min_storage_per_node:
+            data_storage_per_vm_gt = data_storage_per_vm_gt.map(lambda x: max(x, min_storage_per_node))
+
+        # combine 1 & 2 and select values according to vm_total_gt
+        data_storage_total = data_storage_total_lt + data_storage_total_gt
+        data_storage_per_vm = data_storage_per_vm_lt + data_storage_per_vm_gt
+    elif not compute['VMs'].any():
+        # if this service doesn't have any compute resources
+        data_storage_total = data_storage + data_storage_buffer
+    else:
+        # data is spread across all VMs
+        data_storage_total = data_storage
+        data_storage_per_vm = data_storage_total / vms_total
+        if min_storage_per_node and any(data_storage_per_vm < min_storage_per_node):
+            data_storage_per_vm = data_storage_per_vm.map(lambda x: max(x, min_storage_per_node))
             data_storage_total = data_storage_per_vm * vms_total
-        elif True in set(vm_total_gt):
-            # in this case 'service_def.min_nodes' is more than what is being suggested
-            # so we want to add storage buffer and then distribute among all the nodes
-            # but only where vm_total_gt = False
-
-            # 1. calculate storage per VM and total for case where ``vms_total <= vms_suggested``
-            # per vm storage = storage / vms_suggested
-            # total storage = per vm storage * vms_total
-            vm_total_lte = np.invert(vm_total_gt)
-            data_storage_per_vm_lt = (data_storage + data_storage_buffer) / compute['VMs'] * vm_total_lte
-            if min_storage_per_node:
-                data_storage_per_vm_lt = data_storage_per_vm_lt.map(lambda x: max(x, min_storage_per_node))
-            data_storage_total_lt = data_storage_per_vm_lt * vms_total * vm_total_lte
-
-            # 2. calculate storage per VM and total for case where ``vms_total > vms_suggested``
-            data_storage_total_gt = (data_storage + data_storage_buffer) * vm_total_gt
-            data_storage_per_vm_gt = data_storage_total_gt / vms_total * vm_total_gt
-            if min_storage_per_node:
-                data_storage_per_vm_gt = data_storage_per_vm_gt.map(lambda x: max(x, min_storage_per_node))
-
-            # combine 1 & 2 and select values according to vm_total_gt
-            data_storage_total = data_storage_total_lt + data_storage_total_gt
-            data_storage_per_vm = data_storage_per_vm_lt + data_storage_per_vm_gt
-        elif not compute['VMs'].any():
-            # if this service doesn't have any compute resources
-            data_storage_total = data_storage + data_storage_buffer
-        else:
-            # data is spread across all VMs
-            data_storage_total = data_storage
-            data_storage_per_vm = data_storage_total / vms_total
-            if min_storage_per_node and any(data_storage_per_vm < min_storage_per_node):
-                data_storage_per_vm = data_storage_per_vm.map(lambda x: max(x, min_storage_per_node))
-                data_storage_total = data_storage_per_vm * vms_total
-
-        zero = pd.Series([0] * len(vms_suggested), index=vms_suggested.index)
-        include_ha_resources = service_def.include_ha_resources
-        data_storage_ha = data_storage_total if include_ha_resources else zero.copy()
-        data_storage_total = data_storage_total + data_storage_ha
-
-        cores = vms_total * service_def.process.cores_per_node if vms_total.any() else zero.copy()
-        cores_ha = cores if include_ha_resources else zero.copy()
-        cores_total = cores + cores_ha
-
-        ram = vms_total * service_def.process.ram_per_node if vms_total.any() else zero.copy()
-        ram_ha = ram if include_ha_resources else zero.copy()
-        ram_total = ram + ram_ha
-
-        vms_ha = vms_total.copy() if include_ha_resources else zero.copy()
-        vms_total = vms_total + vms_ha
-
-        os_storage = vms_total * config.vm_os_storage_gb * (1000.0 ** 3)
-        os_storage_ha = vms_ha * config.vm_os_storage_gb * (1000.0 ** 3)
-        if service_def.process.cores_per_node:
-            vm_type = '{}x{}'.format(service_def.process.cores_per_node, service_def.process.ram_per_node)
-        else:
-            vm_type = ''
-        data = OrderedDict([
-            ('VM Type', vm_type),
-            ('Cores Per VM', service_def.process.cores_per_node),
-            ('Cores HA', cores_ha),
-            ('Cores Total', cores_total),
-            ('RAM Per VM', service_def.process.ram_per_node),
-            ('RAM HA (GB)', ram_ha),
-            ('RAM Total (GB)', ram_total),
-            ('Data Storage Per VM (GB)', tenth_round(to_gb((data_storage_per_vm) if compute['VMs'].any() else zero.copy()))),
-            ('Data Storage HA (%s)' % storage_units, tenth_round(to_display((data_storage_ha).map(np.ceil)))),
-            ('Data Storage Total (%s)' % storage_units, tenth_round(to_display((data_storage_total).map(np.ceil)))),
-            ('Data Storage RAW (includes HA) (%s)' % storage_units, to_display(data_storage + data_storage_ha)),
-            ('VMs HA', vms_ha),
-            ('VMs Total', vms_total),
-            ('VM Buffer', node_buffer),
-            ('Buffer %', estimation_buffer),
-            ('OS Storage HA (GB)', (to_gb(os_storage_ha)).map(np.ceil)),
-            ('OS Storage Total (Bytes)', os_storage),
-            ('OS Storage Total (GB)', (to_gb(os_storage)).map(np.ceil)),
-            ('Storage Group', service_def.storage.group),
-            ('Aggregation Key', service_def.aggregation_key or service_name),
-        ])
-        combined = pd.DataFrame(data=data)
-        summary_df[service_name] = combined
 
-    return pd.concat(list(summary_df.values()), axis=1, keys=list(summary_df))
+    zero = pd.Series([0] * len(vms_suggested), index=vms_suggested.index)
+    include_ha_resources = service_def.include_ha_resources
+    data_storage_ha = data_storage_total if include_ha_resources else zero.copy()
+    data_storage_total = data_storage_total + data_storage_ha
+
+    cores = vms_total * service_def.process.cores_per_node if vms_total.any() else zero.copy()
+    cores_ha = cores if include_ha_resources else zero.copy()
+    cores_total = cores + cores_ha
+
+    ram = vms_total * service_def.process.ram_per_node if vms_total.any() else zero.copy()
+    ram_ha = ram if include_ha_resources else zero.copy()
+    ram_total = ram + ram_ha
+
+    vms_ha = vms_total.copy() if include_ha_resources else zero.copy()
+    vms_total = vms_total + vms_ha
+
+    os_storage = vms_total * config.vm_os_storage_gb * (1000.0 ** 3)
+    os_storage_ha = vms_ha * config.vm_os_storage_gb * (1000.0 ** 3)
+    if service_def.process.cores_per_node:
+        vm_type = '{}x{}'.format(service_def.process.cores_per_node, service_def.process.ram_per_node)
+    else:
+        vm_type = ''
+    data = OrderedDict([
+        ('VM Type', vm_type),
+        ('Cores Per VM', service_def.process.cores_per_node),
+        ('Cores HA', cores_ha),
+        ('Cores Total', cores_total),
+        ('RAM Per VM', service_def.process.ram_per_node),
+        ('RAM HA (GB)', ram_ha),
+        ('RAM Total (GB)', ram_total),
+        ('Data Storage Per VM (GB)', tenth_round(to_gb((data_storage_per_vm) if compute['VMs'].any() else zero.copy()))),
+        ('Data Storage HA (%s)' % storage_units, tenth_round(to_display((data_storage_ha).map(np.ceil)))),
+        ('Data Storage Total (%s)' % storage_units, tenth_round(to_display((data_storage_total).map(np.ceil)))),
+        ('Data Storage RAW (includes HA) (%s)' % storage_units, to_display(data_storage + data_storage_ha)),
+        ('VMs HA', vms_ha),
+        ('VMs Total', vms_total),
+        ('VM Buffer', node_buffer),
+        ('Buffer %', estimation_buffer),
+        ('OS Storage HA (GB)', (to_gb(os_storage_ha)).map(np.ceil)),
+        ('OS Storage Total (Bytes)', os_storage),
+        ('OS Storage Total (GB)', (to_gb(os_storage)).map(np.ceil)),
+    ])
+    for group in service_def.storage.tier_groups:
+        tier_storage = service_snapshot['Data Storage'][tier_storage_field(group)] * (1 + storage_estimation_buffer)
+        data[tier_storage_column(group, storage_units)] = tenth_round(to_display(tier_storage.map(np.ceil)))
+    data.update([
+        ('Storage Group', service_def.storage.group),
+        ('Aggregation Key', service_def.aggregation_key or service_name),
+    ])
+    summary_data = pd.DataFrame(data=data)
+    if config.compact_dtypes:
+        return compact_summary_data(summary_data)
+    return summary_data
 
 
 def compare_summaries(config, summaries_by_date):
     data_storage_series = []
     storage_by_group_series = []
     compute_series = []
+    cost_series = []
     storage_units = config.storage_display_unit
     for date in summaries_by_date:
         summary_data = summaries_by_date[date]
@@ -214,6 +316,8 @@ def compare_summaries(config, summaries_by_date):
         compute = summary_data.service_summary[['Cores Total', 'RAM Total (GB)', 'VMs Total']]
         compute = compute.rename({'Cores Total': 'Cores', 'RAM Total (GB)': 'RAM (GB)', 'VMs Total': 'VMs'}, axis=1)
         compute_series.append(compute)
+        if summary_data.cost is not None:
+            cost_series.append(summary_data.cost[[MONTHLY_COST, CUMULATIVE_COST]])
 
     first_date = list(summaries_by_date)[0]
     group_series = summaries_by_date[first_date].service_summary['Storage Group']
@@ -229,4 +333,6 @@ def compare_summaries(config, summaries_by_date):
 
     compute = pd.concat(compute_series, axis=1, keys=keys)
     compute = compute[compute > 0].dropna()
-    return SummaryComparison(storage_by_cat, storage_by_group, compute)
+
+    cost = pd.concat(cost_series, axis=1, keys=keys) if cost_series else None
+    return SummaryComparison(storage_by_cat, storage_by_group, compute, cost)
@@ -0,0 +1,76 @@
+"""Survival curves for items with varying lifespans.
+
+A survival curve gives the fraction of items that are still live at each age
+(in months) where age 0 is the month the items are created. The number of live
+items is the convolution of the monthly new items with the survival curve
+which is computed with an FFT so that long horizons stay fast.
+"""
+import functools
+import math
+
+import numpy as np
+
+from core.utils import apply_context
+
+
+def _lognormal_survival(ages, median, sigma):
+    ages = np.maximum(ages, 1e-12)
+    z = (np.log(ages) - math.log(median)) / (sigma * math.sqrt(2))
+    return 0.5 * np.array([math.erfc(value) for value in z])
+
+
+# distribution type -> (function of ages, names of the parameters)
+DISTRIBUTIONS = {
+    'fixed': (lambda ages, lifespan: (ages < lifespan).astype(float), ['lifespan']),
+    'exponential': (lambda ages, mean: np.exp(-ages / mean), ['mean']),
+    'weibull': (lambda ages, scale, shape: np.exp(-(ages / scale) ** shape), ['scale', 'shape']),
+    'lognormal': (_lognormal_survival, ['median', 'sigma']),
+}
+
+
+def survival_from_distribution(context, distribution, length):
+    """Survival curve for a lifespan distribution.
+
+    :param distribution: dict with the distribution ``type`` and its parameters in months
+                         e.g. {'type': 'exponential', 'mean': 6}
+    :param length: number of months
+    """
+    distribution = dict(distribution)
+    distribution_type = distribution.pop('type', None)
+    if distribution_type not in DISTRIBUTIONS:
+        raise ValueError('Unknown distribution type "{}". Expected one of: {}'.format(
+            distribution_type, ', '.join(DISTRIBUTIONS)
+        ))
+    func, param_names = DISTRIBUTIONS[distribution_type]
+    if set(distribution) != set(param_names):
+        raise ValueError('The "{}" distribution requires: {}'.format(distribution_type, ', '.join(param_names)))
+    params = [apply_context(context, distribution[name], float) for name in param_names]
+    return func(np.arange(length, dtype=np.float64), *params)
+
+
+def survival_from_curve(context, survival, length):
+    """Survival curve from a list of the fraction of items live at each age.
+    Items are removed after the last age in the list."""
+    curve = np.zeros(length)
+    values = [apply_context(context, value, float) for value in survival[:length]]
+    curve[:len(values)] = values
+    return curve
+
+
+@functools.lru_cache(maxsize=128)
+def _survival_spectrum(curve, fft_size):
+    return np.fft.rfft(curve, fft_size)
+
+
+def live_items(new_items, survival):
+    """Number of live items in each month.
+
+    :param new_items: array of the number of items created each month
+    :param survival: survival curve with the same length as ``new_items``
+    """
+    length = len(new_items)
+    # zero pad to avoid wrapping around and round up to a power of 2 for speed
+    fft_size = 1 << (2 * length - 1).bit_length()
+    # the spectrum of the survival curve is shared between sets with the same curve
+    spectrum = _survival_spectrum(tuple(survival), fft_size)
+    return np.fft.irfft(np.fft.rfft(new_items, fft_size) * spectrum, fft_size)[:length]
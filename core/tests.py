@@ -1,11 +1,49 @@
+import asyncio
+import itertools
+import json
+import os
+import socket
+import tempfile
+import sqlite3
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
 from io import StringIO
-from unittest import TestCase
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client
+from unittest import TestCase, mock
+from unittest.mock import ANY
 
+import numpy as np
 import pandas as pd
-from pandas.util.testing import assert_frame_equal
+import yaml
+from pandas.testing import assert_frame_equal
 
-from core.models import CumulativeModel, LimitedLifetimeModel, DerivedSum, \
-    DerivedFactor, DateValueModel, BaselineWithGrowth, DerivedProduct
+from core.api import Model
+from core.autoscale import rolling_max, simulate_autoscaling, simulate_nodes
+from core.calibrate import calibrate, levenberg_marquardt, write_fitted_config
+from core.collect import ResultCache, get_overrides, load_queries, reduce_es, run_queries, select_queries
+from core.capacity import CapacityConfig, forecast_exhaustion, get_monthly_demand
+from core.config import ClusterConfig, AutoscalingDef, config_for_set, config_to_json, config_from_path, \
+    get_config_root, merge_config_data
+from core.cost import get_cost_data, get_price_series
+from core.cube import CubeWriter, SummaryCube
+from core.diff import diff_configs
+from core.distributed import Coordinator, run_worker, get_set_snapshot
+from core.emulator import Emulator, ParameterRange, fit_emulator, latin_hypercube, run_samples
+from core.generate import generate_usage_data, generate_service_data, get_service_and_summary_data, \
+    get_service_data, get_age_buckets
+from core.parallel import generate_service_summary_data
+from core.procurement import plan_procurement
+from core.server import ModelServer
+from core.queueing import erlang_c, required_servers, wait_probability, SECONDS_PER_MONTH
+from core.summarize import compare_summaries, get_summary_data, summarize_service_data
+from core.sets import iter_combined_sets, count_combined_sets
+from core.solve import solve_max_value
+from core.store import ResultsStore
+from core.writers import HTMLWriter
+from core.models import models_by_slug, CumulativeModel, LimitedLifetimeModel, DerivedSum, \
+    DerivedFactor, DateValueModel, BaselineWithGrowth, DerivedProduct, ExpressionModel, SurvivalModel, \
+    DerivedModel
 
 
 class UsageModelTests(TestCase):
@@ -20,12 +58,12 @@ class UsageModelTests(TestCase):
         assert_frame_equal(result, self._from_csv(expected))
 
     def test_date_value(self):
-        m = DateValueModel('test', [
+        m = DateValueModel({}, 'test', [
             ['20180101', 10],
             ['20180201', 20],
             ['20180301', 30],
         ])
-        frame = m.data_frame(None)
+        frame = m.data_frame(pd.DataFrame())
         expected = """,test
             2018-01-01,10
             2018-02-01,20
@@ -34,16 +72,18 @@ class UsageModelTests(TestCase):
         assert_frame_equal(frame, self._from_csv(expected))
 
     def _from_csv(self, expected):
-        return pd.read_csv(StringIO(expected), index_col=0, parse_dates=True)
+        df = pd.read_csv(StringIO(expected), index_col=0, parse_dates=True)
+        df.index = pd.DatetimeIndex(df.index, freq='infer')
+        return df
 
     def test_can_run(self):
-        model = DerivedFactor('forms', dependant_field='users', factor=1)
+        model = DerivedFactor({}, 'forms', dependant_field='users', factor=1)
         self.assertFalse(model.can_run(pd.DataFrame()))
         self.assertTrue(model.can_run(_get_user_data()))
 
     def test_cumulative(self):
         user_data = _get_user_data()
-        result = CumulativeModel('total', dependant_field='users').data_frame(user_data)
+        result = CumulativeModel({}, 'total', dependant_field='users').data_frame(user_data)
         expected = """,total
             2017-01-01,100
             2017-02-01,200
@@ -54,7 +94,7 @@ class UsageModelTests(TestCase):
 
     def test_cumulative_limited_lifespan(self):
         user_data = _get_user_data()
-        result = LimitedLifetimeModel('total_live', dependant_field='users', lifespan=2).data_frame(user_data)
+        result = LimitedLifetimeModel({}, 'total_live', dependant_field='users', lifespan=2).data_frame(user_data)
         expected = """,total_live
             2017-01-01,100
             2017-02-01,200
@@ -63,11 +103,42 @@ class UsageModelTests(TestCase):
         """
         assert_frame_equal(result, self._from_csv(expected))
 
+    def test_cumulative_survival_curve(self):
+        user_data = _get_user_data()
+        result = SurvivalModel({}, 'total_live', dependant_field='users', survival=[1, 0.5]).data_frame(user_data)
+        expected = """,total_live
+            2017-01-01,100
+            2017-02-01,150
+            2017-03-01,250
+            2017-04-01,300
+        """
+        assert_frame_equal(result, self._from_csv(expected))
+
+    def test_cumulative_survival_fixed_matches_limited_lifespan(self):
+        user_data = _get_user_data()
+        fixed = SurvivalModel({}, 'total_live', 'users', distribution={'type': 'fixed', 'lifespan': 2})
+        limited = LimitedLifetimeModel({}, 'total_live', dependant_field='users', lifespan=2)
+        assert_frame_equal(fixed.data_frame(user_data), limited.data_frame(user_data))
+
+    def test_cumulative_survival_distribution(self):
+        index = pd.date_range('2017-01-01', periods=240, freq='MS')
+        new_items = pd.DataFrame({'cases': np.arange(240) * 1000}, index=index)
+        model = SurvivalModel({'mean': 6}, 'cases_live', 'cases', distribution={'type': 'exponential', 'mean': '{mean}'})
+        result = model.data_frame(new_items)['cases_live']
+        expected = np.convolve(new_items['cases'], np.exp(-np.arange(240) / 6))[:240]
+        self.assertEqual(list(result), list(np.rint(expected).astype(int)))
+
+    def test_cumulative_survival_requires_one_of_survival_or_distribution(self):
+        with self.assertRaises(ValueError):
+            SurvivalModel({}, 'live', 'users')
+        with self.assertRaises(ValueError):
+            SurvivalModel({}, 'live', 'users', survival=[1], distribution={'type': 'exponential', 'mean': 2})
+
     def test_derived_sum(self):
         user_data = _get_user_data()
-        forms = DerivedFactor('forms', 'users', 5).data_frame(user_data)
+        forms = DerivedFactor({}, 'forms', 'users', 5).data_frame(user_data)
         user_forms = pd.concat([user_data, forms], axis=1)
-        result = DerivedSum('sum', dependant_fields=['users', 'forms']).data_frame(user_forms)
+        result = DerivedSum({}, 'sum', dependant_fields=['users', 'forms']).data_frame(user_forms)
         expected = """,sum
             2017-01-01,600
             2017-02-01,600
@@ -77,13 +148,13 @@ class UsageModelTests(TestCase):
         assert_frame_equal(result, self._from_csv(expected))
 
     def test_derived_product(self):
-        factor = DateValueModel('factor', [
+        factor = DateValueModel({}, 'factor', [
             ['20170101', '20170201', 2],
             ['20170301', '20170401', 5],
         ]).data_frame(pd.DataFrame())
         user_data = _get_user_data(factor)
         print(user_data)
-        result = DerivedProduct('product', ['users', 'factor']).data_frame(user_data)
+        result = DerivedProduct({}, 'product', ['users', 'factor']).data_frame(user_data)
         expected = """,product
             2017-01-01,200
             2017-02-01,200
@@ -94,7 +165,7 @@ class UsageModelTests(TestCase):
 
     def test_derived_factor(self):
         user_data = _get_user_data()
-        result = DerivedFactor('2x', dependant_field='users', factor=2).data_frame(user_data)
+        result = DerivedFactor({}, '2x', dependant_field='users', factor=2).data_frame(user_data)
         expected = """,2x
             2017-01-01,200
             2017-02-01,200
@@ -105,7 +176,7 @@ class UsageModelTests(TestCase):
 
     def test_baseline_with_growth(self):
         user_data = _get_user_data()
-        result = BaselineWithGrowth('bg', 'users', 10, 2, 50).data_frame(user_data)
+        result = BaselineWithGrowth({}, 'bg', 'users', 10, 2, 50).data_frame(user_data)
         # month, value = baseline x users + startwith + monthly usage cumulative
         # 2017-01-01, 1250 = 1000 + 50 + 200
         # 2017-02-01, 1450 = 1000 + 50 + 200 + 200
@@ -119,9 +190,1013 @@ class UsageModelTests(TestCase):
         """
         assert_frame_equal(result, self._from_csv(expected))
 
+    def test_expression(self):
+        user_data = _get_user_data()
+        model = ExpressionModel({'factor': 3}, 'expr', 'users * {factor} + max(users, 150) / 10', start_with=5)
+        self.assertEqual(model.dependant_fields, ['users'])
+        result = model.data_frame(user_data)
+        expected = """,expr
+            2017-01-01,320.0
+            2017-02-01,315.0
+            2017-03-01,620.0
+            2017-04-01,620.0
+        """
+        assert_frame_equal(result, self._from_csv(expected))
+
+    def test_expression_rejects_unsafe_syntax(self):
+        for expression in ['__import__("os")', 'users.sum()', 'users[0]', 'lambda: 1']:
+            with self.assertRaises(ValueError):
+                ExpressionModel({}, 'expr', expression)
+
+
+class SetsTests(TestCase):
+    def test_combined_sets(self):
+        sets = {
+            'users': [{'name': '{users}u', 'users': {'range': [100, 300, 100]}}],
+            'forms': [{'name': 'a', 'forms': 1}, {'name': 'b', 'forms': 2}],
+            'size': [{'name': 'size', 'size': {'logspace': [1, 100, 3]}}],
+        }
+        self.assertEqual(count_combined_sets(sets), 18)
+        combined = iter_combined_sets(sets)
+        self.assertEqual(next(combined), {'name': '100u-a-size-1', 'users': 100, 'forms': 1, 'size': 1})
+        self.assertEqual(
+            [s['name'] for s in itertools.islice(combined, 5)],
+            ['100u-a-size-10', '100u-a-size-100', '100u-b-size-1', '100u-b-size-10', '100u-b-size-100']
+        )
+        self.assertEqual(len(list(combined)), 12)
+
+
+class ConfigOverlayTests(TestCase):
+    def test_merge_config_data(self):
+        base = {'usage': {'users': {'model': 'a', 'value': 1}, 'forms': {'model': 'b'}}, 'services': {'web': {}}}
+        merged = merge_config_data(base, {'usage': {'users': {'value': 2}, 'forms': None}, 'services': {'db': {}}})
+        self.assertEqual(merged, {'usage': {'users': {'model': 'a', 'value': 2}}, 'services': {'web': {}, 'db': {}}})
+        # the base is not modified
+        self.assertEqual(base['usage']['users']['value'], 1)
+        self.assertIn('forms', base['usage'])
+
+    def test_extends(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            base_path = os.path.join(tmpdir, 'base.yml')
+            with open(base_path, 'w') as f:
+                yaml.safe_dump(config_to_json(_get_test_config()), f, sort_keys=False)
+            os.mkdir(os.path.join(tmpdir, 'overlays'))
+            overlay_path = os.path.join(tmpdir, 'overlays', 'overlay.yml')
+            with open(overlay_path, 'w') as f:
+                yaml.safe_dump({
+                    'extends': '../base.yml',
+                    'services': {'db': {'usage_capacity_per_node': 500}},
+                }, f)
+
+            config = config_from_path(overlay_path)
+            self.assertEqual(config.services['db'].usage_capacity_per_node, 500)
+            self.assertEqual(config.services['db'].process.cores_per_node, 4)
+            self.assertEqual(list(config.services), ['web', 'db'])
+            self.assertEqual(get_config_root(overlay_path), base_path)
+            # each config is a copy of the cached data
+            config.services['db'].usage_capacity_per_node = 1
+            self.assertEqual(config_from_path(overlay_path).services['db'].usage_capacity_per_node, 500)
+
+            usage_cache = {}
+            service_cache = {}
+            set_context = next(iter_combined_sets(config.sets))
+            with mock.patch('core.generate.get_service_data', wraps=get_service_data) as compute:
+                for path in (base_path, overlay_path):
+                    config = config_from_path(path)
+                    usage = generate_usage_data(config, set_context, usage_cache)
+                    get_service_and_summary_data(config, usage, service_cache)
+            # web is the same in both configs so is only computed once
+            self.assertEqual([call.args[1] for call in compute.call_args_list], ['web', 'db', 'db'])
+
+            with open(base_path, 'w') as f:
+                yaml.safe_dump({'extends': 'overlays/overlay.yml'}, f)
+            with self.assertRaisesRegex(ValueError, 'Circular'):
+                config_from_path(overlay_path)
+
+
+    def test_usage_cache_with_different_dates(self):
+        def _usage(start, end):
+            return {
+                'users': {'model': 'date_range_value', 'ranges': [[start, end, 100]]},
+                'forms': {'model': 'expression', 'expression': '5'},
+            }
+
+        usage_cache = {}
+        set_context = {'name': 'default'}
+        base = generate_usage_data(_get_test_config(usage=_usage('20170101', '20170401')), set_context, usage_cache)
+        overlay = generate_usage_data(_get_test_config(usage=_usage('20180101', '20180401')), set_context, usage_cache)
+        self.assertEqual(overlay.index[0], pd.Timestamp('2018-01-01'))
+        self.assertEqual(list(overlay['forms']), [5] * 4)
+        self.assertEqual(len(usage_cache), 4)
+        self.assertEqual(list(base['forms']), [5] * 4)
+
+
+class ServiceTemplateTests(TestCase):
+    def _get_config(self):
+        return _get_test_config(
+            sets={
+                'users': [{'name': '{users}u', 'users': {'range': [100, 200, 100]}}],
+                'hardware': [{'name': 'small', 'cores': 2, 'capacity': 100}, {'name': 'big', 'cores': 8, 'capacity': 400}],
+            },
+            services={
+                'web': {
+                    'usage_capacity_per_node': '{capacity}',
+                    'process': {'cores_per_node': '{cores}', 'ram_per_node': 4},
+                    'storage': {'group': 'SSD', 'static_baseline': '{cores}0GB'},
+                },
+                'db': {
+                    'usage_capacity_per_node': 1000,
+                    'usage_field': 'forms',
+                    'process': {'cores_per_node': 4, 'ram_per_node': 16},
+                    'storage': {'group': 'SSD', 'data_models': [{'referenced_field': 'forms_total', 'unit_size': '1MB'}]},
+                },
+            },
+        )
+
+    def test_config_for_set(self):
+        config = self._get_config()
+        # resolved with the first set by default
+        self.assertEqual(config.services['web'].usage_capacity_per_node, 100)
+        self.assertEqual(config_to_json(config)['services']['web']['usage_capacity_per_node'], '{capacity}')
+
+        set_config = config_for_set(config, {'name': '100u-big', 'users': 100, 'cores': 8, 'capacity': 400})
+        web = set_config.services['web']
+        self.assertEqual((web.usage_capacity_per_node, web.process.cores_per_node), (400, 8))
+        self.assertEqual(web.storage.static_baseline_bytes, 80 * 1000 ** 3)
+        self.assertIs(config_for_set(_get_test_config(), {'name': 'default'}).__class__, ClusterConfig)
+
+    def test_no_sets(self):
+        with self.assertRaises(ValueError):
+            _get_test_config(sets={}, services=self._get_config()._service_templates)
+
+    def test_unaffected_services_reused(self):
+        config = self._get_config()
+        cache = {}
+        results = {}
+        computed = []
+        for set_context in iter_combined_sets(config.sets):
+            set_config = config_for_set(config, set_context)
+            usage = generate_usage_data(set_config, set_context)
+            with mock.patch('core.generate.get_service_data', side_effect=get_service_data) as service_data_mock:
+                results[set_context['name']] = get_service_and_summary_data(set_config, usage, cache)
+            computed.append([call[0][1] for call in service_data_mock.call_args_list])
+            expected = get_summary_data(set_config, generate_service_data(set_config, usage))
+            assert_frame_equal(results[set_context['name']][1], expected)
+
+        small, big = results['100u-small'][1], results['100u-big'][1]
+        self.assertEqual(list(small['web']['VMs Total']), [2, 2, 2, 2])
+        self.assertEqual(list(big['web']['VMs Total']), [2, 2, 2, 2])
+        self.assertEqual(list(small['web']['Cores Total']), [4, 4, 4, 4])
+        self.assertEqual(list(big['web']['Cores Total']), [16, 16, 16, 16])
+        # the db service doesn't use the hardware variables so it is only computed once per user count
+        self.assertEqual(computed, [['web', 'db'], ['web'], ['web', 'db'], ['web']])
+
+
+class ApiTests(TestCase):
+    def test_lazy_result(self):
+        model = Model(_get_test_config())
+        self.assertEqual(model.set_names, ['100u', '200u', '300u', '400u', '500u'])
+        result = model.run(set='300u')
+        self.assertEqual(result.value('web', 'VMs Total', '2017-04'), 4)
+        # only the web service and the usage it needs are computed
+        self.assertEqual(list(result._services), ['web'])
+        self.assertNotIn('usage', result.__dict__)
+        self.assertEqual(list(model.usage_cache), [('users', 'date_range_value', ANY, (), ())])
+
+        usage = generate_usage_data(result.config, result.set_context)
+        summary_data = get_summary_data(result.config, generate_service_data(result.config, usage))
+        assert_frame_equal(result.usage, usage)
+        assert_frame_equal(result.summary_data, summary_data)
+        self.assertEqual(result.summary_dates, [pd.Timestamp('2017-04-01')])
+        expected = summarize_service_data(result.config, summary_data, pd.Timestamp('2017-04-01'))
+        assert_frame_equal(result.summary().service_summary, expected.service_summary)
+        self.assertIs(result.summary('2017-04'), result.summary())
+        self.assertEqual(list(result.comparison().compute.columns.get_level_values(0).unique()), ['2017-04-01'])
+
+    def test_run_all(self):
+        results = list(Model(_get_test_config()).run_all())
+        self.assertEqual([result.value('web', 'VMs Total') for result in results], [2, 3, 4, 5, 6])
+
+    def test_unknown_set(self):
+        with self.assertRaisesRegex(ValueError, 'Set "missing" not found'):
+            Model(_get_test_config()).run(set='missing')
+        model = Model(_get_test_config(sets={}))
+        self.assertEqual(model.run().name, 'default')
+        self.assertEqual(model.run(set='default').name, 'default')
+        with self.assertRaisesRegex(ValueError, 'Set "missing" not found'):
+            model.run(set='missing')
+
+
+class CompactDtypesTests(TestCase):
+    def test_compact_summary(self):
+        config = _get_test_config()
+        compact_config = _get_test_config(compact_dtypes=True)
+        usage = generate_usage_data(config, {'name': 'test', 'users': 300})
+        service_data, summary_data = get_service_and_summary_data(config, usage)
+        compact_service_data, compact_summary_data = get_service_and_summary_data(compact_config, usage)
+
+        self.assertEqual(compact_service_data[('web', 'Compute', 'VMs')].dtype, np.int32)
+        self.assertEqual(compact_summary_data[('web', 'VMs Total')].dtype, np.int32)
+        self.assertEqual(compact_summary_data[('db', 'Data Storage Total (GB)')].dtype, np.float32)
+        self.assertEqual(compact_summary_data[('db', 'Storage Group')].dtype, 'category')
+        self.assertLess(compact_summary_data.memory_usage(deep=True).sum(), summary_data.memory_usage(deep=True).sum())
+
+        date = usage.index[-1]
+        summary = summarize_service_data(config, summary_data, date)
+        compact_summary = summarize_service_data(compact_config, compact_summary_data, date)
+        labels = ['Storage Group', 'Aggregation Key']
+        assert_frame_equal(
+            compact_summary.service_summary.drop(columns=labels).astype(float),
+            summary.service_summary.drop(columns=labels).astype(float),
+            rtol=1e-6
+        )
+        assert_frame_equal(compact_summary.vm_slabs, summary.vm_slabs, check_dtype=False)
+        assert_frame_equal(compact_summary.vm_aggs, summary.vm_aggs, check_dtype=False)
+
+
+class ServerTests(TestCase):
+    def _run(self, coroutine_function):
+        server = ModelServer({'test': Model(_get_test_config())})
+
+        async def _run():
+            http_server = await server.start('127.0.0.1', 0)
+            port = http_server.sockets[0].getsockname()[1]
+            async with http_server:
+                return await coroutine_function(server, port)
+
+        try:
+            return asyncio.run(_run())
+        finally:
+            server.close()
+
+    @staticmethod
+    async def _get(port, path):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(f'GET {path} HTTP/1.1\r\nConnection: close\r\n\r\n'.encode('latin1'))
+        response = await reader.read()
+        writer.close()
+        head, _, body = response.partition(b'\r\n\r\n')
+        return int(head.split()[1]), json.loads(body)
+
+    def test_queries(self):
+        async def _queries(server, port):
+            path = '/value?set=300u&service=web&metric=VMs%20Total&date=2017-04'
+            responses = await asyncio.gather(*[self._get(port, path) for i in range(5)])
+            # concurrent identical queries are computed once
+            self.assertEqual(responses, [(200, {'value': 4})] * 5)
+            self.assertEqual(server.computations, 1)
+            self.assertEqual(await self._get(port, path), (200, {'value': 4}))
+            self.assertEqual(server.computations, 1)
+
+            self.assertEqual(await self._get(port, path + '&override.users=500'), (200, {'value': 6}))
+            status, usage = await self._get(port, '/usage?set=200u&field=forms')
+            self.assertEqual(usage['data']['2017-01-01'], 2000)
+            status, comparison = await self._get(port, '/comparison')
+            self.assertEqual(comparison['compute']['index'], ['db', 'web', 'Total'])
+            self.assertEqual(len(comparison['compute']['columns']), 15)
+
+            self.assertEqual((await self._get(port, '/value?config=other&service=web&metric=VMs%20Total'))[0], 404)
+            self.assertEqual((await self._get(port, '/value?set=100u'))[0], 400)
+            self.assertEqual((await self._get(port, '/value?set=unknown&service=web&metric=VMs%20Total'))[0], 400)
+            # overrides of variables the config doesn't use would be ignored
+            status, response = await self._get(port, path + '&override.forms_per_user=5')
+            self.assertEqual(status, 400)
+            self.assertIn('Unknown set variables: forms_per_user', response['error'])
+        self._run(_queries)
+
+    def test_invalid_requests(self):
+        server = ModelServer({'test': Model(_get_test_config())})
+
+        def _post(body):
+            return asyncio.run(server.handle_request('POST', '/value?service=web&metric=VMs%20Total', body))[0]
+
+        try:
+            for body in (b'{"set": ["a"]}', b'{"overrides": {"users": [1, 2]}}', b'{"overrides": [1]}', b'[1]', b'{'):
+                self.assertEqual(_post(body), 400, body)
+            self.assertEqual(_post(b'{"overrides": {"users": 500}}'), 200)
+
+            server.query_value = None
+            with self.assertLogs('core.server', 'ERROR'):
+                self.assertEqual(_post(b'{"set": "300u"}'), 500)
+        finally:
+            server.close()
+
+
+class DistributedTests(TestCase):
+    def test_coordinator_with_local_workers(self):
+        config = _get_test_config()
+        sets = list(iter_combined_sets(config.sets))
+        coordinator = Coordinator(config, sets, ('localhost', 0), authkey=b'test', shard_size=2)
+        address = coordinator.address
+
+        def _flaky_worker():
+            # take a shard then disconnect without answering
+            with Client(address, authkey=b'test') as conn:
+                conn.recv()
+                conn.recv()
+
+        results = {}
+        coordinator_thread = threading.Thread(target=lambda: results.update(snapshots=coordinator.run(timeout=60)))
+        coordinator_thread.start()
+        # connections that aren't workers don't stop the coordinator accepting workers
+        socket.create_connection(address).close()
+        with self.assertRaises(AuthenticationError):
+            Client(address, authkey=b'wrong')
+
+        threads = [threading.Thread(target=_flaky_worker)] + [
+            threading.Thread(target=run_worker, args=(address, b'test')) for i in range(2)
+        ]
+        for thread in threads:
+            thread.start()
+        coordinator_thread.join()
+        for thread in threads:
+            thread.join()
+        snapshots = results['snapshots']
+
+        self.assertEqual(list(snapshots), [s['name'] for s in sets])
+        expected = get_set_snapshot(config, sets[-1])
+        assert_frame_equal(snapshots[sets[-1]['name']].service_summary, expected.service_summary)
+
+
+class ParallelTests(TestCase):
+    def test_parallel_matches_serial(self):
+        config = _get_test_config()
+        usage = generate_usage_data(config, {'name': 'test', 'users': 300})
+        service_data = generate_service_data(config, usage)
+        summary_data = get_summary_data(config, service_data)
+
+        parallel_service_data, parallel_summary_data = generate_service_summary_data(config, usage, 2)
+        assert_frame_equal(parallel_service_data, service_data, check_dtype=False)
+        assert_frame_equal(parallel_summary_data, summary_data, check_dtype=False)
+
+    def test_parallel_cache(self):
+        config = _get_test_config()
+        usage = generate_usage_data(config, {'name': 'test', 'users': 300})
+        cache = {}
+        generate_service_summary_data(config, usage, 2, cache)
+        cached_web = cache['web']
+        with mock.patch('core.parallel.ProcessPoolExecutor') as executor:
+            generate_service_summary_data(config, usage, 2, cache)
+        executor.assert_not_called()
+
+        config.services['db'].usage_capacity_per_node = 500
+        service_data, summary_data = generate_service_summary_data(config, usage, 2, cache)
+        # only db is recomputed
+        self.assertIs(cache['web'], cached_web)
+        expected_service_data, expected_summary_data = get_service_and_summary_data(config, usage)
+        assert_frame_equal(service_data, expected_service_data, check_dtype=False)
+        assert_frame_equal(summary_data, expected_summary_data, check_dtype=False)
+
+    def test_parallel_compact_dtypes(self):
+        config = _get_test_config(compact_dtypes=True)
+        usage = generate_usage_data(config, {'name': 'test', 'users': 300})
+        service_data, summary_data = get_service_and_summary_data(config, usage)
+
+        parallel_service_data, parallel_summary_data = generate_service_summary_data(config, usage, 2)
+        assert_frame_equal(parallel_service_data, service_data)
+        assert_frame_equal(parallel_summary_data, summary_data)
+        self.assertIn(np.dtype(np.float32), set(parallel_service_data.dtypes))
+
+
+class SolveTests(TestCase):
+    def test_solve_max_users(self):
+        config = _get_test_config()
+        limits = CapacityConfig({'services': {'web': {'vms': 6}}}).limit_series()
+        # 500 users = 5 VMs + 1 VM buffer
+        result = solve_max_value(config, {'name': 'test'}, 'users', limits, 100, 5000, batch_size=3)
+        self.assertEqual(result.value, 500)
+        self.assertEqual(result.exceeded_value, 501)
+        self.assertEqual(result.utilization[('service', 'web', 'vms')], 1)
+        self.assertGreater(result.exceeded_utilization[('service', 'web', 'vms')], 1)
+
+    def test_solve_limits_not_reached(self):
+        config = _get_test_config()
+        limits = CapacityConfig({'storage_groups': {'SSD': {'storage': '1000TB'}}}).limit_series()
+        result = solve_max_value(config, {'name': 'test'}, 'users', limits, 100, 5000)
+        self.assertEqual(result.value, 5000)
+        self.assertIsNone(result.exceeded_value)
+
+    def test_solve_unknown_variable(self):
+        limits = CapacityConfig({'services': {'web': {'vms': 6}}}).limit_series()
+        with self.assertRaisesRegex(ValueError, 'Unknown set variables: user. The config uses: users'):
+            solve_max_value(_get_test_config(), {'name': 'test'}, 'user', limits, 100, 5000)
+
+
+class CapacityForecastTests(TestCase):
+    def test_forecast_exhaustion(self):
+        limits = CapacityConfig({'services': {'web': {'vms': 3}}}).limit_series()
+        index = pd.date_range('2017-01-01', periods=4, freq='MS')
+        columns = pd.MultiIndex.from_tuples([('service', 'web', 'vms'), ('service', 'web', 'cores')])
+        demand_by_set = {
+            'small': pd.DataFrame([[1, 2], [2, 4], [3, 6], [3, 6]], index=index, columns=columns),
+            'large': pd.DataFrame([[2, 4], [3, 6], [5, 10], [4, 8]], index=index, columns=columns),
+        }
+        forecast = forecast_exhaustion(demand_by_set, limits, lead_time=1)
+
+        small = forecast.loc[('small', 'service', 'web', 'vms')]
+        self.assertTrue(pd.isna(small['Exhausted']))
+        self.assertEqual(small['Peak Demand'], 3)
+
+        large = forecast.loc[('large', 'service', 'web', 'vms')]
+        self.assertEqual(large['Exhausted'], pd.Timestamp('2017-03-01'))
+        self.assertEqual(large['Order By'], pd.Timestamp('2017-02-01'))
+        self.assertEqual(large['Peak Demand'], 5)
+
+        with self.assertRaisesRegex(ValueError, 'No sets to forecast'):
+            forecast_exhaustion({}, limits)
+
+
+class HTMLWriterTests(TestCase):
+    def test_html_report(self):
+        index = pd.date_range('2017-01-01', periods=3, freq='MS')
+        data_frame = pd.DataFrame(
+            {('web', 'VMs'): [1, 2, np.nan], ('web', 'Group'): ['</script>', 'b', 'c']}, index=index
+        )
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'report.html')
+            with HTMLWriter(path) as writer:
+                writer.write_user_counts_horizontal('Summary', [('2017-01', 100)])
+                writer.write_data_frame(data_frame, 'Summary', 'Date', 'Raw', has_total_row=True)
+                writer.write_config_string('usage: {}')
+            with open(path) as f:
+                html = f.read()
+
+        # the data can't close the script element early
+        self.assertEqual(html.count('</script>'), 2)
+        data = html.split('id="report">')[1].split('</script>')[0]
+        sheets = json.loads(data.replace('<\\/', '</'))['sheets']
+        self.assertEqual(list(sheets), ['Summary', 'Config'])
+        table = sheets['Summary'][1]
+        self.assertEqual(table['columns'], [['web', 'web'], ['VMs', 'Group']])
+        self.assertEqual(table['index'], ['2017-01-01', '2017-02-01', '2017-03-01'])
+        self.assertEqual(table['data'], [[1, '</script>'], [2, 'b'], [None, 'c']])
+        self.assertTrue(table['total'])
+        self.assertEqual(sheets['Config'], [{'text': 'usage: {}'}])
+
+
+class ProcurementTests(TestCase):
+    def test_plan_procurement(self):
+        index = pd.date_range('2017-01-01', periods=4, freq='MS')
+        columns = pd.MultiIndex.from_tuples([
+            ('service', 'web', 'vms'), ('service', 'db', 'vms'), ('storage_group', 'SSD', 'storage')
+        ])
+        demand_by_set = {
+            'small': pd.DataFrame([[1, 1, 5e12], [2, 1, 9e12], [3, 1, 12e12], [2, 1, 12e12]], index=index, columns=columns),
+            'large': pd.DataFrame([[2, 1, 5e12], [5, 1, 25e12], [9, 1, 30e12], [9, 1, 31e12]], index=index, columns=columns),
+        }
+        steps = CapacityConfig({
+            'services': {'*': {'vms': 1}, 'web': {'vms': 4}},
+            'storage_groups': {'SSD': {'storage': '10TB'}},
+        })
+        provisioned = CapacityConfig({'services': {'db': {'vms': 1}}})
+        plan = plan_procurement(demand_by_set, steps, provisioned, lead_time=2)
+
+        # the provisioned resources never decrease and always cover the demand
+        self.assertTrue((plan.provisioned >= plan.required).all().all())
+        self.assertTrue((plan.provisioned.diff().fillna(0) >= 0).all().all())
+        self.assertEqual(list(plan.provisioned[('small', 'service', 'web', 'vms')]), [4, 4, 4, 4])
+        self.assertEqual(list(plan.provisioned[('large', 'service', 'web', 'vms')]), [4, 8, 12, 12])
+        self.assertEqual(list(plan.provisioned[('large', 'storage_group', 'SSD', 'storage')]), [1e13, 3e13, 3e13, 4e13])
+
+        # db is already provisioned so it needs no orders
+        self.assertNotIn('db', plan.orders.index.get_level_values('name'))
+        large_storage = plan.orders.loc[('large', 'storage_group', 'SSD', 'storage')]
+        self.assertEqual(list(large_storage['Steps']), [1, 2, 1])
+        self.assertEqual(list(large_storage['Delivery']), [index[0], index[1], index[3]])
+        self.assertEqual(large_storage['Order By'].iloc[1], pd.Timestamp('2016-12-01'))
+
+    def test_unknown_steps(self):
+        index = pd.date_range('2017-01-01', periods=2, freq='MS')
+        demand = pd.DataFrame([[1], [2]], index=index, columns=pd.MultiIndex.from_tuples([('service', 'web', 'vms')]))
+        with self.assertRaisesRegex(ValueError, 'unknown'):
+            plan_procurement({'default': demand}, CapacityConfig({'services': {'db': {'vms': 1}}}))
+        with self.assertRaisesRegex(ValueError, 'No sets to plan'):
+            plan_procurement({}, CapacityConfig({'services': {'web': {'vms': 1}}}))
+
+
+class TieredStorageTests(TestCase):
+    def _get_config(self, **extra):
+        config = config_to_json(_get_test_config(**extra))
+        config['services']['db']['storage']['data_models'][0]['tiers'] = [
+            {'group': 'SAS', 'after': 1},
+            {'group': 'blob', 'after': 3, 'redundancy_factor': 2},
+        ]
+        return ClusterConfig(config)
+
+    def test_age_buckets(self):
+        buckets = get_age_buckets(np.array([[1, 2, 3, 4], [1, 2, 2, 1]]), [1, 3])
+        np.testing.assert_array_equal(buckets, [
+            [[1, 1, 1, 1], [0, 1, 2, 2], [0, 0, 0, 1]],
+            # the oldest items are removed first
+            [[1, 1, 0, 0], [0, 1, 2, 0], [0, 0, 0, 1]],
+        ])
+
+    def test_tiered_storage(self):
+        config = self._get_config(price_catalog={
+            'vm_types': {'2x4': {'on_demand': 0}, '4x16': {'on_demand': 0}},
+            'storage_groups': {
+                'SSD': {'on_demand': 0}, 'VM_os': {'on_demand': 0}, 'SAS': {'on_demand': 1}, 'blob': {'on_demand': 10},
+            },
+        })
+        usage = generate_usage_data(config, {'name': 'test', 'users': 100})
+        service_data, summary_data = get_service_and_summary_data(config, usage)
+
+        storage = service_data['db']['Data Storage']
+        # 1000 forms per month, 1MB per form and a storage buffer of 0.2
+        self.assertEqual(list(storage['forms_total']), [1e9] * 4)
+        self.assertEqual(list(storage['storage (SAS)']), [0, 1.2e9, 2.4e9, 2.4e9])
+        self.assertEqual(list(storage['storage (blob)']), [0, 0, 0, 2.4e9])
+
+        summary = summarize_service_data(config, summary_data, pd.Timestamp('2017-04-01'))
+        storage_by_group = summary.storage_by_group['Rounded Total (GB)']
+        # with the estimation buffer of 0.1
+        self.assertAlmostEqual(storage_by_group['SAS'], 2.64)
+        self.assertAlmostEqual(storage_by_group['blob'], 2.64)
+        self.assertAlmostEqual(summary.cost.loc['db', 'Storage Cost'], 2.64 + 26.4)
+
+        demand = get_monthly_demand(config, summary_data)
+        self.assertAlmostEqual(demand[('storage_group', 'blob', 'storage')].iloc[-1], 2.64e9)
+
+
+class CostTests(TestCase):
+    catalog = {
+        'reserved_fraction': 0.5,
+        'vm_types': {
+            '2x4': {'on_demand': 100, 'reserved': {'2017-01': 60, '2017-03': 40}},
+            '4x16': {'on_demand': 300, 'reserved_fraction': 0},
+        },
+        'storage_groups': {'SSD': {'on_demand': 0.1}, 'VM_os': {'on_demand': 0.05}},
+    }
+
+    def _get_summary_data(self, config):
+        usage = generate_usage_data(config, {'name': 'test', 'users': 300})
+        return get_service_and_summary_data(config, usage)[1]
+
+    def test_price_series(self):
+        dates = pd.date_range('2017-01-01', periods=4, freq='MS')
+        prices = get_price_series({'2017-02': 10, '2017-04': 5}, dates)
+        self.assertEqual(list(prices), [10, 10, 10, 5])
+
+    def test_cost_data(self):
+        config = _get_test_config(price_catalog=self.catalog)
+        summary_data = self._get_summary_data(config)
+        cost = get_cost_data(config, summary_data)
+
+        web = summary_data['web']
+        os_cost = web['OS Storage Total (Bytes)'] / 1e9 * 0.05
+        vm_prices = pd.Series([80, 80, 70, 70], index=summary_data.index)
+        assert_frame_equal(cost['web'], pd.DataFrame({
+            'Compute Cost': web['VMs Total'] * vm_prices + os_cost,
+            'Storage Cost': web['Data Storage Total (GB)'] * 0.1,
+            'Total Cost': web['VMs Total'] * vm_prices + os_cost + web['Data Storage Total (GB)'] * 0.1,
+        }), check_dtype=False, check_names=False)
+        self.assertEqual(
+            list(cost[('db', 'Compute Cost')]),
+            list(summary_data[('db', 'VMs Total')] * 300 + summary_data[('db', 'OS Storage Total (Bytes)')] / 1e9 * 0.05)
+        )
+
+    def test_missing_price(self):
+        config = _get_test_config(price_catalog={'vm_types': {'2x4': {'on_demand': 1}}})
+        with self.assertRaisesRegex(ValueError, 'VM types: 4x16'):
+            get_cost_data(config, self._get_summary_data(config))
+
+    def test_cost_summary(self):
+        config = _get_test_config(price_catalog=self.catalog)
+        summary_data = self._get_summary_data(config)
+        cost = get_cost_data(config, summary_data)
+        date = pd.Timestamp('2017-04-01')
+        summary = summarize_service_data(config, summary_data, date)
+        self.assertEqual(summary.cost.loc['Total', 'Monthly Cost'], cost.loc[date].xs('Total Cost', level=1).sum())
+        self.assertEqual(summary.cost.loc['web', 'Cumulative Cost'], cost[('web', 'Total Cost')].sum())
+        assert_frame_equal(summarize_service_data(config, summary_data, date, cost).cost, summary.cost)
+
+        comparison = compare_summaries(config, {date: summary})
+        self.assertEqual(comparison.cost[('2017-04-01', 'Monthly Cost')].to_dict(), summary.cost['Monthly Cost'].to_dict())
+
+        # the cost limit applies to the total monthly cost
+        demand = get_monthly_demand(config, summary_data)
+        self.assertEqual(demand[('total', 'all', 'cost')].loc[date], summary.cost.loc['Total', 'Monthly Cost'])
+        limits = CapacityConfig({'total': {'cost': 1000}}).limit_series()
+        self.assertEqual(list(limits.index), [('total', 'all', 'cost')])
+
+
+class EmulatorTests(TestCase):
+    def test_latin_hypercube(self):
+        samples = latin_hypercube(10, 3, seed=1)
+        self.assertEqual(samples.shape, (10, 3))
+        for column in samples.T:
+            self.assertEqual(sorted(np.floor(column * 10).astype(int)), list(range(10)))
+
+    def test_unknown_parameter(self):
+        parameters = [ParameterRange('users', 100, 1000), ParameterRange('forms_per_user', 1, 10)]
+        with self.assertRaisesRegex(ValueError, 'Unknown set variables: forms_per_user'):
+            fit_emulator(_get_test_config(), {'name': 'test'}, parameters, samples=16)
+
+    def test_fit_emulator(self):
+        config = _get_test_config()
+        parameters = [ParameterRange('users', 100, 1000)]
+        emulator = fit_emulator(config, {'name': 'test'}, parameters, samples=16, holdout=0.25, degree=1)
+        self.assertEqual(list(emulator.errors.index), emulator.metrics)
+        self.assertIn('Storage SSD (GB)', emulator.metrics)
+
+        actual = run_samples(config, {'name': 'test'}, parameters, np.array([[550]])).iloc[0]
+        predicted = emulator.predict(users=550)
+        # the metrics are nearly linear in the users
+        self.assertLess(abs(predicted['VMs'] - actual['VMs']), 2 * emulator.errors.loc['VMs', 'Max Error'] + 1)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'emulator.json')
+            emulator.save(path)
+            loaded = Emulator.load(path)
+        self.assertEqual(loaded.predict(users=550), predicted)
+        assert_frame_equal(loaded.errors, emulator.errors)
+
+
+class CubeTests(TestCase):
+    def test_write_and_query(self):
+        config = _get_test_config()
+        set_contexts = list(iter_combined_sets(config.sets))[:2]
+        summaries = {}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'cube')
+            with CubeWriter(path, count_combined_sets(config.sets)) as writer:
+                for set_context in set_contexts:
+                    usage = generate_usage_data(config, set_context)
+                    summary_data = get_summary_data(config, generate_service_data(config, usage))
+                    summaries[set_context['name']] = summary_data
+                    writer.write(set_context['name'], summary_data)
+
+            cube = SummaryCube.load(path)
+            self.assertEqual(cube.labels['set'], ['100u', '200u'])
+            self.assertEqual(cube.data.shape[0], 2)
+
+            selection = cube.sel(service='web', metric='VMs Total', period='2017-Q1').to_frame()
+            self.assertEqual(list(selection.columns), ['100u', '200u'])
+            self.assertEqual(list(selection.index), list(pd.date_range('2017-01-01', periods=3, freq='MS')))
+            for set_name, summary_data in summaries.items():
+                self.assertEqual(
+                    list(selection[set_name]),
+                    list(summary_data[('web', 'VMs Total')].iloc[:3].astype(float))
+                )
+
+            with self.assertRaises(KeyError):
+                cube.sel(service='unknown')
+
+    def test_sets_with_different_dates(self):
+        config = _get_test_config()
+        usage = generate_usage_data(config, {'name': 'test', 'users': 100})
+        summary_data = get_summary_data(config, generate_service_data(config, usage))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'cube')
+            with CubeWriter(path, 2) as writer:
+                writer.write('all', summary_data)
+                writer.write('later', summary_data.iloc[1:])
+            cube = SummaryCube.load(path)
+            selection = cube.sel(service='web', metric='VMs Total').to_frame()
+            self.assertTrue(np.isnan(selection['later'].iloc[0]))
+            np.testing.assert_array_equal(selection['later'].iloc[1:], selection['all'].iloc[1:])
+
+
+class ResultsStoreTests(TestCase):
+    def test_history(self):
+        config = _get_test_config()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with ResultsStore(os.path.join(tmpdir, 'results.db')) as store:
+                for commit, users in [('abc', 100), ('def', 300)]:
+                    run_id = store.add_run('test.yml', config, commit)
+                    usage = generate_usage_data(config, {'name': f'{users}u', 'users': users})
+                    service_data = generate_service_data(config, usage)
+                    store.add_set(run_id, 'default', usage, service_data, get_summary_data(config, service_data))
+
+                history = store.get_history('web', 'VMs Total')
+                self.assertEqual(list(history['commit']), ['abc', 'def'])
+                self.assertEqual(list(history['date']), ['2017-04-01', '2017-04-01'])
+                self.assertEqual(list(history['value']), [2, 4])
+
+                history = store.get_history('web', 'VMs Total', date='2017-01')
+                self.assertEqual(list(history['date']), ['2017-01-01', '2017-01-01'])
+
+
+class DiffTests(TestCase):
+    def _diff(self, config_b):
+        config_a = _get_test_config()
+        set_context = {'name': '100u', 'users': 100}
+        return diff_configs(config_a, set_context, config_b, set_context)
+
+    def test_service_change(self):
+        config_b = _get_test_config()
+        config_b.services['db'].usage_capacity_per_node = 500
+        result = self._diff(config_b)
+        self.assertEqual(result.changed_keys, [('services', 'db', 'usage_capacity_per_node')])
+        self.assertEqual(result.causes['db'], [('services', 'db', 'usage_capacity_per_node')])
+        self.assertEqual(result.causes['web'], [])
+        self.assertEqual(set(result.cells.index.get_level_values('service')), {'db'})
+        vms = result.cells.loc[('Service Data', 'db', 'Compute: VMs', pd.Timestamp('2017-04-01'))]
+        self.assertEqual((vms['Before'], vms['After']), (1, 2))
+
+    def test_usage_change_traced_to_dependant_services(self):
+        config_b = _get_test_config()
+        config_b.usage['forms'].factor = 20
+        result = self._diff(config_b)
+        self.assertEqual(result.causes['db'], [('usage', 'forms', 'factor')])
+        self.assertEqual(result.causes['web'], [])
+        self.assertEqual(set(result.cells.index.get_level_values('service')), {'db'})
+
+    def test_no_changes(self):
+        result = self._diff(_get_test_config())
+        self.assertEqual(result.changed_keys, [])
+        self.assertTrue(result.cells.empty)
+
+
+class QueueingTests(TestCase):
+    def test_unstable_load_does_not_overflow(self):
+        with np.errstate(over='raise'):
+            self.assertEqual(float(wait_probability(1, 1e4, 1.0, 1000)), 1)
+            servers = required_servers([1e4], 1.0, 1000, 0.95)
+        self.assertGreater(servers[0], 1e4)
+
+    def test_erlang_c(self):
+        self.assertAlmostEqual(float(erlang_c(3, 2.0)), 4 / 9)
+        self.assertEqual(float(erlang_c(2, 3.0)), 1)
+
+    def test_required_servers(self):
+        arrival_rates = [0, 0.5, 10, 2000]
+        servers = required_servers(arrival_rates, 1.5, 2, 0.95)
+        self.assertEqual(servers[0], 0)
+        for rate, count in zip(arrival_rates[1:], servers[1:]):
+            count = int(count)
+            self.assertLessEqual(float(wait_probability(count, rate, 1.5, 2)), 0.05)
+            self.assertGreater(float(wait_probability(count - 1, rate, 1.5, 2)), 0.05)
+
+    def test_queue_sub_process(self):
+        config = _get_test_config(services={
+            'celery': {
+                'usage_field': 'forms',
+                'process': {
+                    'cores_per_node': 8, 'ram_per_node': 16, 'cores_per_sub_process': 1, 'ram_per_sub_process': 1,
+                    'sub_processes': [{
+                        'name': 'queue', 'service_time': 0.5, 'target_wait': 1,
+                        'tasks_per_usage': SECONDS_PER_MONTH / 1000, 'concurrency': 2,
+                    }],
+                },
+            },
+        })
+        usage = generate_usage_data(config, {'name': '100u', 'users': 100})
+        service_data = generate_service_data(config, usage)
+        expected = np.ceil(required_servers(usage['forms'].to_numpy() / 1000, 0.5, 1) / 2)
+        self.assertEqual(list(service_data[('celery', 'Compute', 'CPU')]), list(expected))
+
+
+class AutoscaleTests(TestCase):
+    def test_rolling_max(self):
+        values = np.random.default_rng(0).random(100)
+        for window in [1, 3, 10, 100, 150]:
+            expected = [values[max(0, i - window + 1):i + 1].max() for i in range(len(values))]
+            self.assertEqual(list(rolling_max(values, window)), expected)
+
+    def test_simulate_nodes(self):
+        load = np.array([1, 1, 4, 4, 4, 1, 1, 1, 1, 1], dtype=float)
+        nodes = simulate_nodes(load, 1, scale_up_delay=1, scale_down_delay=2, min_nodes=1)
+        # available 1 minute after needed and removed after 2 minutes of lower load
+        self.assertEqual(list(nodes), [1, 1, 1, 4, 4, 4, 4, 1, 1, 1])
+
+    def test_simulate_autoscaling(self):
+        config = _get_test_config()
+        config.services['web'].autoscaling = AutoscalingDef({
+            'hourly_profile': [1] * 12 + [2] * 12, 'target_utilization': 1, 'scale_up_delay': 0, 'scale_down_delay': 0,
+        })
+        usage = generate_usage_data(config, {'name': '500u', 'users': 500})
+        results = simulate_autoscaling(config, generate_service_data(config, usage), '2017-04-01', days=2)
+        self.assertEqual(list(results.index), ['web'])
+        web = results.loc['web']
+        self.assertEqual(web['Static VMs'], 5)
+        self.assertEqual(web['Peak VMs'], 5)
+        self.assertEqual(web['Average VMs'], 4)
+        self.assertEqual(web['Minutes Over Capacity'], 0)
+
+
+class CollectTests(TestCase):
+    es_response = {
+        'aggregations': {
+            'cases_per_user': {
+                'buckets': [
+                    {'key': 'u1', 'doc_count': 30, 'cases_by_date': {'buckets': [{'doc_count': 10}, {'doc_count': 20}]}},
+                    {'key': 'u2', 'doc_count': 30, 'cases_by_date': {'buckets': [{'doc_count': 30}]}},
+                ]
+            }
+        }
+    }
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmpdir.name, 'test.db')
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute('CREATE TABLE cases (id INTEGER, lifespan REAL)')
+            conn.executemany('INSERT INTO cases VALUES (?, ?)', [(1, 10), (2, 20), (3, 60)])
+
+        self.es_requests = []
+        test = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                test.es_requests.append((self.path, json.loads(body)))
+                response = json.dumps(test.es_response).encode('utf8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(response)))
+                self.end_headers()
+                self.wfile.write(response)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer(('localhost', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        self.queries_path = os.path.join(self.tmpdir.name, 'queries.yml')
+        with open(self.queries_path, 'w') as f:
+            f.write(
+                "case_lifespan: select avg(lifespan) from cases\n"
+                "case_rows: select id, lifespan from cases order by id\n"
+                "cases_per_user_per_month:\n"
+                "  index: cases\n"
+                "  query: '{\"size\": 0, \"aggs\": {}}'\n"
+            )
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmpdir.cleanup()
+
+    def _run(self, cache, refresh=False):
+        return asyncio.run(run_queries(
+            load_queries(self.queries_path),
+            db_url=f'sqlite:///{self.db_path}',
+            es_url='http://localhost:%s' % self.server.server_port,
+            pool_size=2, cache=cache, refresh=refresh,
+        ))
+
+    def test_collect(self):
+        cache = ResultCache(os.path.join(self.tmpdir.name, 'cache.json'))
+        results = self._run(cache)
+        self.assertEqual(results['case_lifespan'][1], 30)
+        self.assertIsNone(results['case_rows'][1])
+        self.assertEqual(results['case_rows'][0]['rows'], [[1, 10], [2, 20], [3, 60]])
+        # mean of (10 + 20) / 2 and 30 / 1
+        self.assertEqual(results['cases_per_user_per_month'][1], 22.5)
+        self.assertEqual(self.es_requests, [('/cases/_search', {'size': 0, 'aggs': {}})])
+
+        self.assertEqual(get_overrides(results), {'sets': {'collected': [{
+            'name': 'collected', 'case_lifespan': 30, 'cases_per_user_per_month': 22.5
+        }]}})
+
+    def test_cache(self):
+        cache_path = os.path.join(self.tmpdir.name, 'cache.json')
+        self._run(ResultCache(cache_path))
+        results = self._run(ResultCache(cache_path))
+        self.assertEqual(len(self.es_requests), 1)
+        self.assertEqual(results['cases_per_user_per_month'][1], 22.5)
+
+        self._run(ResultCache(cache_path), refresh=True)
+        self.assertEqual(len(self.es_requests), 2)
+
+    def test_reduce_es_hit_count(self):
+        self.assertEqual(reduce_es({'hits': {'total': 12, 'hits': []}}), 12)
+        # Elasticsearch 7+
+        self.assertEqual(reduce_es({'hits': {'total': {'value': 12, 'relation': 'eq'}, 'hits': []}}), 12)
+
+    def test_select_queries(self):
+        queries = load_queries(self.queries_path)
+        self.assertEqual(list(select_queries(queries, ['case_rows', 'case_lifespan'])), ['case_rows', 'case_lifespan'])
+        with self.assertRaisesRegex(ValueError, 'Unknown queries: missing. Known queries: case_lifespan'):
+            select_queries(queries, ['missing'])
+
+
+class CalibrateTests(TestCase):
+    set_context = {'name': '100u', 'users': 100}
+
+    def test_evaluate_matches_data_frame(self):
+        config = _get_test_config(usage={
+            'users': {'model': 'date_range_value', 'ranges': [['20170101', '20170601', 100]]},
+            'forms': {'model': 'expression', 'expression': 'users * 10 + 5'},
+            'cases': {'model': 'baseline_with_growth', 'dependant_field': 'users', 'baseline': 3, 'monthly_growth': 2},
+            'all': {'model': 'derived_sum', 'dependant_fields': ['forms', 'cases'], 'start_with': 7},
+            'forms_live': {'model': 'cumulative_limited_lifespan', 'dependant_field': 'forms', 'lifespan': 2},
+        })
+        usage = generate_usage_data(config, self.set_context)
+        values = {field: usage[field].to_numpy(float) for field in usage.columns}
+        models = models_by_slug()
+        for name, model_def in config.usage.items():
+            model = models[model_def.model](self.set_context, name, **model_def.model_params)
+            for field, result in model.evaluate(values).items():
+                np.testing.assert_allclose(result, values[field], err_msg=field)
+
+    def test_evaluate_without_array_func(self):
+        class DerivedMax(DerivedModel):
+            slug = 'derived_max'
+            func = max
+
+        values = {'a': np.array([1., 5.]), 'b': np.array([3., 2.])}
+        result = DerivedMax(self.set_context, 'max', ['a', 'b']).evaluate(values)
+        np.testing.assert_array_equal(result['max'], [3, 5])
+
+    def test_levenberg_marquardt(self):
+        x = np.arange(10.)
+        y = 3 * np.exp(-0.5 * x)
+        fit = levenberg_marquardt(lambda p: p[0] * np.exp(-p[1] * x) - y, [1, 1])
+        np.testing.assert_allclose(fit.x, [3, 0.5], rtol=1e-6)
+
+    def test_calibrate(self):
+        actual = _get_test_config()
+        actual.usage['forms'].factor = 15
+        actual.services['db'].storage.data_models[0].unit_size = '2MB'
+        usage = generate_usage_data(actual, self.set_context)
+        service_data = generate_service_data(actual, usage)
+        observed = pd.DataFrame({
+            'forms_total': usage['forms_total'],
+            'db.storage': service_data['db']['Data Storage']['storage'],
+        })
+        # missing observations are ignored
+        observed.iloc[1, 0] = np.nan
+
+        result = calibrate(_get_test_config(), self.set_context, [
+            'usage.forms.factor', 'services.db.storage.data_models.0.unit_size'
+        ], observed)
+        np.testing.assert_allclose(result.parameters['Initial'], [10, 1e6])
+        np.testing.assert_allclose(result.parameters['Fitted'], [15, 2e6], rtol=1e-6)
+        self.assertEqual(len(result.residuals), 7)
+        np.testing.assert_allclose(result.residuals['Residual'], 0, atol=1e-3)
+        self.assertTrue((result.metrics['Fitted Error'] < 1e-6).all())
+        self.assertTrue((result.metrics['Initial Error'] > 0.1).all())
+
+    def test_write_fitted_config(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            base_path = os.path.join(tmpdir, 'base.yml')
+            with open(base_path, 'w') as f:
+                yaml.safe_dump(config_to_json(_get_test_config()), f, sort_keys=False)
+            overlay_path = os.path.join(tmpdir, 'overlay.yml')
+            with open(overlay_path, 'w') as f:
+                yaml.safe_dump({'extends': 'base.yml', 'services': {'db': {'usage_capacity_per_node': 500}}}, f)
+            os.mkdir(os.path.join(tmpdir, 'fitted'))
+            output_path = os.path.join(tmpdir, 'fitted', 'fitted.yml')
+
+            # both parameters are only in the base config
+            write_fitted_config(overlay_path, {
+                'usage.forms.factor': 15.0000001, 'services.db.storage.data_models.0.unit_size': 2e6
+            }, output_path)
+            with open(output_path, 'r') as f:
+                self.assertEqual(yaml.safe_load(f)['extends'], '../overlay.yml')
+            config = config_from_path(output_path)
+            self.assertEqual(config.usage['forms'].factor, 15)
+            self.assertEqual(config.services['db'].storage.data_models[0].unit_size, 2000000)
+            self.assertEqual(config.services['db'].usage_capacity_per_node, 500)
+            self.assertEqual(config_to_json(config)['usage']['users'], config_to_json(_get_test_config())['usage']['users'])
+
+    def test_calibrate_errors(self):
+        observed = pd.DataFrame({'forms': [1000.]}, index=pd.DatetimeIndex(['2017-01-01']))
+        for parameter in ['usage.forms.missing', 'services.web.process.cores_per_node', 'usage.users.ranges.0.2']:
+            with self.assertRaises(ValueError):
+                calibrate(_get_test_config(), self.set_context, [parameter], observed)
+        with self.assertRaises(ValueError):
+            calibrate(_get_test_config(), self.set_context, ['usage.forms.factor'], observed.rename(columns={'forms': 'x'}))
+
+
+def _get_test_config(**extra):
+    config = {
+        'estimation_buffer': 0.1,
+        'storage_buffer': 0.2,
+        'vm_os_storage_gb': 50,
+        'vm_os_storage_group': 'VM_os',
+        'sets_summary_date': '2017-04',
+        'sets': {
+            'users': [{'name': '{users}u', 'users': {'range': [100, 500, 100]}}],
+        },
+        'usage': {
+            'users': {'model': 'date_range_value', 'ranges': [['20170101', '20170401', '{users}']]},
+            'forms': {'model': 'derived_factor', 'dependant_field': 'users', 'factor': 10},
+            'forms_total': {'model': 'cumulative', 'dependant_field': 'forms'},
+        },
+        'services': {
+            'web': {
+                'usage_capacity_per_node': 100,
+                'process': {'cores_per_node': 2, 'ram_per_node': 4},
+                'storage': {'group': 'SSD', 'static_baseline': '10GB'},
+            },
+            'db': {
+                'usage_capacity_per_node': 1000,
+                'usage_field': 'forms',
+                'process': {'cores_per_node': 4, 'ram_per_node': 16},
+                'storage': {'group': 'SSD', 'data_models': [{'referenced_field': 'forms_total', 'unit_size': '1MB'}]},
+            },
+        },
+    }
+    config.update(extra)
+    return ClusterConfig(config)
+
 
 def _get_user_data(*others):
-    model = DateValueModel('users', [
+    model = DateValueModel({}, 'users', [
         ['20170101', '20170201', 100],
         ['20170301', '20170401', 200],
     ])
@@ -32,6 +32,16 @@ def from_storage_display_unit(unit):
     return _inner
 
 
+def tier_storage_field(group):
+    """Service data storage field of a lifecycle tier"""
+    return f'storage ({group})'
+
+
+def tier_storage_column(group, storage_units):
+    """Summary data column of a lifecycle tier"""
+    return f'Tier Storage {group} ({storage_units})'
+
+
 def storage_display_to_bytes(display_value):
     pattern = re.compile('(?P<value>\d+)\s*(?P<units>(?:K|M|G|T)B)')
     match = pattern.match(display_value)
@@ -60,3 +70,44 @@ def apply_context(context, val, type_conversion=str):
     if isinstance(val, str) and context_pattern.findall(val):
         return type_conversion(val.format(**context))
     return val
+
+
+def apply_context_recursive(context, val):
+    """Apply the context to all strings in a nested structure of lists and dicts"""
+    if isinstance(val, dict):
+        return {key: apply_context_recursive(context, item) for key, item in val.items()}
+    if isinstance(val, (list, tuple)):
+        return [apply_context_recursive(context, item) for item in val]
+    return apply_context(context, val)
+
+
+def apply_context_typed(context, val):
+    """Like ``apply_context_recursive`` but strings that are a single placeholder
+    e.g. '{cores}' are replaced by the value itself so numbers stay numbers."""
+    if isinstance(val, dict):
+        return {key: apply_context_typed(context, item) for key, item in val.items()}
+    if isinstance(val, (list, tuple)):
+        return [apply_context_typed(context, item) for item in val]
+    if isinstance(val, str) and context_pattern.fullmatch(val):
+        return context[val[1:-1]]
+    return apply_context(context, val)
+
+
+def get_context_variables(val):
+    """:return: set of the names of the placeholders in a nested structure of lists and dicts"""
+    if isinstance(val, dict):
+        return set().union(*(get_context_variables(item) for item in val.values()))
+    if isinstance(val, (list, tuple)):
+        return set().union(*(get_context_variables(item) for item in val))
+    if isinstance(val, str):
+        return {match[1:-1] for match in context_pattern.findall(val)}
+    return set()
+
+
+def has_context(val):
+    """:return: True if any string in a nested structure of lists and dicts has a placeholder"""
+    if isinstance(val, dict):
+        return any(has_context(item) for item in val.values())
+    if isinstance(val, (list, tuple)):
+        return any(has_context(item) for item in val)
+    return isinstance(val, str) and bool(context_pattern.search(val))
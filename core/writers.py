@@ -1,6 +1,8 @@
+import html
+import json
 import os
 from abc import ABC, abstractmethod
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from datetime import datetime
 from itertools import zip_longest
 from numbers import Number
@@ -193,3 +195,221 @@ class ConsoleWriter(BaseWriter):
             print('\n%s %s %s' % (header2, header or index_label, header2))
         print()
         print(data_frame)
+
+
+HTML_TEMPLATE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<meta name="viewport" content="width=device-width, initial-scale=1">
+<title>{title}</title>
+<style>
+body {{ font-family: sans-serif; font-size: 13px; margin: 0; }}
+nav {{ position: sticky; top: 0; background: #eee; padding: 4px; border-bottom: 1px solid #ccc; }}
+nav button {{ margin: 2px; }}
+nav button.active {{ background: #CCFFFF; font-weight: bold; }}
+main {{ padding: 8px; }}
+h3 {{ background: #CCFFFF; padding: 4px; margin: 16px 0 4px; }}
+.scroll {{ overflow-x: auto; }}
+table {{ border-collapse: collapse; }}
+th, td {{ border: 1px solid #ccc; padding: 2px 6px; white-space: nowrap; }}
+td {{ text-align: right; }}
+th {{ background: #f6f6f6; }}
+tr.total td, tr.total th {{ font-weight: bold; }}
+pre {{ white-space: pre-wrap; }}
+</style>
+</head>
+<body>
+<nav id="sheets"></nav>
+<main id="sheet"></main>
+<script type="application/json" id="report">{data}</script>
+<script>
+var PAGE_SIZE = {page_size};
+var report = JSON.parse(document.getElementById('report').textContent);
+
+function el(tag, text, cls) {{
+  var node = document.createElement(tag);
+  if (text !== undefined) node.textContent = text;
+  if (cls) node.className = cls;
+  return node;
+}}
+
+function format(value) {{
+  if (value === null) return '';
+  if (typeof value !== 'number') return value;
+  return Number.isInteger(value) ? String(value) : value.toLocaleString(undefined, {{maximumFractionDigits: 2}});
+}}
+
+function renderRows(tbody, table, page) {{
+  tbody.textContent = '';
+  var start = page * PAGE_SIZE, end = Math.min(start + PAGE_SIZE, table.data.length);
+  for (var i = start; i < end; i++) {{
+    var tr = el('tr', undefined, table.total && i === table.data.length - 1 ? 'total' : '');
+    tr.appendChild(el('th', table.index[i]));
+    table.data[i].forEach(function (value) {{ tr.appendChild(el('td', format(value))); }});
+    tbody.appendChild(tr);
+  }}
+}}
+
+function renderTable(block) {{
+  var section = el('section');
+  if (block.title) section.appendChild(el('h3', block.title));
+  var table = el('table'), thead = el('thead'), tbody = el('tbody');
+  block.columns.forEach(function (level, i) {{
+    var tr = el('tr');
+    tr.appendChild(el('th', i === block.columns.length - 1 ? block.index_label || '' : ''));
+    level.forEach(function (label) {{ tr.appendChild(el('th', label)); }});
+    thead.appendChild(tr);
+  }});
+  table.appendChild(thead);
+  table.appendChild(tbody);
+  var pages = Math.ceil(block.data.length / PAGE_SIZE);
+  if (pages > 1) {{
+    var pager = el('div'), page = 0, label = el('span');
+    var show = function (next) {{
+      page = Math.max(0, Math.min(pages - 1, next));
+      label.textContent = ' Rows ' + (page * PAGE_SIZE + 1) + '-' + Math.min((page + 1) * PAGE_SIZE, block.data.length) +
+        ' of ' + block.data.length + ' ';
+      renderRows(tbody, block, page);
+    }};
+    [['<<', function () {{ return 0; }}], ['<', function () {{ return page - 1; }}]].forEach(function (b) {{
+      var button = el('button', b[0]); button.onclick = function () {{ show(b[1]()); }}; pager.appendChild(button);
+    }});
+    pager.appendChild(label);
+    [['>', function () {{ return page + 1; }}], ['>>', function () {{ return pages - 1; }}]].forEach(function (b) {{
+      var button = el('button', b[0]); button.onclick = function () {{ show(b[1]()); }}; pager.appendChild(button);
+    }});
+    section.appendChild(pager);
+    show(0);
+  }} else {{
+    renderRows(tbody, block, 0);
+  }}
+  var scroll = el('div', undefined, 'scroll');
+  scroll.appendChild(table);
+  section.appendChild(scroll);
+  return section;
+}}
+
+function showSheet(name) {{
+  var main = document.getElementById('sheet');
+  main.textContent = '';
+  report.sheets[name].forEach(function (block) {{
+    main.appendChild(block.text !== undefined ? el('pre', block.text) : renderTable(block));
+  }});
+  Array.prototype.forEach.call(document.querySelectorAll('nav button'), function (button) {{
+    button.className = button.textContent === name ? 'active' : '';
+  }});
+}}
+
+Object.keys(report.sheets).forEach(function (name) {{
+  var button = el('button', name);
+  button.onclick = function () {{ showSheet(name); }};
+  document.getElementById('sheets').appendChild(button);
+}});
+if (Object.keys(report.sheets).length) showSheet(Object.keys(report.sheets)[0]);
+</script>
+</body>
+</html>
+"""
+
+
+class HTMLWriter(BaseWriter):
+    """Single self-contained HTML file with a tab for each sheet.
+
+    The tables are embedded as compact JSON and rendered in the browser a page
+    at a time so that even long raw data tables open instantly.
+    """
+    page_size = 100
+
+    def __init__(self, output_path, title=None):
+        self.output_path = output_path
+        self.title = title or os.path.basename(output_path)
+        self.sheets = OrderedDict()
+
+    def _add_block(self, sheet_name, block):
+        self.sheets.setdefault(sheet_name, []).append(block)
+
+    def write_user_counts_vertical(self, sheet_name, user_count_table):
+        self._add_block(sheet_name, {
+            'title': 'User counts',
+            'index_label': 'Date',
+            'columns': [['User count']],
+            'index': [date for date, count in user_count_table],
+            'data': [[count] for date, count in user_count_table],
+        })
+
+    def write_user_counts_horizontal(self, sheet_name, user_count_table):
+        self._add_block(sheet_name, {
+            'title': 'User counts',
+            'columns': [[date for date, count in user_count_table]],
+            'index': ['User count'],
+            'data': [[count for date, count in user_count_table]],
+        })
+
+    def write_data_frame(self, data_frame, sheet_name, index_label, header=None, has_total_row=False):
+        columns = data_frame.columns
+        if isinstance(columns, pd.MultiIndex):
+            column_levels = [[str(label) for label in columns.get_level_values(i)] for i in range(columns.nlevels)]
+        else:
+            column_levels = [[str(label) for label in columns]]
+        self._add_block(sheet_name, {
+            'title': header,
+            'index_label': index_label,
+            'columns': column_levels,
+            'index': [_html_label(label) for label in data_frame.index],
+            # pandas' JSON encoder writes NaN as null and is much faster than converting each value
+            'data': json.loads(data_frame.to_json(orient='values', date_format='iso')),
+            'total': has_total_row,
+        })
+
+    def write_config_string(self, config_string):
+        self._add_block('Config', {'text': config_string})
+
+    def save(self):
+        data = json.dumps({'sheets': self.sheets}, separators=(',', ':'))
+        with open(self.output_path, 'w', encoding='utf8') as f:
+            f.write(HTML_TEMPLATE.format(
+                title=html.escape(self.title),
+                # the JSON must not close the script element
+                data=data.replace('</', '<\\/'),
+                page_size=self.page_size,
+            ))
+
+
+def _html_label(label):
+    if isinstance(label, datetime):
+        return format_date(label)
+    if isinstance(label, tuple):
+        return ': '.join(str(part) for part in label)
+    return str(label)
+
+
+class CSVStreamWriter(object):
+    """Append data frames to a single CSV file as soon as they are available
+    so that large sweeps don't need to hold all their results in memory."""
+    def __init__(self, output_path):
+        self.output_path = output_path
+        self.file = None
+        self.columns = None
+
+    def write_data_frame(self, data_frame):
+        if self.columns is None:
+            self.columns = list(data_frame.columns)
+            data_frame.to_csv(self.file, index=False)
+        else:
+            data_frame.reindex(columns=self.columns).to_csv(self.file, index=False, header=False)
+        self.file.flush()
+
+    def __enter__(self):
+        self.file = open(self.output_path, 'w', newline='')
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.file.close()
+
+
+def get_file_writer(output_path):
+    """HTMLWriter for ``.html`` paths otherwise ExcelWriter"""
+    if os.path.splitext(output_path)[1].lower() in ('.html', '.htm'):
+        return HTMLWriter(output_path)
+    return ExcelWriter(output_path)
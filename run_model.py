@@ -1,148 +1,818 @@
 import argparse
-import itertools
+import asyncio
+import functools
+import glob
 import os
+import secrets
 import subprocess
 import sys
+import time
 from collections import namedtuple, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import nullcontext
 
 import pandas as pd
+import yaml
 
-from core.config import config_from_path
-from core.generate import generate_usage_data, generate_service_data
-from core.output import write_raw_data, write_summary_comparisons, write_summary_data, write_raw_service_data
+from core.autoscale import simulate_autoscaling
+from core.calibrate import calibrate as calibrate_config, load_observations, write_fitted_config
+from core.capacity import capacity_from_path, forecast_exhaustion, get_monthly_demand
+from core.collect import DEFAULT_TTL, ResultCache, get_overrides, load_queries, run_queries, select_queries
+from core.config import config_for_set, config_from_path, config_from_git, get_config_root
+from core.cost import catalog_from_path, get_cost_data
+from core.cube import CubeWriter, SummaryCube
+from core.diff import diff_configs
+from core.distributed import Coordinator, parse_address, run_worker
+from core.emulator import fit_emulator as fit_config_emulator, parse_parameter_range
+from core.generate import generate_usage_data, generate_service_data, get_service_and_summary_data
+from core.output import write_raw_data, write_summary_comparisons, write_summary_data, write_raw_service_data, \
+    write_set_summary, write_capacity_forecast, write_procurement_plan
+from core.parallel import generate_service_summary_data
+from core.procurement import plan_procurement
+from core.server import ModelServer
+from core.sets import count_combined_sets, get_set_context, iter_combined_sets
+from core.solve import solve_max_value
+from core.store import ResultsStore
 from core.summarize import incremental_summaries, \
-    summarize_service_data, compare_summaries, get_summary_data
+    summarize_service_data, compare_summaries, get_summary_dates
 from core.utils import apply_context, context_pattern
-from core.writers import ConsoleWriter
-from core.writers import ExcelWriter
+from core.writers import ConsoleWriter, CSVStreamWriter
+from core.writers import get_file_writer
 
 SummaryData = namedtuple('SummaryData', 'storage compute')
+BatchResult = namedtuple('BatchResult', 'config_path sets seconds error')
 
 
+@functools.lru_cache()
 def get_git_revision_hash():
     return subprocess.check_output(['git', 'rev-parse', 'HEAD']).strip().decode('utf8')
 
 
-def get_combined_sets(sets):
-    combined_sets = []
-    for combinations in list(itertools.product(*sets.values())):
-        context = {}
-        name = None
-        for item in combinations:
-            item = item.copy()
-            item_name = item.pop('name', None)
-            context.update(item)
-            if item_name:
-                if not name:
-                    name = item_name
-                else:
-                    name += f'-{item_name}'
-        context['name'] = name
-        combined_sets.append(context)
-    return combined_sets
+def add_authkey_argument(parser):
+    parser.add_argument('--authkey', default=os.environ.get('MODEL_AUTHKEY'),
+                        help='Shared secret key used to authenticate workers. Defaults to $MODEL_AUTHKEY. '
+                             'The coordinator generates and prints a random key if neither is set.')
 
 
-if __name__ == '__main__':
+def get_authkey(args, generate=False):
+    """:param generate: generate a random key if none is given. Otherwise a key is required."""
+    if args.authkey:
+        return args.authkey.encode('utf8')
+    if not generate:
+        print('A shared key is required: pass --authkey or set $MODEL_AUTHKEY to the key used by the coordinator.')
+        sys.exit(1)
+    authkey = secrets.token_hex(16)
+    print(f'No --authkey or $MODEL_AUTHKEY given. Start workers with MODEL_AUTHKEY={authkey}')
+    return authkey.encode('utf8')
+
+
+def add_prices_argument(parser):
+    parser.add_argument('--prices', help='Path to YAML price catalog used to compute the cost. '
+                                         'Overrides the "price_catalog" in the config.')
+
+
+def load_config(args):
+    config = config_from_path(args.config)
+    if args.prices:
+        config.price_catalog = catalog_from_path(args.prices)
+    return config
+
+
+def write_sets_comparison(config, sets_snapshots, output):
+    output_path = apply_context({'name': 'comparison'}, output)
+    print(f'Writing comparison output to "{output_path}"')
+    set_comparisons = compare_summaries(config, sets_snapshots)
+    comparison_writer = get_file_writer(output_path)
+    with comparison_writer:
+        write_summary_comparisons(config, comparison_writer, {}, set_comparisons)
+
+
+def run_coordinator(config, combined_sets, args):
+    coordinator = Coordinator(
+        config, combined_sets, parse_address(args.coordinator), get_authkey(args, generate=True),
+        shard_size=args.shard_size, max_retries=args.retries
+    )
+    print(f'Waiting for workers on {args.coordinator} to process {len(coordinator.set_contexts)} sets')
+    sets_snapshots = coordinator.run()
+
+    summary_date = config.sets_summary_date_val
+    if args.stream:
+        with CSVStreamWriter(args.stream) as stream:
+            for name, snapshot in sets_snapshots.items():
+                write_set_summary(stream, name, summary_date, snapshot)
+
+    if args.output:
+        write_sets_comparison(config, sets_snapshots, args.output)
+    else:
+        with ConsoleWriter() as writer:
+            write_summary_comparisons(config, writer, {}, compare_summaries(config, sets_snapshots))
+    return len(sets_snapshots)
+
+
+def worker(argv):
+    parser = argparse.ArgumentParser('CommCare Cluster Model worker')
+    parser.add_argument('coordinator', metavar='HOST:PORT', help='Address of the coordinator')
+    parser.add_argument('--timeout', type=int, default=30,
+                        help='Seconds to wait for the coordinator to accept connections.')
+    add_authkey_argument(parser)
+    args = parser.parse_args(argv)
+
+    print(f'Connecting to coordinator at {args.coordinator}')
+    processed = run_worker(parse_address(args.coordinator), get_authkey(args), connect_timeout=args.timeout)
+    print(f'Processed {processed} shards')
+
+
+def get_config_cost(config_path):
+    """Rough relative cost of running a config used to schedule the largest configs first"""
+    config = config_from_path(config_path)
+    sets = count_combined_sets(config.sets) if config.sets else 1
+    return sets * (len(config.usage) + len(config.services))
+
+
+def get_batch_configs(paths, pattern):
+    config_paths = []
+    for path in paths:
+        if os.path.isdir(path):
+            config_paths.extend(sorted(glob.glob(os.path.join(path, pattern))))
+        else:
+            config_paths.append(path)
+    return config_paths
+
+
+def run_batch_config(config_path, output, usage_cache=None, service_caches=None):
+    argv = [config_path]
+    if output:
+        config_name = os.path.splitext(os.path.basename(config_path))[0]
+        argv += ['-o', output.replace('{config}', config_name)]
+
+    start = time.time()
+    try:
+        sets = run_config(get_parser().parse_args(argv), usage_cache, service_caches)
+    except (Exception, SystemExit) as e:
+        return BatchResult(config_path, 0, time.time() - start, f'{type(e).__name__}: {e}')
+    return BatchResult(config_path, sets, time.time() - start, None)
+
+
+def run_batch_group(config_paths, output):
+    """Run configs that extend the same base in one process. The usage fields
+    and services that are the same in each config are only computed once."""
+    if len(config_paths) == 1:
+        return [run_batch_config(config_paths[0], output)]
+    usage_cache = {}
+    service_caches = {}
+    return [
+        run_batch_config(config_path, output, usage_cache, service_caches)
+        for config_path in config_paths
+    ]
+
+
+def get_batch_groups(config_paths):
+    """:return: lists of config paths grouped by the config at the root of their ``extends`` chain"""
+    groups = OrderedDict()
+    for config_path in config_paths:
+        try:
+            root = get_config_root(config_path)
+        except Exception:
+            # the error is reported when the config is run
+            root = config_path
+        groups.setdefault(root, []).append(config_path)
+    return list(groups.values())
+
+
+def batch(argv):
+    parser = argparse.ArgumentParser('CommCare Cluster Model batch')
+    parser.add_argument('paths', nargs='+', help='Config files or directories of config files')
+    parser.add_argument('-o', '--output',
+                        help='Write output to Excel files at this path. '
+                             'Must include the {config} placeholder and {name} for configs with sets.')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='Number of configs to run in parallel. Defaults to the number of CPUs.')
+    parser.add_argument('--pattern', default='*.yml', help='Config file pattern for directories.')
+    args = parser.parse_args(argv)
+
+    if args.output and '{config}' not in context_pattern.findall(args.output):
+        print("Add '{config}' placeholder to the output filename create unique files per config.")
+        sys.exit(1)
+
+    config_paths = get_batch_configs(args.paths, args.pattern)
+    costs = {}
+    for config_path in config_paths:
+        try:
+            costs[config_path] = get_config_cost(config_path)
+        except Exception:
+            costs[config_path] = 0
+    groups = get_batch_groups(config_paths)
+    groups.sort(key=lambda group: sum(costs[config_path] for config_path in group), reverse=True)
+
+    # compute once in this process so that it is inherited by the workers
+    get_git_revision_hash()
+
+    start = time.time()
+    results = []
+    if args.jobs == 1:
+        for group in groups:
+            results.extend(run_batch_group(group, args.output))
+    else:
+        with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            futures = [
+                executor.submit(run_batch_group, group, args.output)
+                for group in groups
+            ]
+            for future in as_completed(futures):
+                results.extend(future.result())
+    elapsed = time.time() - start
+
+    report = pd.DataFrame([
+        {
+            'Config': os.path.basename(result.config_path),
+            'Sets': result.sets,
+            'Seconds': result.seconds,
+            'Status': result.error or 'OK',
+        }
+        for result in sorted(results, key=lambda r: r.seconds, reverse=True)
+    ]).set_index('Config')
+    pd.set_option('display.max_colwidth', 80)
+    print('\n' + report.to_string(float_format='{:.1f}'.format))
+    failed = sum(1 for result in results if result.error)
+    print(
+        f'\n{len(results)} configs ({failed} failed), {report.Sets.sum()} sets in {elapsed:.1f}s '
+        f'using {args.jobs} jobs (sum of config times {report.Seconds.sum():.1f}s)'
+    )
+    if failed:
+        sys.exit(1)
+
+
+def solve(argv):
+    parser = argparse.ArgumentParser('CommCare Cluster Model solver')
+    parser.add_argument('config', help='Path to config file')
+    parser.add_argument('-l', '--limits', required=True, help='Path to YAML file with the resource limits.')
+    parser.add_argument('--variable', default='users', help='Set variable to solve for. Defaults to "users".')
+    parser.add_argument('--min', type=float, required=True, help='Lower bound for the variable.')
+    parser.add_argument('--max', type=float, required=True, help='Upper bound for the variable.')
+    parser.add_argument('--tolerance', type=float, default=1, help='Stop once the answer is within this range.')
+    parser.add_argument('--set', help='Set to use for the other set variables. Defaults to the first set.')
+    parser.add_argument('--date', help='Only check limits up to this date (YYYY-MM). Defaults to all dates.')
+    parser.add_argument('--batch-size', type=int, default=4, help='Number of values to evaluate per round.')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of processes to evaluate values.')
+    add_prices_argument(parser)
+    args = parser.parse_args(argv)
+
+    pd.options.display.float_format = '{:.3f}'.format
+    config = load_config(args)
+    limits = capacity_from_path(args.limits).limit_series()
+
+    low, high = args.min, args.max
+    if all(float(value).is_integer() for value in (low, high, args.tolerance)):
+        low, high = int(low), int(high)
+    try:
+        set_context = get_set_context(config, args.set)
+        result = solve_max_value(
+            config, set_context, args.variable, limits, low, high,
+            tolerance=args.tolerance, batch_size=args.batch_size, date=args.date, jobs=args.jobs
+        )
+    except ValueError as e:
+        parser.error(str(e))
+
+    print(f'Evaluated {result.evaluations} values of "{args.variable}" for set "{set_context["name"]}"')
+    if result.value is None:
+        print(f'Limits are exceeded at the minimum value ({args.min})')
+    elif result.exceeded_value is None:
+        print(f'Limits are not reached at the maximum value ({args.max})')
+    else:
+        print(f'Maximum {args.variable}: {result.value} (limits exceeded at {result.exceeded_value})')
+
+    utilization = pd.DataFrame(OrderedDict([
+        (f'Utilization at {value}', utilization)
+        for value, utilization in [(result.value, result.utilization), (result.exceeded_value, result.exceeded_utilization)]
+        if utilization is not None
+    ]))
+    utilization = utilization.sort_values(list(utilization.columns)[-1], ascending=False)
+    utilization.index = [':'.join(key) for key in utilization.index]
+    with ConsoleWriter() as writer:
+        writer.write_data_frame(utilization, 'Limits', 'Limit', 'Utilization of limits (1 = fully used)')
+
+
+def fit_emulator(argv):
+    parser = argparse.ArgumentParser('CommCare Cluster Model emulator fitting')
+    parser.add_argument('config', help='Path to config file')
+    parser.add_argument('-p', '--parameter', action='append', required=True,
+                        help='Set variable and range to sample e.g. users=1000:50000. May be repeated.')
+    parser.add_argument('-o', '--output', required=True, help='Write the emulator to this JSON file.')
+    parser.add_argument('--samples', type=int, default=64, help='Number of model runs including held-out runs.')
+    parser.add_argument('--holdout', type=float, default=0.25,
+                        help='Fraction of the runs used to measure the error of the emulator.')
+    parser.add_argument('--degree', type=int, default=2, help='Degree of the polynomial.')
+    parser.add_argument('--set', help='Set to use for the other set variables. Defaults to the first set.')
+    parser.add_argument('--date', help='Date of the metrics (YYYY-MM). Defaults to the sets summary date or '
+                                       'the last date.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for the sampling.')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of processes to run the model.')
+    add_prices_argument(parser)
+    args = parser.parse_args(argv)
+
+    pd.options.display.float_format = '{:.3f}'.format
+    config = load_config(args)
+    try:
+        parameters = [parse_parameter_range(value) for value in args.parameter]
+        start = time.time()
+        emulator = fit_config_emulator(
+            config, get_set_context(config, args.set), parameters, args.samples, args.holdout,
+            args.degree, args.date, args.jobs, args.seed
+        )
+    except ValueError as e:
+        parser.error(str(e))
+
+    print(f'Fitted to {args.samples} model runs in {time.time() - start:.1f}s')
+    if emulator.errors is not None:
+        with ConsoleWriter() as writer:
+            writer.write_data_frame(emulator.errors, 'Emulator', 'Metric', 'Error on held-out runs')
+    emulator.save(args.output)
+    print(f'Emulator written to "{args.output}"')
+
+
+def get_demand_by_set(config, set_name=None):
+    """:return: dict of set name -> monthly demand of each set (or only ``set_name``)"""
+    if set_name:
+        combined_sets = [get_set_context(config, set_name)]
+    else:
+        combined_sets = iter_combined_sets(config.sets) if config.sets else iter([{'name': 'default'}])
+
+    demand_by_set = OrderedDict()
+    usage_cache = {}
+    service_cache = {}
+    for set_context in combined_sets:
+        set_config = config_for_set(config, set_context)
+        usage = generate_usage_data(set_config, set_context, usage_cache)
+        _, summary_data = get_service_and_summary_data(set_config, usage, service_cache)
+        demand_by_set[set_context['name']] = get_monthly_demand(set_config, summary_data)
+    return demand_by_set
+
+
+def forecast(argv):
+    parser = argparse.ArgumentParser('CommCare Cluster Model capacity forecast')
+    parser.add_argument('config', help='Path to config file')
+    parser.add_argument('-l', '--provisioned', required=True,
+                        help='Path to YAML file with the currently provisioned resources.')
+    parser.add_argument('--lead-time', type=int, default=0, help='Months needed to provision new resources.')
+    parser.add_argument('--set', help='Only run a specific set.')
+    parser.add_argument('-o', '--output', help='Write output to Excel file at this path. '
+                                               'Paths ending in .html are written as an HTML report.')
+    add_prices_argument(parser)
+    args = parser.parse_args(argv)
+
+    pd.options.display.float_format = '{:.1f}'.format
+    config = load_config(args)
+    limits = capacity_from_path(args.provisioned).limit_series()
+    try:
+        demand_by_set = get_demand_by_set(config, args.set)
+        capacity_forecast = forecast_exhaustion(demand_by_set, limits, args.lead_time)
+    except ValueError as e:
+        parser.error(str(e))
+    writer = get_file_writer(args.output) if args.output else ConsoleWriter()
+    with writer:
+        write_capacity_forecast(config, writer, capacity_forecast, args.lead_time)
+
+
+def plan(argv):
+    parser = argparse.ArgumentParser('CommCare Cluster Model procurement plan')
+    parser.add_argument('config', help='Path to config file')
+    parser.add_argument('--steps', required=True,
+                        help='Path to YAML file with the purchase step size of each resource.')
+    parser.add_argument('-l', '--provisioned',
+                        help='Path to YAML file with the resources that are provisioned before the first month.')
+    parser.add_argument('--lead-time', type=int, default=0, help='Months between ordering and delivery.')
+    parser.add_argument('--set', help='Only run a specific set.')
+    parser.add_argument('-o', '--output', help='Write output to Excel file at this path. '
+                                               'Paths ending in .html are written as an HTML report.')
+    add_prices_argument(parser)
+    args = parser.parse_args(argv)
+
+    pd.options.display.float_format = '{:.1f}'.format
+    config = load_config(args)
+    steps = capacity_from_path(args.steps)
+    provisioned = capacity_from_path(args.provisioned) if args.provisioned else None
+    try:
+        demand_by_set = get_demand_by_set(config, args.set)
+        procurement_plan = plan_procurement(demand_by_set, steps, provisioned, args.lead_time)
+    except ValueError as e:
+        parser.error(str(e))
+    writer = get_file_writer(args.output) if args.output else ConsoleWriter()
+    with writer:
+        write_procurement_plan(config, writer, procurement_plan, args.lead_time)
+
+
+def format_config_key(key):
+    return '.'.join(key)
+
+
+def simulate(argv):
+    parser = argparse.ArgumentParser('CommCare Cluster Model autoscaling simulation')
+    parser.add_argument('config', help='Path to config file')
+    parser.add_argument('--set', help='Set to simulate. Defaults to the first set.')
+    parser.add_argument('--start', help='First day to simulate (YYYY-MM-DD). Defaults to a year before the last month.')
+    parser.add_argument('--days', type=int, default=365, help='Number of days to simulate. Defaults to 365.')
+    parser.add_argument('-s', '--service', help='Only simulate a specific service.')
+    args = parser.parse_args(argv)
+
+    config = config_from_path(args.config)
+    if args.service:
+        config.services = {
+            args.service: config.services[args.service]
+        }
+    if not any(service_def.autoscaling for service_def in config.services.values()):
+        print('No services have an autoscaling policy')
+        sys.exit(1)
+
+    set_context = get_set_context(config, args.set)
+    config = config_for_set(config, set_context)
+    usage = generate_usage_data(config, set_context)
+    service_data = generate_service_data(config, usage)
+    start = args.start or usage.index[-1] - pd.DateOffset(months=11)
+
+    pd.options.display.float_format = '{:.2f}'.format
+    results = simulate_autoscaling(config, service_data, start, args.days)
+    with ConsoleWriter() as writer:
+        writer.write_data_frame(results, f"Autoscaling ({set_context['name']})", 'Service')
+
+
+def calibrate(argv):
+    parser = argparse.ArgumentParser('CommCare Cluster Model calibration')
+    parser.add_argument('config', help='Path to config file')
+    parser.add_argument('observed', help='CSV or Parquet file of observed monthly values. The first column is the month '
+                                         'and the others are usage fields or "<service>.storage" in bytes.')
+    parser.add_argument('-p', '--parameter', action='append', required=True,
+                        help='Parameter to fit e.g. usage.forms.factor or '
+                             'services.couch.storage.data_models.0.unit_size. May be repeated.')
+    parser.add_argument('--set', help='Set to calibrate. Defaults to the first set.')
+    parser.add_argument('--max-iterations', type=int, default=100, help='Maximum solver iterations.')
+    parser.add_argument('-o', '--output', help='Write the config with the fitted parameters to this file.')
+    parser.add_argument('--residuals', help='Write the observed and fitted values to this CSV file.')
+    args = parser.parse_args(argv)
+
+    config = config_from_path(args.config)
+    observed = load_observations(args.observed)
+    try:
+        result = calibrate_config(
+            config, get_set_context(config, args.set), args.parameter, observed, args.max_iterations
+        )
+    except ValueError as e:
+        parser.error(str(e))
+
+    print(f'Fitted in {result.iterations} iterations ({result.evaluations} model evaluations)')
+    pd.set_option('display.max_rows', None)
+    with ConsoleWriter() as writer:
+        writer.write_data_frame(result.parameters, 'Calibration', 'Parameters')
+        writer.write_data_frame(result.metrics, 'Calibration', 'RMS error relative to the largest observed value')
+
+    if args.residuals:
+        result.residuals.to_csv(args.residuals)
+        print(f'Residuals written to "{args.residuals}"')
+    if args.output:
+        write_fitted_config(args.config, result.parameters['Fitted'].to_dict(), args.output)
+        print(f'Fitted config written to "{args.output}"')
+
+
+def collect(argv):
+    parser = argparse.ArgumentParser('CommCare Cluster Model input collection')
+    parser.add_argument('queries', nargs='?', default='queries.yml', help='Path to the queries file.')
+    parser.add_argument('--db', help='Database URL for SQL queries e.g. postgresql://user@host/db or sqlite:///path')
+    parser.add_argument('--es', help='Elasticsearch URL for ES queries e.g. http://localhost:9200')
+    parser.add_argument('-q', '--query', action='append', help='Only run these queries. May be repeated.')
+    parser.add_argument('--pool-size', type=int, default=4, help='Number of concurrent queries per endpoint.')
+    parser.add_argument('--cache', default='.query-cache.json', help='Path to the cache of query results.')
+    parser.add_argument('--ttl', type=int, default=DEFAULT_TTL, help='Seconds to cache query results for.')
+    parser.add_argument('--refresh', action='store_true', help='Ignore cached results.')
+    parser.add_argument('--set-name', default='collected', help='Name of the set in the overrides file.')
+    parser.add_argument('-o', '--output', help='Write the config overrides to this YAML file.')
+    args = parser.parse_args(argv)
+
+    queries = load_queries(args.queries, args.ttl)
+    try:
+        if args.query:
+            queries = select_queries(queries, args.query)
+        results = asyncio.run(run_queries(
+            queries, args.db, args.es, args.pool_size, ResultCache(args.cache), args.refresh
+        ))
+    except ValueError as e:
+        parser.error(str(e))
+    for name, (result, value) in results.items():
+        if value is None and 'rows' in result:
+            print(f'{name}:')
+            print(pd.DataFrame(result['rows'], columns=result['columns']).to_string(index=False))
+        else:
+            print(f'{name}: {value}')
+
+    overrides = yaml.safe_dump(get_overrides(results, args.set_name), default_flow_style=False, sort_keys=False)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(overrides)
+        print(f'Overrides written to "{args.output}"')
+    else:
+        print(overrides)
+
+
+def query(argv):
+    parser = argparse.ArgumentParser('CommCare Cluster Model cube query')
+    parser.add_argument('cube', help='Path to the cube written with the "--cube" option')
+    parser.add_argument('--set', action='append', help='Sets to include. May be repeated.')
+    parser.add_argument('-s', '--service', action='append', help='Services to include. May be repeated.')
+    parser.add_argument('-m', '--metric', action='append', help='Metrics to include. May be repeated.')
+    parser.add_argument('--period', help='Period to include e.g. 2020, 2020-Q2 or 2020-06')
+    parser.add_argument('--start', help='First month to include (YYYY-MM)')
+    parser.add_argument('--end', help='Last month to include (YYYY-MM)')
+    parser.add_argument('--list', action='store_true', help='List the labels of the cube')
+    args = parser.parse_args(argv)
+
+    pd.options.display.float_format = '{:.1f}'.format
+    cube = SummaryCube.load(args.cube)
+    if args.list:
+        for axis, labels in cube.labels.items():
+            print(f'{axis} ({len(labels)}): {", ".join(labels)}')
+        return
+
+    selection = cube.sel(
+        set=args.set, service=args.service, metric=args.metric,
+        start=args.start, end=args.end, period=args.period,
+    )
+    with ConsoleWriter() as writer:
+        writer.write_data_frame(selection.to_frame(), 'Query', 'Month')
+
+
+def serve(argv):
+    parser = argparse.ArgumentParser('CommCare Cluster Model server')
+    parser.add_argument('configs', nargs='+', help='Config files to serve')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on.')
+    parser.add_argument('--port', type=int, default=8000, help='Port to listen on.')
+    parser.add_argument('--cache-size', type=int, default=32, help='Number of set results to keep in memory.')
+    add_prices_argument(parser)
+    args = parser.parse_args(argv)
+
+    server = ModelServer.from_paths(args.configs, cache_size=args.cache_size)
+    if args.prices:
+        catalog = catalog_from_path(args.prices)
+        for model in server.models.values():
+            model.config.price_catalog = catalog
+
+    async def _serve():
+        http_server = await server.start(args.host, args.port)
+        print('Serving {} on http://{}:{}'.format(', '.join(server.models), args.host, args.port))
+        async with http_server:
+            await http_server.serve_forever()
+
+    try:
+        asyncio.run(_serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+
+def history(argv):
+    parser = argparse.ArgumentParser('CommCare Cluster Model results history')
+    parser.add_argument('db', help='Path to the results database written with the "--db" option')
+    parser.add_argument('-s', '--service', required=True, help='Service to show.')
+    parser.add_argument('-m', '--metric', default='VMs Total', help='Summary metric to show. Defaults to "VMs Total".')
+    parser.add_argument('--set', help='Only show a specific set.')
+    parser.add_argument('--date', help='Date to compare (YYYY-MM). Defaults to the last date of each run.')
+    parser.add_argument('--config', help='Only show runs of this config file name.')
+    args = parser.parse_args(argv)
+
+    pd.options.display.float_format = '{:.1f}'.format
+    with ResultsStore(args.db) as store:
+        history = store.get_history(args.service, args.metric, args.set, args.date, args.config)
+    with ConsoleWriter() as writer:
+        writer.write_data_frame(history.set_index('run'), f'{args.service}: {args.metric}', 'History')
+
+
+def diff(argv):
+    parser = argparse.ArgumentParser('CommCare Cluster Model diff')
+    parser.add_argument('config', help='Path to config file')
+    parser.add_argument('other', nargs='?', help='Path to the config file to compare with. '
+                                                 'Defaults to the same config file.')
+    parser.add_argument('--rev', help='Git revision of the first config e.g. HEAD~1')
+    parser.add_argument('--other-rev', help='Git revision of the other config. Defaults to the current file.')
+    parser.add_argument('--set', help='Set to compare. Defaults to the first set.')
+    parser.add_argument('--tolerance', type=float, default=0.01,
+                        help='Relative change to ignore. Defaults to 0.01 (1%%).')
+    parser.add_argument('--abs-tolerance', type=float, default=0, help='Absolute change to ignore.')
+    parser.add_argument('--date', help='Only show changes for this date (YYYY-MM).')
+    args = parser.parse_args(argv)
+
+    other_path = args.other or args.config
+    if other_path == args.config and not (args.rev or args.other_rev):
+        parser.error('Specify another config or a git revision to compare with')
+
+    config = config_from_git(args.config, args.rev) if args.rev else config_from_path(args.config)
+    other = config_from_git(other_path, args.other_rev) if args.other_rev else config_from_path(other_path)
+
+    result = diff_configs(
+        config, get_set_context(config, args.set),
+        other, get_set_context(other, args.set),
+        rtol=args.tolerance, atol=args.abs_tolerance
+    )
+    cells = result.cells
+    if args.date:
+        cells = cells[cells.index.get_level_values('date') == pd.Timestamp(args.date)]
+
+    pd.options.display.float_format = '{:.1f}'.format
+    pd.set_option('display.max_rows', None)
+    print(f'{len(result.changed_keys)} changed config keys')
+    for key in result.changed_keys:
+        print(f'    {format_config_key(key)}')
+
+    with ConsoleWriter() as writer:
+        for service_name in cells.index.get_level_values('service').unique():
+            causes = result.causes.get(service_name) or []
+            writer.write_data_frame(
+                cells.xs(service_name, level='service'), 'Changes', None,
+                header='{} (caused by: {})'.format(
+                    service_name, ', '.join(format_config_key(key) for key in causes) or 'unknown'
+                )
+            )
+    if cells.empty:
+        print('No changes beyond the tolerance')
+
+
+def get_parser():
     parser = argparse.ArgumentParser('CommCare Cluster Model')
     parser.add_argument('config', help='Path to config file')
-    parser.add_argument('-o', '--output', help='Write output to Excel file at this path.')
+    parser.add_argument('-o', '--output', help='Write output to Excel file at this path. '
+                                               'Paths ending in .html are written as an HTML report.')
     parser.add_argument('-s', '--service', help='Only output data for specific service.')
     parser.add_argument('-u', '--usage', help='Print a specific usage field.')
     parser.add_argument('--set', help='Only run a specific set.')
+    parser.add_argument('-p', '--processes', type=int,
+                        help='Compute the services in parallel using this many worker processes.')
+    parser.add_argument('--compact', action='store_true',
+                        help='Use smaller dtypes (int32 counts, float32 values) to reduce memory use for large sweeps.')
+    parser.add_argument('--stream', help='Append the summary of each set to this CSV file as soon as it is '
+                                         'computed. Use for large sweeps in place of the comparison output.')
+    parser.add_argument('--cube', help='Write the monthly summary data of every set to a cube file at this path '
+                                       'for querying with the "query" command.')
+    parser.add_argument('--db', help='Record the results of this run in a SQLite database at this path '
+                                     'for comparing with the "history" command.')
+    parser.add_argument('--coordinator', metavar='HOST:PORT',
+                        help='Distribute the sets to workers connecting to this address. '
+                             'Start workers with "run_model.py worker HOST:PORT".')
+    parser.add_argument('--shard-size', type=int, default=1, help='Number of sets to send to a worker at a time.')
+    parser.add_argument('--retries', type=int, default=3, help='Number of times to retry a failed shard.')
+    add_prices_argument(parser)
+    add_authkey_argument(parser)
+    return parser
+
+
+def main(argv):
+    args = get_parser().parse_args(argv)
+    run_config(args)
+
 
-    args = parser.parse_args()
+def run_config(args, usage_cache=None, service_caches=None):
+    """Run the model for a single config
 
+    :param usage_cache: Optional dict of usage fields shared with other configs
+    :param service_caches: Optional dict of set name -> service cache shared with other configs
+    :return: number of sets computed
+    """
     pd.options.display.float_format = '{:.1f}'.format
 
     config_path = args.config
     config_name = os.path.basename(config_path)
-    config = config_from_path(config_path)
+    config = load_config(args)
+    if args.compact:
+        config.compact_dtypes = True
 
     if args.service:
         config.services = {
             args.service: config.services[args.service]
         }
 
-    combined_sets = get_combined_sets(config.sets) if config.sets else [{'name': 'default'}]
+    combined_sets = iter_combined_sets(config.sets) if config.sets else iter([{'name': 'default'}])
 
     if args.set:
-        combined_sets = [s for s in combined_sets if s['name'] == args.set]
+        combined_sets = (s for s in combined_sets if s['name'] == args.set)
+
+    if args.coordinator:
+        return run_coordinator(config, combined_sets, args)
 
-    multiple_sets = len(combined_sets) > 1
-    is_excel = bool(args.output)
-    if multiple_sets and is_excel:
+    multiple_sets = not args.set and bool(config.sets) and count_combined_sets(config.sets) > 1
+    is_file_output = bool(args.output)
+    if multiple_sets and is_file_output:
         placeholders = context_pattern.findall(args.output)
         if '{name}' not in placeholders:
             print("Add '{name}' placeholder to the output filename create unique files per set.")
             sys.exit(1)
 
     sets_snapshots = OrderedDict()
-    for set_context in combined_sets:
-
-        print(f"Generating data for set '{set_context['name']}'")
-        usage = generate_usage_data(config, set_context)
+    set_count = 0
+    stream_writer = CSVStreamWriter(args.stream) if args.stream else nullcontext()
+    set_total = 1 if args.set or not config.sets else count_combined_sets(config.sets)
+    cube_writer = CubeWriter(args.cube, set_total) if args.cube else nullcontext()
+    results_store = ResultsStore(args.db) if args.db else nullcontext()
+    service_cache = {}
+    with stream_writer as stream, cube_writer as cube, results_store as store:
+        if store:
+            run_id = store.add_run(config_name, config, get_git_revision_hash())
+        for set_context in combined_sets:
+            set_count += 1
+            print(f"Generating data for set '{set_context['name']}'")
+            set_config = config_for_set(config, set_context)
+            usage = generate_usage_data(set_config, set_context, usage_cache)
 
-        if args.usage:
-            print(usage[args.usage])
+            if args.usage:
+                print(usage[args.usage])
 
-        service_data = generate_service_data(config, usage)
+            set_service_cache = service_cache
+            if service_caches is not None:
+                # the same set of another config is the most likely to have the same services
+                set_service_cache = service_caches.setdefault(set_context['name'], {})
+            if args.processes:
+                service_data, summary_data = generate_service_summary_data(
+                    set_config, usage, args.processes, set_service_cache
+                )
+            else:
+                service_data, summary_data = get_service_and_summary_data(set_config, usage, set_service_cache)
 
-        if config.summary_dates:
-            summary_dates = config.summary_date_vals
-        else:
-            summary_dates = [usage.iloc[-1].name]  # summarize at final date
+            if cube:
+                cube.write(set_context['name'], summary_data)
+            if store:
+                store.add_set(run_id, set_context['name'], usage, service_data, summary_data)
 
-        summary_dates = sorted(summary_dates)
+            summary_dates = get_summary_dates(set_config, usage)
 
-        if is_excel:
-            output_path = apply_context(set_context, args.output)
-            print(f'Writing output to "{output_path}"')
-            writer = ExcelWriter(output_path)
-        else:
-            writer = ConsoleWriter()
-
-        with writer:
-            summaries = OrderedDict()
-            user_count = {}
-            date_list = list(usage.index.to_series())
-            summary_data = get_summary_data(config, service_data)
-            for date in summary_dates:
-                summaries[date] = summarize_service_data(config, summary_data, date)
-                user_count[date] = usage.loc[date]['users']
-
-            if multiple_sets and config.sets_summary_date_val:
-                sets_snapshots[set_context['name']] = summaries[config.sets_summary_date_val]
-
-            if len(summary_dates) == 1:
-                date = summary_dates[0]
-                summary_data_snapshot = summaries[date]
-                write_summary_data(config, writer, date, summary_data_snapshot, user_count[date])
+            if is_file_output:
+                output_path = apply_context(set_context, args.output)
+                print(f'Writing output to "{output_path}"')
+                writer = get_file_writer(output_path)
             else:
-                summary_comparisons = compare_summaries(config, summaries)
-                incrementals = incremental_summaries(summary_comparisons, summary_dates)
-                write_summary_comparisons(config, writer, user_count, summary_comparisons)
-                write_summary_comparisons(config, writer, user_count, incrementals, prefix='Incremental ')
-
-                for date in sorted(summaries):
-                    write_summary_data(config, writer, date, summaries[date], user_count[date])
-
-            if is_excel:
-                # only write raw data if writing to Excel
-                write_raw_data(writer, usage, 'Usage')
-                write_raw_service_data(writer, service_data, summary_data, 'Raw Data')
-
-                with open(config_path, 'r') as f:
-                    config_string = 'Config filename: {}\nGit commit: {}\n\n{}'.format(
-                        config_name,
-                        get_git_revision_hash(),
-                        f.read()
-                    )
-                    writer.write_config_string(config_string)
+                writer = ConsoleWriter()
+
+            with writer:
+                summaries = OrderedDict()
+                user_count = {}
+                date_list = list(usage.index.to_series())
+                cost_data = get_cost_data(set_config, summary_data) if set_config.price_catalog else None
+                for date in summary_dates:
+                    summaries[date] = summarize_service_data(set_config, summary_data, date, cost_data)
+                    user_count[date] = usage.loc[date]['users']
+
+                if stream:
+                    for date, summary in summaries.items():
+                        write_set_summary(stream, set_context['name'], date, summary)
+
+                if multiple_sets and is_file_output and set_config.sets_summary_date_val:
+                    # only keep the snapshots if we're going to write the comparison output
+                    sets_snapshots[set_context['name']] = summaries[set_config.sets_summary_date_val]
+
+                if len(summary_dates) == 1:
+                    date = summary_dates[0]
+                    summary_data_snapshot = summaries[date]
+                    write_summary_data(set_config, writer, date, summary_data_snapshot, user_count[date])
+                else:
+                    summary_comparisons = compare_summaries(set_config, summaries)
+                    incrementals = incremental_summaries(summary_comparisons, summary_dates)
+                    write_summary_comparisons(set_config, writer, user_count, summary_comparisons)
+                    write_summary_comparisons(set_config, writer, user_count, incrementals, prefix='Incremental ')
+
+                    for date in sorted(summaries):
+                        write_summary_data(set_config, writer, date, summaries[date], user_count[date])
+
+                if is_file_output:
+                    # only write raw data if writing to a file
+                    write_raw_data(writer, usage, 'Usage')
+                    write_raw_service_data(writer, service_data, summary_data, 'Raw Data')
+
+                    with open(config_path, 'r') as f:
+                        config_string = 'Config filename: {}\nGit commit: {}\n\n{}'.format(
+                            config_name,
+                            get_git_revision_hash(),
+                            f.read()
+                        )
+                        writer.write_config_string(config_string)
 
     if sets_snapshots and args.output:
-        output_path = apply_context({'name': 'comparison'}, args.output)
-        print(f'Writing comparison output to "{output_path}"')
-        set_comparisons = compare_summaries(config, sets_snapshots)
-        comparison_writer = ExcelWriter(output_path)
-        with comparison_writer:
-            write_summary_comparisons(config, comparison_writer, {}, set_comparisons)
+        write_sets_comparison(config, sets_snapshots, args.output)
+    return set_count
+
+
+COMMANDS = {
+    'batch': batch,
+    'calibrate': calibrate,
+    'collect': collect,
+    'diff': diff,
+    'fit-emulator': fit_emulator,
+    'forecast': forecast,
+    'history': history,
+    'plan': plan,
+    'query': query,
+    'serve': serve,
+    'simulate': simulate,
+    'solve': solve,
+    'worker': worker,
+}
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        COMMANDS[sys.argv[1]](sys.argv[2:])
+    else:
+        main(sys.argv[1:])